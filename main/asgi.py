@@ -11,14 +11,25 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.auth import AuthMiddlewareStack
+from channels.security.websocket import AllowedHostsOriginValidator
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
 
+# Set up Django before the consumers import models
+django_asgi_app = get_asgi_application()
+
 import skilloryx.routing  # noqa
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": URLRouter(
-        skilloryx.routing.websocket_urlpatterns
+    "http": django_asgi_app,
+    # Sockets sign in from the session cookie, so only our own pages may
+    # open them
+    "websocket": AllowedHostsOriginValidator(
+        AuthMiddlewareStack(
+            URLRouter(
+                skilloryx.routing.websocket_urlpatterns
+            )
+        )
     ),
 })
@@ -57,7 +57,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "skilloryx.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "skilloryx.queries.QueryCountMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -72,7 +74,7 @@ ROOT_URLCONF = "urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "BACKEND": "skilloryx.metrics.DjangoTemplates",
         "DIRS": [BASE_DIR / "templates"],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -80,6 +82,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "skilloryx.caching.fragments",
             ],
         },
     },
@@ -137,29 +140,139 @@ USE_TZ = True
 STATIC_URL = "/static/"
 STATICFILES_DIRS = [BASE_DIR / "static"]
 STATIC_ROOT = BASE_DIR / "staticfiles"
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+# Pagination
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 24))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
 
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
-
-# Channels
-if os.environ.get('REDIS_URL'):
+# Uploads get content-hashed names and are served with immutable caching
+STORAGES = {
+    'default': {'BACKEND': 'skilloryx.storage.HashedFileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+MEDIA_MAX_AGE = 60 * 60
+
+# Profile photos: uploads are re-encoded and thumbnailed by the task worker.
+# Until then they wait in PHOTO_UPLOAD_ROOT, which must not be served
+PHOTO_UPLOAD_ROOT = BASE_DIR / 'uploads'
+PHOTO_SIZES = (80, 160, 320)
+PHOTO_MAX_DIMENSION = 1024
+PHOTO_MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+PHOTO_MAX_PIXELS = 40_000_000
+
+# Channels: CHANNEL_LAYER_REDIS_URLS (comma-separated, defaults to REDIS_URL)
+# shards groups and sockets across several Redis instances. Past a queue's
+# capacity, or the capacity of the group prefix a group_send goes to,
+# messages are dropped. In memory every socket has its own queue; with Redis
+# all sockets of a worker share one, so those limits are per worker process
+# and presence, then notifications, are shed first when a worker falls behind
+CHANNEL_LAYER_REDIS_URLS = [
+    url for url in os.environ.get('CHANNEL_LAYER_REDIS_URLS', os.environ.get('REDIS_URL', '')).split(',') if url
+]
+CHANNEL_LAYER_EXPIRY_SECONDS = int(os.environ.get('CHANNEL_LAYER_EXPIRY_SECONDS', 60))
+CHANNEL_LAYER_MEMORY_CONFIG = {
+    'capacity': 100,
+    'expiry': CHANNEL_LAYER_EXPIRY_SECONDS,
+    'group_capacity': {'video_call_': 200, 'chat_': 100, 'user_': 50, 'presence_': 20},
+}
+CHANNEL_LAYER_REDIS_CONFIG = {
+    'capacity': int(os.environ.get('CHANNEL_LAYER_CAPACITY', 5000)),
+    'expiry': CHANNEL_LAYER_EXPIRY_SECONDS,
+    'group_capacity': {'video_call_': 5000, 'chat_': 2000, 'user_': 1000, 'presence_': 500},
+    # Lowers the channels_redis logger to INFO to count group_send drops
+    # (see layers.py); nothing extra is logged
+    'count_group_drops': os.environ.get('CHANNEL_LAYER_COUNT_DROPS', 'True') == 'True',
+}
+if CHANNEL_LAYER_REDIS_URLS:
     CHANNEL_LAYERS = {
         'default': {
-            'BACKEND': 'channels_redis.core.RedisChannelLayer',
-            'CONFIG': {
-                'hosts': [os.environ.get('REDIS_URL')],
-            },
+            'BACKEND': 'skilloryx.layers.RedisChannelLayer',
+            'CONFIG': {**CHANNEL_LAYER_REDIS_CONFIG, 'hosts': CHANNEL_LAYER_REDIS_URLS},
         },
     }
 else:
     CHANNEL_LAYERS = {
         'default': {
-            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+            'BACKEND': 'skilloryx.layers.InMemoryChannelLayer',
+            'CONFIG': CHANNEL_LAYER_MEMORY_CONFIG,
+        }
+    }
+
+# Query instrumentation: X-Query-Count header and N+1 warnings
+QUERY_COUNT = os.environ.get('QUERY_COUNT', str(DEBUG)) == 'True'
+QUERY_REPEAT_THRESHOLD = 5
+
+# Request metrics, served in Prometheus format at /metrics/ to staff or to
+# requests with "Authorization: Bearer $METRICS_TOKEN"
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True') == 'True'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Fraction of requests run under cProfile; the slowest are kept in PROFILE_DIR
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_KEEP = 20
+PROFILE_DIR = os.environ.get('PROFILE_DIR', BASE_DIR / 'profiles')
+
+# Cache (shares REDIS_URL with the channel layer)
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+            'KEY_PREFIX': 'skilloryx',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         }
     }
+CACHE_PAGE_SECONDS = int(os.environ.get('CACHE_PAGE_SECONDS', 300))
+CACHE_FRAGMENT_SECONDS = int(os.environ.get('CACHE_FRAGMENT_SECONDS', 600))
+# The enrolment QR code embeds the TOTP secret, so it is only cached for
+# about as long as someone takes to scan it
+OTP_QR_CACHE_SECONDS = 10 * 60
+
+# Match ranking: each term's weight, and the (mean, weight in reviews) prior
+# that a teacher's average rating is shrunk towards
+MATCH_WEIGHTS = {'reciprocity': 2, 'online': 1, 'location': 1, 'reputation': 1}
+MATCH_RATING_PRIOR = (3, 2)
+# Profiles geocoded within this distance of each other count as co-located
+MATCH_NEARBY_KM = float(os.environ.get('MATCH_NEARBY_KM', 25))
+
+# Presence: sockets heartbeat every PRESENCE_HEARTBEAT_SECONDS and count as
+# gone after PRESENCE_TTL_SECONDS without one. State lives in Redis when
+# REDIS_URL is set, otherwise in process memory
+PRESENCE_REDIS_URL = os.environ.get('REDIS_URL', '')
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', 60))
+PRESENCE_HEARTBEAT_SECONDS = int(os.environ.get('PRESENCE_HEARTBEAT_SECONDS', 25))
+PRESENCE_BATCH_SECONDS = float(os.environ.get('PRESENCE_BATCH_SECONDS', 1))
+# Users one socket may watch at once
+PRESENCE_WATCH_LIMIT = 200
+
+# Production launcher (`python manage.py serve`): worker processes, the
+# server each one runs, open connections per worker (uvicorn only, 0 for no
+# limit) and how long workers get to finish on reload or shutdown. More than
+# one worker needs REDIS_URL so sockets on different workers share groups.
+# Not WEB_CONCURRENCY, which buildpacks set on their own
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', 1))
+ASGI_SERVER = os.environ.get('ASGI_SERVER', 'daphne')
+ASGI_LIMIT_CONCURRENCY = int(os.environ.get('ASGI_LIMIT_CONCURRENCY', 0))
+ASGI_GRACEFUL_SECONDS = int(os.environ.get('ASGI_GRACEFUL_SECONDS', 30))
+
+# Window over which a call peer's ICE candidates are coalesced into one relay
+VIDEO_CALL_ICE_BATCH_SECONDS = float(os.environ.get('VIDEO_CALL_ICE_BATCH_SECONDS', 0.05))
 
 # Email
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 DEFAULT_FROM_EMAIL = 'noreply@skilloryx.com'
+EMAIL_DIGEST_WINDOW_SECONDS = int(os.environ.get('EMAIL_DIGEST_WINDOW_SECONDS', 30 * 60))
+
+# Background tasks (run with `python manage.py run_tasks`)
+TASKS_EAGER = os.environ.get('TASKS_EAGER', 'False') == 'True'
+TASKS_MAX_ATTEMPTS = int(os.environ.get('TASKS_MAX_ATTEMPTS', 5))
+TASKS_BACKOFF_SECONDS = 10
+TASKS_BACKOFF_MAX_SECONDS = 60 * 60
+TASKS_LEASE_SECONDS = 10 * 60
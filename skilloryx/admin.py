@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Profile, Skill, Offer, Request, SwapProposal, Message, Review
+from .models import Profile, Skill, Offer, Request, SwapProposal, Message, Review, Match, Task, EmailNotification, ReadReceipt
 
 # Register your models here.
 admin.site.register(Profile)
@@ -9,3 +9,7 @@ admin.site.register(Request)
 admin.site.register(SwapProposal)
 admin.site.register(Message)
 admin.site.register(Review)
+admin.site.register(Match)
+admin.site.register(Task)
+admin.site.register(EmailNotification)
+admin.site.register(ReadReceipt)
@@ -7,4 +7,7 @@ class SkilloryxConfig(AppConfig):
 
     def ready(self):
         import skilloryx.signals
+        import skilloryx.notifications
+        import skilloryx.photos
+        import skilloryx.qr
 
@@ -0,0 +1,95 @@
+"""
+Page and fragment caching.
+
+Cached entries embed the current version number of every kind of content they
+were rendered from (`offers`, `requests`, `profiles`). Saving or deleting one
+of those models bumps its version in signals.py, so stale entries are never
+read again and simply expire; nothing has to know which keys to delete.
+"""
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+VERSION_PREFIX = 'version:'
+
+stats = Counter()
+
+
+def versions(*names):
+    """
+    Current version of each named kind of content, in one cache round trip.
+    """
+    keys = [VERSION_PREFIX + name for name in names]
+    found = cache.get_many(keys)
+    missing = {key: 1 for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return [found[key] for key in keys]
+
+
+def bump(name):
+    key = VERSION_PREFIX + name
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, None)
+
+
+def counters():
+    """
+    Hit/miss counts for this process, keyed by cache name.
+    """
+    names = {name for name, _ in stats}
+    return {
+        name: {'hits': stats[name, 'hit'], 'misses': stats[name, 'miss']}
+        for name in sorted(names)
+    }
+
+
+def record(name, hit):
+    stats[name, 'hit' if hit else 'miss'] += 1
+
+
+def cache_anonymous(*depends_on, timeout=None):
+    """
+    Cache a view's response for anonymous GET requests.
+
+    Signed-in users, pending flash messages and responses that issued a CSRF
+    token or cookies are never cached, since those pages are per-visitor.
+    """
+    def decorator(view):
+        name = view.__name__
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or request.user.is_authenticated or len(get_messages(request)):
+                return view(request, *args, **kwargs)
+
+            key = ':'.join(['page', name, request.get_full_path(), *map(str, versions(*depends_on))])
+            response = cache.get(key)
+            record(name, response is not None)
+            if response is not None:
+                return response
+
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.cookies and not request.META.get('CSRF_COOKIE_USED'):
+                cache.set(key, response, timeout or settings.CACHE_PAGE_SECONDS)
+            return response
+        return wrapper
+    return decorator
+
+
+def fragments(request):
+    """
+    Context processor for `{% cache fragment_seconds ... card_version %}` in
+    offer card templates; the version is only looked up if a template uses it.
+    """
+    return {
+        'fragment_seconds': settings.CACHE_FRAGMENT_SECONDS,
+        'card_version': SimpleLazyObject(lambda: '.'.join(map(str, versions('offers', 'profiles')))),
+    }
@@ -0,0 +1,39 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .pagination import encode_cursor
+
+
+def group_name(proposal_id):
+    return f'chat_{proposal_id}'
+
+
+def message_payload(message):
+    """
+    JSON shape shared by the HTTP endpoint and the chat socket.
+    """
+    return {
+        'id': message.id,
+        'sender__user__username': message.sender.user.username,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+        'cursor': encode_cursor(message),
+    }
+
+
+def chat_event(message):
+    return {
+        'type': 'chat_message',
+        'proposal_id': message.proposal_id,
+        'message': message_payload(message),
+    }
+
+
+def broadcast_message(message):
+    """
+    Push a newly saved message to everyone connected to its proposal.
+    """
+    async_to_sync(get_channel_layer().group_send)(
+        group_name(message.proposal_id),
+        chat_event(message)
+    )
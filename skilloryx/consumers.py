@@ -1,68 +1,317 @@
-import json
-from channels.generic.websocket import JsonWebsocketConsumer
-from asgiref.sync import async_to_sync
+import asyncio
+from collections import Counter
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django.db.models import Q
+from . import inbox, presence
+from .chat import chat_event, group_name
+from .forms import MessageForm
+from .models import Match, Profile, SwapProposal
 
 
-class VideoCallConsumer(JsonWebsocketConsumer):
-    def connect(self):
-        self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'video_call_{self.room_name}'
+class CallRoom:
+    """
+    One video-call room joined over a session socket. Peers learn each
+    other's channel on join so signalling goes straight to them, and ICE
+    candidates are coalesced into batches.
+    """
+    def __init__(self, consumer, room):
+        self.consumer = consumer
+        self.room = room
+        self.group = f'video_call_{room}'
+        self.peers = set()
+        self.pending_candidates = []
+        self.flush_task = None
 
-        # Join room group
-        async_to_sync(self.channel_layer.group_add)(
-            self.room_group_name,
-            self.channel_name
-        )
-
-        self.accept()
+    @property
+    def layer(self):
+        return self.consumer.channel_layer
 
-    def disconnect(self, close_code):
-        # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name,
-            self.channel_name
+    async def join(self):
+        # Peers already in the room reply directly so both sides know each
+        # other's channel
+        await self.layer.group_add(self.group, self.consumer.channel_name)
+        await self.layer.group_send(
+            self.group,
+            {'type': 'video_call_join', 'room': self.room, 'channel': self.consumer.channel_name}
         )
 
-    def receive_json(self, content):
-        # Broadcast message to room group
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'video_call_message',
-                'message': content,
-                'sender_channel_name': self.channel_name,
-            }
+    async def leave(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.layer.group_send(
+            self.group,
+            {'type': 'video_call_leave', 'room': self.room, 'channel': self.consumer.channel_name}
         )
+        await self.layer.group_discard(self.group, self.consumer.channel_name)
 
-    def video_call_message(self, event):
-        message = event['message']
-        sender_channel_name = event['sender_channel_name']
+    async def receive(self, message):
+        # ICE candidates arrive in bursts; coalesce them into one relay
+        if message.get('type') == 'ice-candidate':
+            self.pending_candidates.append(message.get('candidate'))
+            if self.flush_task is None:
+                self.flush_task = asyncio.ensure_future(self.flush_candidates_later())
+            return
+        await self.flush_candidates()
+        await self.relay(message)
 
-        # Send message to WebSocket (exclude sender)
-        if self.channel_name != sender_channel_name:
-            self.send_json(message)
+    async def flush_candidates_later(self):
+        await asyncio.sleep(settings.VIDEO_CALL_ICE_BATCH_SECONDS)
+        await self.flush_candidates()
+
+    async def flush_candidates(self):
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+        candidates, self.pending_candidates = self.pending_candidates, []
+        if candidates:
+            await self.relay({'type': 'ice-candidates', 'candidates': candidates})
+
+    async def relay(self, message):
+        event = {
+            'type': 'video_call_message',
+            'room': self.room,
+            'message': message,
+            'sender_channel_name': self.consumer.channel_name,
+        }
+        if not self.peers:
+            # Peer not known yet (handshake still in flight): use the group
+            await self.layer.group_send(self.group, event)
+            return
+        for peer in self.peers:
+            await self.layer.send(peer, event)
+
+    async def on_join(self, channel):
+        if channel != self.consumer.channel_name:
+            self.peers.add(channel)
+            await self.layer.send(
+                channel,
+                {'type': 'video_call_present', 'room': self.room, 'channel': self.consumer.channel_name}
+            )
 
 
-class NotificationConsumer(JsonWebsocketConsumer):
-    def connect(self):
-        self.username = self.scope['url_route']['kwargs']['username']
-        self.user_group_name = f'user_{self.username}'
+class SessionConsumer(AsyncJsonWebsocketConsumer):
+    """
+    The one socket a signed-in browser keeps open, at /ws/session/.
 
-        # Join user group
-        async_to_sync(self.channel_layer.group_add)(
+    Frames are {"stream": ..., "payload": {...}}. The "notifications"
+    stream is pushed to every session of the user. "chat" carries the
+    proposals the page subscribed to, "call" the signalling for the
+    video-call rooms it joined, and "presence" the online state of the users
+    it watches. The user comes from the session cookie, and anonymous
+    visitors are refused.
+    """
+    async def connect(self):
+        user = self.scope.get('user')
+        self.profile = None
+        self.chats = set()
+        self.calls = {}
+        self.watching = Counter()
+        if user is None or not user.is_authenticated:
+            self.user = None
+            await self.close()
+            return
+
+        self.user = user
+        self.user_group_name = f'user_{user.username}'
+        await self.channel_layer.group_add(
             self.user_group_name,
             self.channel_name
         )
 
-        self.accept()
+        await self.accept()
+        # Tells the client how often to send presence heartbeats
+        await self.send_json({'stream': 'session', 'payload': {'heartbeat': settings.PRESENCE_HEARTBEAT_SECONDS}})
+        if await presence.call('connect', self.user.pk, self.channel_name):
+            presence.batcher.add(self.user.pk)
 
-    def disconnect(self, close_code):
-        # Leave user group
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        if self.user is None:
+            return
+        if await presence.call('disconnect', self.user.pk, self.channel_name):
+            presence.batcher.add(self.user.pk)
+        await self.presence_groups('group_discard', self.watching)
+        for call in self.calls.values():
+            await call.leave()
+        for proposal_id in self.chats:
+            await self.channel_layer.group_discard(group_name(proposal_id), self.channel_name)
+        await self.channel_layer.group_discard(
             self.user_group_name,
             self.channel_name
         )
 
-    def user_notification(self, event):
+    async def receive_json(self, content):
+        stream = content.get('stream')
+        payload = content.get('payload')
+        if stream not in ('chat', 'call', 'presence') or not isinstance(payload, dict):
+            await self.send_json({'stream': 'session', 'payload': {'error': 'unknown stream'}})
+            return
+        await getattr(self, f'receive_{stream}')(payload)
+
+    # Notifications
+
+    async def user_notification(self, event):
+        await self.send_json({'stream': 'notifications', 'payload': event['message']})
+
+    # Chat
+
+    async def receive_chat(self, payload):
+        try:
+            proposal_id = int(payload.get('proposal'))
+        except (TypeError, ValueError):
+            return await self.chat_error(None, 'unknown proposal')
+        action = payload.get('action')
+
+        if action == 'subscribe':
+            # Only the two participants may join
+            if not await self.is_participant(proposal_id):
+                return await self.chat_error(proposal_id, 'not a participant')
+            await self.channel_layer.group_add(group_name(proposal_id), self.channel_name)
+            self.chats.add(proposal_id)
+        elif action == 'unsubscribe':
+            if proposal_id in self.chats:
+                self.chats.discard(proposal_id)
+                await self.channel_layer.group_discard(group_name(proposal_id), self.channel_name)
+        elif action == 'send':
+            if proposal_id not in self.chats:
+                return await self.chat_error(proposal_id, 'not subscribed')
+            form = MessageForm({'content': payload.get('content', '')})
+            if not form.is_valid():
+                return await self.chat_error(proposal_id, form.errors)
+            msg = await self.save_message(proposal_id, form)
+            await self.channel_layer.group_send(group_name(proposal_id), chat_event(msg))
+
+    async def chat_error(self, proposal_id, errors):
+        await self.send_json({'stream': 'chat', 'payload': {'proposal': proposal_id, 'errors': errors}})
+
+    async def chat_message(self, event):
+        proposal_id = event['proposal_id']
+        if proposal_id not in self.chats:
+            return
         message = event['message']
-        self.send_json(message)
+        await self.send_json({'stream': 'chat', 'payload': {'proposal': proposal_id, 'message': message}})
+        if message['sender__user__username'] != self.user.username:
+            # Delivered to an open chat, so it has been read
+            await self.mark_read(proposal_id, message['id'])
+
+    def load_profile(self):
+        if self.profile is None:
+            self.profile = Profile.objects.filter(user=self.user).select_related('user').first()
+        return self.profile
+
+    @database_sync_to_async
+    def is_participant(self, proposal_id):
+        self.load_profile()
+        return self.profile is not None and SwapProposal.objects.filter(
+            Q(proposer=self.profile) | Q(responder=self.profile), pk=proposal_id
+        ).exists()
+
+    @database_sync_to_async
+    def mark_read(self, proposal_id, message_id):
+        inbox.mark_read(proposal_id, self.profile, message_id)
+
+    @database_sync_to_async
+    def save_message(self, proposal_id, form):
+        msg = form.save(commit=False)
+        msg.proposal_id = proposal_id
+        msg.sender = self.profile
+        msg.save()
+        return msg
+
+    # Video calls
+
+    async def receive_call(self, payload):
+        room = str(payload.get('room', ''))[:100]
+        if not room:
+            return
+        action = payload.get('action')
+        call = self.calls.get(room)
+        if action == 'join' and call is None:
+            # Rooms are named after proposals, and only their two participants may join
+            if not room.isdigit() or not await self.is_participant(int(room)):
+                return await self.send_json({'stream': 'call', 'payload': {'room': room, 'error': 'not a participant'}})
+            call = self.calls[room] = CallRoom(self, room)
+            await call.join()
+            await self.send_json({'stream': 'call', 'payload': {'room': room, 'joined': True}})
+        elif action == 'leave' and call is not None:
+            del self.calls[room]
+            await call.leave()
+        elif action == 'signal' and call is not None and isinstance(payload.get('message'), dict):
+            await call.receive(payload['message'])
+
+    async def video_call_join(self, event):
+        call = self.calls.get(event['room'])
+        if call is not None:
+            await call.on_join(event['channel'])
+
+    async def video_call_present(self, event):
+        call = self.calls.get(event['room'])
+        if call is not None:
+            call.peers.add(event['channel'])
+
+    async def video_call_leave(self, event):
+        call = self.calls.get(event['room'])
+        if call is not None:
+            call.peers.discard(event['channel'])
+
+    async def video_call_message(self, event):
+        # Send message to WebSocket (exclude sender)
+        if event['room'] in self.calls and self.channel_name != event['sender_channel_name']:
+            await self.send_json({'stream': 'call', 'payload': {'room': event['room'], 'message': event['message']}})
+
+    # Presence
+
+    async def receive_presence(self, payload):
+        action = payload.get('action')
+        if action == 'heartbeat':
+            if await presence.call('heartbeat', self.user.pk, self.channel_name):
+                presence.batcher.add(self.user.pk)
+            await presence.batcher.sweep()
+            return
+
+        users = payload.get('users')
+        if not isinstance(users, list):
+            return
+        user_ids = {user_id for user_id in users[:settings.PRESENCE_WATCH_LIMIT] if isinstance(user_id, int)}
+        if action == 'watch':
+            # Only match partners, and no more than PRESENCE_WATCH_LIMIT users per socket
+            user_ids = await self.match_partners(user_ids)
+            free = max(settings.PRESENCE_WATCH_LIMIT - len(self.watching), 0)
+            user_ids = (user_ids & self.watching.keys()) | set(sorted(user_ids - self.watching.keys())[:free])
+            if not user_ids:
+                return
+            await self.presence_groups('group_add', user_ids - self.watching.keys())
+            self.watching.update(user_ids)
+            # Current state, in case it changed since the page was rendered
+            online = await presence.call('online', user_ids)
+            await self.send_json({'stream': 'presence', 'payload': {
+                'changes': {str(user_id): user_id in online for user_id in user_ids},
+            }})
+        elif action == 'unwatch':
+            watched = self.watching.keys() & user_ids
+            self.watching.subtract(watched)
+            self.watching = +self.watching
+            await self.presence_groups('group_discard', watched - self.watching.keys())
+
+    async def presence_groups(self, method, user_ids):
+        method = getattr(self.channel_layer, method)
+        await asyncio.gather(*(method(presence.group_name(user_id), self.channel_name) for user_id in user_ids))
+
+    @database_sync_to_async
+    def match_partners(self, user_ids):
+        self.load_profile()
+        if self.profile is None:
+            return set()
+        return set(
+            Match.objects.filter(profile=self.profile, partner__user_id__in=user_ids)
+            .values_list('partner__user_id', flat=True)
+        )
+
+    async def presence_changes(self, event):
+        changes = {
+            user_id: online for user_id, online in event['changes'].items()
+            if int(user_id) in self.watching
+        }
+        if changes:
+            await self.send_json({'stream': 'presence', 'payload': {'changes': changes}})
@@ -0,0 +1,84 @@
+"""
+Denormalized Profile counters.
+
+offer_count, request_count, completed_swap_count, rating_sum and
+rating_count are adjusted by the signal handlers in signals.py with single
+`UPDATE ... SET n = n + 1` statements, so concurrent changes can't lose
+increments. Writes that skip signals (QuerySet.update, raw SQL) can drift;
+reconcile() recounts everything and fixes the rows that differ.
+"""
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from . import caching
+from .models import Offer, Profile, Request, Review, SwapProposal
+
+FIELDS = ('offer_count', 'request_count', 'completed_swap_count', 'rating_sum', 'rating_count')
+
+
+def adjust(profile_ids, **deltas):
+    # Clamped at zero so a counter that has drifted low can't fail the
+    # positive-integer check; reconcile() puts it right
+    Profile.objects.filter(pk__in=profile_ids).update(
+        **{field: F(field) + delta if delta >= 0 else Greatest(F(field) + delta, 0) for field, delta in deltas.items()}
+    )
+    caching.bump('profiles')
+
+
+def reviewee_id(review):
+    proposer_id, responder_id = SwapProposal.objects.values_list('proposer_id', 'responder_id').get(pk=review.swap_id)
+    return responder_id if review.reviewer_id == proposer_id else proposer_id
+
+
+def _count(queryset, aggregate=None):
+    aggregate = aggregate or Count('pk')
+    return Coalesce(
+        Subquery(queryset.annotate(_group=Value(1)).values('_group').annotate(n=aggregate).values('n')[:1]),
+        0,
+        output_field=IntegerField(),
+    )
+
+
+def expected():
+    """
+    Profiles annotated with freshly counted `expected_<field>` values.
+    """
+    profile = OuterRef('pk')
+    completed = SwapProposal.objects.filter(status='completed')
+    received = Review.objects.filter(
+        (Q(swap__proposer=profile) | Q(swap__responder=profile)) & ~Q(reviewer=profile)
+    )
+    return Profile.objects.annotate(
+        expected_offer_count=_count(Offer.objects.filter(profile=profile)),
+        expected_request_count=_count(Request.objects.filter(profile=profile)),
+        expected_completed_swap_count=_count(completed.filter(Q(proposer=profile) | Q(responder=profile))),
+        expected_rating_sum=_count(received, Sum('rating')),
+        expected_rating_count=_count(received),
+    )
+
+
+def reconcile(batch_size=1000):
+    """
+    Recount every profile and save the ones that drifted; returns how many.
+    """
+    stale = []
+    fixed = 0
+    for profile in expected().only(*FIELDS).iterator(chunk_size=batch_size):
+        changed = False
+        for field in FIELDS:
+            value = getattr(profile, f'expected_{field}')
+            if getattr(profile, field) != value:
+                setattr(profile, field, value)
+                changed = True
+        if changed:
+            stale.append(profile)
+        if len(stale) >= batch_size:
+            fixed += len(stale)
+            Profile.objects.bulk_update(stale, FIELDS)
+            stale = []
+    if stale:
+        fixed += len(stale)
+        Profile.objects.bulk_update(stale, FIELDS)
+    if fixed:
+        caching.bump('profiles')
+    return fixed
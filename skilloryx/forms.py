@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 from .models import Offer, Request, SwapProposal, Message, Skill, Profile
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
@@ -98,15 +99,35 @@ class OTPTokenForm(forms.Form):
     token = forms.CharField(max_length=6, label='Enter 6-digit code from your authenticator app')
 
 class ProfileForm(forms.ModelForm):
+    # Not saved by the form: the view hands it to photos.accept_upload()
+    photo = forms.ImageField(required=False, widget=forms.FileInput(attrs={'class': 'form-control'}))
+
     class Meta:
         model = Profile
-        fields = ['bio', 'location', 'photo']
+        fields = ['bio', 'location', 'email_delivery']
+        labels = {
+            'email_delivery': 'Email notifications',
+        }
         widgets = {
             'bio': forms.Textarea(attrs={'rows': 4}),
             'location': forms.TextInput(attrs={'class': 'form-control'}),
-            'photo': forms.FileInput(attrs={'class': 'form-control'}),
+            'email_delivery': forms.Select(attrs={'class': 'form-select'}),
         }
 
+    def clean_photo(self):
+        photo = self.cleaned_data.get('photo')
+        # ImageField has already checked it is an image Pillow can open
+        image = getattr(photo, 'image', None)
+        if image is None:
+            return photo
+        if photo.size > settings.PHOTO_MAX_UPLOAD_BYTES:
+            raise forms.ValidationError(f'Photos must be under {settings.PHOTO_MAX_UPLOAD_BYTES // (1024 * 1024)} MB.')
+        if image.format not in ('JPEG', 'PNG', 'WEBP', 'GIF'):
+            raise forms.ValidationError('Upload a JPEG, PNG, WebP or GIF image.')
+        if image.width * image.height > settings.PHOTO_MAX_PIXELS:
+            raise forms.ValidationError('This image is too large.')
+        return photo
+
 class SignUpForm(UserCreationForm):
     email = forms.EmailField(required = True)
     class Meta:
@@ -0,0 +1,187 @@
+"""
+Offline geocoding and geohash proximity.
+
+Free-text locations are normalized and looked up in the bundled gazetteer
+(data/gazetteer.csv: city names and common aliases), so "Dhaka",
+"dhaka, Bangladesh" and "Dacca" all resolve to the same point. No network
+calls are made; unknown places simply have no coordinates.
+
+Profiles store a geohash of their point. Points in the same geohash cell
+share its prefix, so "within N km" becomes a handful of indexed string
+range scans over the cells around the centre, instead of computing a
+distance for every row.
+"""
+import csv
+import math
+import re
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Q
+
+GAZETTEER = Path(__file__).resolve().parent / 'data' / 'gazetteer.csv'
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+PRECISION = 9
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+SUFFIXES = ('city', 'district', 'division', 'sadar', 'town')
+
+
+@dataclass(frozen=True)
+class Place:
+    name: str
+    country: str
+    latitude: float
+    longitude: float
+
+
+@lru_cache(maxsize=65536)
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode().lower()
+    text = re.sub(r"[^a-z0-9, ]+", '', text)
+    return ' '.join(text.split())
+
+
+@lru_cache(maxsize=1)
+def gazetteer():
+    places = {}
+    with open(GAZETTEER, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            place = Place(row['name'], row['country'], float(row['latitude']), float(row['longitude']))
+            for name in [row['name'], *filter(None, row['aliases'].split('|'))]:
+                places.setdefault(normalize(name), place)
+    return places
+
+
+def geocode(text):
+    """
+    The gazetteer place a free-text location refers to, or None. Tries the
+    whole string, then each comma-separated part ("Mirpur, Dhaka").
+    """
+    places = gazetteer()
+    text = normalize(text or '')
+    for candidate in [text.replace(',', ' '), *text.split(',')]:
+        candidate = ' '.join(candidate.split())
+        for suffix in SUFFIXES:
+            candidate = candidate.removesuffix(f' {suffix}')
+        if candidate in places:
+            return places[candidate]
+    return None
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+@lru_cache(maxsize=4096)
+def decode(geohash):
+    """
+    Centre (latitude, longitude) of a geohash cell.
+    """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            interval = lon_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if value >> shift & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def distance_km(a, b):
+    (lat1, lon1), (lat2, lon2) = a, b
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    h = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
+def is_near(geohash, other_geohash, km=None):
+    if not geohash or not other_geohash:
+        return False
+    if geohash == other_geohash:
+        return True
+    return _within(geohash, other_geohash, km or settings.MATCH_NEARBY_KM)
+
+
+def same_place(geohash, location, other_geohash, other_location, km=None):
+    """
+    Whether two profiles count as co-located: by distance when both were
+    geocoded, otherwise by their normalized location text, so places the
+    gazetteer doesn't know still match themselves.
+    """
+    if geohash and other_geohash:
+        return is_near(geohash, other_geohash, km)
+    location = normalize(location)
+    return bool(location) and location == normalize(other_location)
+
+
+@lru_cache(maxsize=65536)
+def _within(geohash, other_geohash, km):
+    # Profiles share a few thousand places, so ranking mostly hits the cache
+    return distance_km(decode(geohash), decode(other_geohash)) <= km
+
+
+def covering_cells(latitude, longitude, km):
+    """
+    Geohash prefixes whose cells cover every point within `km`: the cell
+    holding the centre and its eight neighbours, at the finest precision
+    whose cells are still at least `km` across.
+    """
+    shrink = max(math.cos(math.radians(latitude)), 0.01)
+    for precision in range(PRECISION, 0, -1):
+        lat_step = 180 / 2 ** ((5 * precision) // 2)
+        lon_step = 360 / 2 ** ((5 * precision + 1) // 2)
+        if min(lat_step, lon_step * shrink) * KM_PER_DEGREE >= km:
+            break
+    cells = set()
+    for dlat in (-lat_step, 0, lat_step):
+        for dlon in (-lon_step, 0, lon_step):
+            lat = max(-90.0, min(90.0, latitude + dlat))
+            lon = (longitude + dlon + 180) % 360 - 180
+            cells.add(encode(lat, lon, precision))
+    return sorted(cells)
+
+
+def near(queryset, latitude, longitude, km, field='geohash'):
+    """
+    Filter `queryset` to rows whose `field` geohash lies in the cells around
+    the point, each an indexed range scan, then to the bounding box.
+    """
+    cells = Q()
+    for cell in covering_cells(latitude, longitude, km):
+        cells |= Q(**{f'{field}__gte': cell, f'{field}__lt': cell + '~'})
+    lat_delta = km / KM_PER_DEGREE
+    lon_delta = lat_delta / max(math.cos(math.radians(latitude)), 0.01)
+    prefix = field.rpartition('__')[0]
+    prefix = f'{prefix}__' if prefix else ''
+    return queryset.filter(cells).filter(**{
+        f'{prefix}latitude__range': (latitude - lat_delta, latitude + lat_delta),
+        f'{prefix}longitude__range': (longitude - lon_delta, longitude + lon_delta),
+    })
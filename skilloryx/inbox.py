@@ -0,0 +1,67 @@
+"""
+The proposal inbox.
+
+A page of proposals is one query: the participants, their users and both
+offers' skills are joined in, and each row is annotated with its unread
+count from the viewer's ReadReceipt, so nothing is loaded per row.
+"""
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Message, ReadReceipt, SwapProposal
+from .pagination import keyset_page
+
+STATUSES = dict(SwapProposal._meta.get_field('status').choices)
+
+
+def unread_count(profile):
+    """
+    Messages from the other participant after `profile`'s read receipt,
+    as an annotation on SwapProposal.
+    """
+    last_read = ReadReceipt.objects.filter(proposal=OuterRef(OuterRef('pk')), profile=profile)
+    unread = (
+        Message.objects.filter(proposal=OuterRef('pk'))
+        .exclude(sender=profile)
+        .filter(id__gt=Coalesce(Subquery(last_read.values('last_read_message_id')[:1]), 0))
+        .order_by()
+        .annotate(_group=Value(1))
+        .values('_group')
+        .annotate(n=Count('pk'))
+        .values('n')
+    )
+    return Coalesce(Subquery(unread[:1]), 0, output_field=IntegerField())
+
+
+def proposals(profile, status=None):
+    queryset = (
+        SwapProposal.objects.filter(Q(proposer=profile) | Q(responder=profile))
+        .select_related(
+            'proposer__user', 'responder__user', 'offer_from_proposer__skill', 'offer_from_responder__skill'
+        )
+        .annotate(unread=unread_count(profile))
+        .order_by('-created_at', '-id')
+    )
+    if status:
+        queryset = queryset.filter(status=status)
+    return queryset
+
+
+def page(profile, status=None, cursor=None, page_size=None):
+    return keyset_page(proposals(profile, status), cursor, page_size)
+
+
+def mark_read(proposal_id, profile, message_id):
+    """
+    Move `profile`'s read receipt for a proposal up to `message_id`.
+    Receipts never move backwards.
+    """
+    advanced = ReadReceipt.objects.filter(
+        proposal_id=proposal_id, profile=profile, last_read_message_id__lt=message_id
+    ).update(last_read_message_id=message_id, read_at=timezone.now())
+    if not advanced:
+        ReadReceipt.objects.bulk_create(
+            [ReadReceipt(proposal_id=proposal_id, profile=profile, last_read_message_id=message_id)],
+            ignore_conflicts=True,
+        )
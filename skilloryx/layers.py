@@ -0,0 +1,142 @@
+"""
+Channel layers with per-group capacity and metrics.
+
+Both are the stock channels layers plus:
+
+* `group_capacity`, e.g. {"video_call_": 200, "user_": 50}: while a
+  group_send to a group with that prefix is delivered, a member's queue
+  counts as full at that many messages. In memory every channel has its own
+  queue, so a flooded call room drops its own signalling instead of filling
+  a socket's queue for chat and notifications too. channels_redis keeps a
+  single queue for all the sockets of a process, so with Redis `capacity`
+  and `group_capacity` limit a worker's whole backlog, and the kinds with
+  the smaller limits are shed first when it falls behind.
+* Send and group_send time and dropped messages per group kind, and the
+  number of messages waiting for this process, served at /metrics/.
+  channels_redis only reports group_send drops in an INFO log line, so
+  with `count_group_drops` (the default) its logger is lowered to INFO and
+  a filter counts that line and swallows it again unless the previous
+  level would have let it through.
+
+RedisChannelLayer shards over every URL in `hosts`: a group lives on the
+host its name hashes to, and a process's sockets on the host its channel
+prefix hashes to. channels_redis hashes a process channel by its full name
+when sending to it but by its prefix when receiving, so with more than one
+host direct sends can land where nobody reads; `consistent_hash` uses the
+prefix for both.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer as BaseInMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer as BaseRedisChannelLayer
+
+from . import metrics
+
+# Set while the current task delivers a group_send
+delivering = contextvars.ContextVar('delivering', default=None)
+
+
+class GroupSendDrops(logging.Filter):
+    # Records below `level`, the logger's level before it was lowered, were
+    # only let through to be counted
+    level = logging.NOTSET
+
+    def filter(self, record):
+        if record.msg.startswith('%s of %s channels over capacity in group'):
+            kind, _ = delivering.get() or ('other', None)
+            metrics.layer_dropped.inc(kind, record.args[0])
+        return record.levelno >= self.level
+
+
+group_send_drops = GroupSendDrops()
+
+
+def count_group_send_drops():
+    logger = logging.getLogger('channels_redis.core')
+    if group_send_drops in logger.filters:
+        return
+    group_send_drops.level = logger.getEffectiveLevel()
+    logger.setLevel(min(group_send_drops.level, logging.INFO))
+    logger.addFilter(group_send_drops)
+
+
+class MeasuredLayer:
+    def __init__(self, *args, group_capacity=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Longest prefix first, so the most specific one wins
+        self.group_capacity = sorted((group_capacity or {}).items(), key=lambda item: -len(item[0]))
+
+    def group_kind(self, group):
+        """
+        (kind, capacity) for a group name: "video_call_42" -> ("video_call", 200).
+        """
+        for prefix, capacity in self.group_capacity:
+            if group.startswith(prefix):
+                return prefix.rstrip('_.-'), capacity
+        return 'other', None
+
+    def get_capacity(self, channel):
+        _, capacity = delivering.get() or (None, None)
+        return capacity or super().get_capacity(channel)
+
+    async def send(self, channel, message):
+        kind = delivering.get()
+        start = time.perf_counter()
+        try:
+            await super().send(channel, message)
+        except ChannelFull:
+            metrics.layer_dropped.inc(kind[0] if kind else 'direct')
+            raise
+        finally:
+            if kind is None:
+                metrics.layer_send_seconds.observe('direct', time.perf_counter() - start)
+
+    async def group_send(self, group, message):
+        kind = self.group_kind(group)
+        token = delivering.set(kind)
+        start = time.perf_counter()
+        try:
+            await super().group_send(group, message)
+        finally:
+            delivering.reset(token)
+            metrics.layer_send_seconds.observe(kind[0], time.perf_counter() - start)
+
+
+class CapacityInMemoryChannelLayer(BaseInMemoryChannelLayer):
+    async def send(self, channel, message):
+        # The stock layer ignores get_capacity() and always uses `capacity`
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        await queue.put((time.time() + self.expiry, deepcopy(message)))
+
+
+class InMemoryChannelLayer(MeasuredLayer, CapacityInMemoryChannelLayer):
+    async def queue_depth(self):
+        return sum(queue.qsize() for queue in self.channels.values())
+
+
+class RedisChannelLayer(MeasuredLayer, BaseRedisChannelLayer):
+    def __init__(self, *args, count_group_drops=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        if count_group_drops:
+            count_group_send_drops()
+
+    def consistent_hash(self, value):
+        if '!' in value:
+            value = self.non_local_name(value)
+        return super().consistent_hash(value)
+
+    async def queue_depth(self):
+        channel = f'specific.{self.client_prefix}!'
+        connection = self.connection(self.consistent_hash(channel))
+        waiting = await connection.zcount(self.prefix + channel, '-inf', '+inf')
+        return waiting + sum(queue.qsize() for queue in self.receive_buffer.values())
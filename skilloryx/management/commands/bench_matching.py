@@ -0,0 +1,151 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from skilloryx import geo
+from skilloryx.matching import rank, refresh_profile, skill_mask, skill_positions
+from skilloryx.models import Match, Offer, Profile, Request, Skill
+from skilloryx.queries import QueryRecorder
+
+
+def geohash(location):
+    place = geo.geocode(location)
+    return geo.encode(place.latitude, place.longitude) if place else ''
+
+
+def legacy_find_matches(profile_id, offers_by_skill, offered, requested, locations):
+    """
+    The per-candidate algorithm `find_matches` used: build sets for every
+    candidate profile, then test membership one skill at a time. Every
+    candidate also cost two relation queries, reported separately.
+    """
+    my_offers = set(offered[profile_id])
+    my_requests = set(requested[profile_id])
+    candidates = []
+    queries = 2
+    for skill_id in my_requests:
+        for offer_id, other_id, online in offers_by_skill.get(skill_id, ()):
+            if other_id == profile_id:
+                continue
+            other_requests = set(requested[other_id])
+            # Built but unused by the legacy scorer; kept so the timing matches it
+            other_offers = set(offered[other_id])  # noqa: F841
+            queries += 2
+            value = 0
+            if any(skill in my_offers for skill in other_requests):
+                value += 2
+            if online:
+                value += 1
+            if locations[profile_id] and locations[profile_id] == locations[other_id]:
+                value += 1
+            candidates.append((other_id, value, offer_id))
+    candidates.sort(key=lambda x: x[1], reverse=True)
+    return candidates, queries
+
+
+class Command(BaseCommand):
+    help = 'Compare the bitset match engine with the legacy per-candidate scoring on synthetic data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offers', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--skills', type=int, default=500)
+        parser.add_argument('--per-profile', type=int, default=4)
+        parser.add_argument('--samples', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--db-candidates', type=int, nargs='*', default=[10, 100, 1000],
+            help='Also refresh one profile against this many real offers and count its queries.',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'offers':>10} {'candidates':>11} {'legacy ms':>10} {'legacy queries':>15} {'engine ms':>10} {'speedup':>8}")
+        for total in options['offers']:
+            self.run(total, options)
+        if options['db_candidates']:
+            self.stdout.write(f"\n{'db candidates':>13} {'reads':>6} {'writes':>7} {'refresh ms':>11}")
+            for candidates in options['db_candidates']:
+                self.run_db(candidates, options)
+
+    def run(self, total, options):
+        rng = random.Random(options['seed'])
+        per_profile = options['per_profile']
+        profiles = max(total // per_profile, 2)
+        skills = range(1, options['skills'] + 1)
+        # Kuakata is not in the gazetteer and only matches on its name
+        cities = ['Dhaka', 'Gazipur', 'Chittagong', 'Sylhet', 'Kuakata', '']
+        geohashes = {name: geohash(name) for name in cities}
+        locations = [rng.choice(cities) for _ in range(profiles)]
+        ratings = [(0, 0) if rng.random() < 0.5 else (rng.randint(1, 5) * n, n) for n in (rng.randint(1, 20) for _ in range(profiles))]
+        offered = [rng.sample(skills, per_profile) for _ in range(profiles)]
+        requested = [rng.sample(skills, per_profile) for _ in range(profiles)]
+        offers_by_skill = {}
+        offer_id = 0
+        for profile_id, skill_ids in enumerate(offered):
+            for skill_id in skill_ids:
+                offer_id += 1
+                offers_by_skill.setdefault(skill_id, []).append((offer_id, profile_id, rng.random() < 0.5))
+        positions = skill_positions(skills)
+        requested_masks = [skill_mask(skill_ids, positions) for skill_ids in requested]
+        offered_masks = [skill_mask(skill_ids, positions) for skill_ids in offered]
+
+        samples = rng.sample(range(profiles), min(options['samples'], profiles))
+        legacy_time = engine_time = 0.0
+        legacy_queries = candidate_count = 0
+        for profile_id in samples:
+            start = time.perf_counter()
+            legacy, queries = legacy_find_matches(profile_id, offers_by_skill, offered, requested, locations)
+            legacy_time += time.perf_counter() - start
+            legacy_queries += queries
+            candidate_count += len(legacy)
+
+            start = time.perf_counter()
+            candidates = (
+                (offer_id, partner_id, online, geohashes[locations[partner_id]], locations[partner_id],
+                 requested_masks[partner_id], *ratings[partner_id])
+                for skill_id in requested[profile_id]
+                for offer_id, partner_id, online in offers_by_skill.get(skill_id, ())
+                if partner_id != profile_id
+            )
+            rank(offered_masks[profile_id], geohashes[locations[profile_id]], locations[profile_id], candidates, limit=6)
+            engine_time += time.perf_counter() - start
+
+        n = len(samples)
+        legacy_ms = legacy_time / n * 1000
+        engine_ms = engine_time / n * 1000
+        self.stdout.write(
+            f'{total:>10} {candidate_count // n:>11} {legacy_ms:>10.2f} {legacy_queries // n:>15} '
+            f'{engine_ms:>10.2f} {legacy_ms / engine_ms if engine_ms else 0:>7.1f}x'
+        )
+
+    def run_db(self, candidates, options):
+        """
+        Refresh one learner against `candidates` teachers inside a
+        transaction that is rolled back, counting the queries it takes.
+        Reads stay constant; writes grow only with bulk insert batches.
+        """
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            skill = Skill.objects.create(name=f'bench-{time.time_ns()}')
+            users = User.objects.bulk_create(
+                User(username=f'bench-{skill.pk}-{i}') for i in range(candidates + 1)
+            )
+            profiles = Profile.objects.bulk_create(
+                Profile(user=user, location=(location := rng.choice(['Dhaka', 'Sylhet', ''])), geohash=geohash(location),
+                        rating_count=(count := rng.randint(0, 10)), rating_sum=count * rng.randint(1, 5))
+                for user in users
+            )
+            learner, teachers = profiles[0], profiles[1:]
+            Request.objects.create(profile=learner, skill=skill)
+            Offer.objects.bulk_create(Offer(profile=teacher, skill=skill) for teacher in teachers)
+
+            start = time.perf_counter()
+            with QueryRecorder() as recorder:
+                refresh_profile(learner)
+            elapsed = (time.perf_counter() - start) * 1000
+            assert Match.objects.filter(profile=learner).count() == candidates
+            transaction.set_rollback(True)
+        reads = sum(sql.lstrip().upper().startswith('SELECT') for sql in recorder.queries)
+        self.stdout.write(f'{candidates:>13} {reads:>6} {recorder.count - reads:>7} {elapsed:>11.2f}')
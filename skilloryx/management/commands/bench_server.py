@@ -0,0 +1,251 @@
+import asyncio
+import base64
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+
+from skilloryx.management.commands.loadtest_signalling import call_rooms, percentile
+from skilloryx.server import SERVERS, shared_state_problems
+
+
+class Socket:
+    """
+    Just enough of a websocket client to exchange JSON text frames.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port, path, session_key):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nOrigin: http://{host}:{port}\r\n'
+            f'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n'
+            f'Cookie: {settings.SESSION_COOKIE_NAME}={session_key}\r\n\r\n'
+        ).encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        if not head.startswith(b'HTTP/1.1 101'):
+            writer.close()
+            raise ConnectionError(head.split(b'\r\n', 1)[0].decode())
+        return cls(reader, writer)
+
+    def send(self, data):
+        payload = json.dumps(data).encode()
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x81, 0x80 | length])
+        elif length < 1 << 16:
+            header = bytes([0x81, 0x80 | 126]) + length.to_bytes(2, 'big')
+        else:
+            header = bytes([0x81, 0x80 | 127]) + length.to_bytes(8, 'big')
+        mask = os.urandom(4)
+        self.writer.write(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+    async def receive(self):
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                length = int.from_bytes(await self.reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await self.reader.readexactly(8), 'big')
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 0x1:
+                return json.loads(payload)
+            if opcode == 0x8:
+                raise ConnectionError('closed by server')
+
+    def close(self):
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Start `serve` with each worker count and measure HTTP view and session-socket throughput against it. '
+        'The load is generated from this process, so compare runs rather than reading absolute numbers.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,2,4', help='Comma-separated worker counts to compare.')
+        parser.add_argument('--server', choices=SERVERS, default=settings.ASGI_SERVER)
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--path', default='/about/', help='HTTP view to request.')
+        parser.add_argument('--clients', type=int, default=32, help='Concurrent keep-alive HTTP clients.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds of HTTP load per run.')
+        parser.add_argument('--sockets', type=int, default=500, help='Session sockets opened per run.')
+        parser.add_argument('--messages', type=int, default=20, help='Call signals sent per socket pair.')
+        parser.add_argument('--timeout', type=float, default=60)
+
+    def handle(self, *args, **options):
+        counts = [int(count) for count in options['workers'].split(',')]
+        shared = not shared_state_problems()
+        if not shared and max(counts) > 1:
+            self.stdout.write(
+                'State is per process (no REDIS_URL), so call relays are only measured with one worker: '
+                'peers on different workers cannot reach each other.'
+            )
+
+        results = []
+        with call_rooms(options['sockets'] // 2, 'bench-server') as (users, rooms):
+            # One session per side of every call
+            sessions = []
+            for user in users:
+                session = SessionStore()
+                session[SESSION_KEY] = str(user.pk)
+                session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                session.create()
+                sessions.append(session)
+            keys = [session.session_key for session in sessions]
+            try:
+                for count in counts:
+                    self.stdout.write(f'{count} worker(s)...')
+                    with self.serving(count, options):
+                        views = self.http_load(options)
+                        sockets = asyncio.run(self.socket_load(options, keys, rooms, relay=shared or count == 1))
+                    results.append((count, views, sockets))
+            finally:
+                for session in sessions:
+                    session.delete()
+
+        self.stdout.write(
+            f'{"workers":>7}  {"http req/s":>10}  {"p50 ms":>7}  {"p99 ms":>7}  {"errors":>6}  '
+            f'{"sock conn/s":>11}  {"relay msg/s":>11}  {"relay p99 ms":>12}'
+        )
+        for count, views, sockets in results:
+            relay = sockets['relay']
+            self.stdout.write(
+                f'{count:>7}  {views["rate"]:>10.0f}  {views["p50"]:>7.2f}  {views["p99"]:>7.2f}  {views["errors"]:>6}  '
+                f'{sockets["connect_rate"]:>11.0f}  '
+                + (f'{relay["rate"]:>11.0f}  {relay["p99"]:>12.2f}' if relay else f'{"-":>11}  {"-":>12}')
+            )
+
+    def serving(self, workers, options):
+        command = self
+
+        class Serving:
+            def __enter__(self):
+                self.process = subprocess.Popen([
+                    sys.executable, '-m', 'django', 'serve', '--host', '127.0.0.1', '--port', str(options['port']),
+                    '--workers', str(workers), '--server', options['server'], '--allow-local-state',
+                ], stdout=subprocess.DEVNULL)
+                deadline = time.monotonic() + options['timeout']
+                while time.monotonic() < deadline:
+                    if self.process.poll() is not None:
+                        raise CommandError(f'serve exited with code {self.process.returncode}.')
+                    try:
+                        connection = http.client.HTTPConnection('127.0.0.1', options['port'], timeout=5)
+                        connection.request('GET', options['path'])
+                        if connection.getresponse().status < 500:
+                            return self
+                    except OSError:
+                        time.sleep(0.2)
+                self.__exit__()
+                raise CommandError(f'serve did not answer within {options["timeout"]}s.')
+
+            def __exit__(self, *exc_info):
+                self.process.terminate()
+                try:
+                    self.process.wait(options['timeout'])
+                except subprocess.TimeoutExpired:
+                    command.stderr.write('serve did not stop in time, killing it.')
+                    self.process.kill()
+                    self.process.wait()
+
+        return Serving()
+
+    def http_load(self, options):
+        deadline = time.perf_counter() + options['duration']
+        latencies = []
+        errors = []
+
+        def client():
+            connection = http.client.HTTPConnection('127.0.0.1', options['port'], timeout=options['timeout'])
+            mine, failed = [], 0
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    connection.request('GET', options['path'])
+                    response = connection.getresponse()
+                    response.read()
+                    ok = response.status < 400
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    ok = False
+                if ok:
+                    mine.append(time.perf_counter() - start)
+                else:
+                    failed += 1
+            latencies.extend(mine)
+            errors.append(failed)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(options['clients'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        ms = [latency * 1000 for latency in latencies] or [0]
+        return {
+            'rate': len(latencies) / elapsed,
+            'p50': percentile(ms, 50),
+            'p99': percentile(ms, 99),
+            'errors': sum(errors),
+        }
+
+    async def socket_load(self, options, sessions, rooms, relay):
+        timeout = options['timeout']
+
+        async def connect(session_key):
+            socket = await Socket.open('127.0.0.1', options['port'], '/ws/session/', session_key)
+            await asyncio.wait_for(socket.receive(), timeout)
+            return socket
+
+        start = time.perf_counter()
+        sockets = await asyncio.gather(*(connect(sessions[i % 2]) for i in range(options['sockets'])))
+        connect_rate = len(sockets) / (time.perf_counter() - start)
+        result = {'connect_rate': connect_rate, 'relay': None}
+
+        if relay:
+            latencies = []
+
+            async def join(socket, room):
+                socket.send({'stream': 'call', 'payload': {'action': 'join', 'room': room}})
+                await asyncio.wait_for(socket.receive(), timeout)
+
+            async def talk(sender, receiver, room):
+                for _ in range(options['messages']):
+                    sender.send({'stream': 'call', 'payload': {
+                        'action': 'signal', 'room': room, 'message': {'type': 'offer', 'sent': time.perf_counter()},
+                    }})
+                for _ in range(options['messages']):
+                    frame = await asyncio.wait_for(receiver.receive(), timeout)
+                    latencies.append(time.perf_counter() - frame['payload']['message']['sent'])
+
+            pairs = [(sockets[i], sockets[i + 1], rooms[i // 2]) for i in range(0, len(sockets) - 1, 2)]
+            for sender, receiver, room in pairs:
+                await join(sender, room)
+                await join(receiver, room)
+            start = time.perf_counter()
+            await asyncio.gather(*(talk(*pair) for pair in pairs))
+            elapsed = time.perf_counter() - start
+            ms = [latency * 1000 for latency in latencies]
+            result['relay'] = {'rate': len(ms) / elapsed, 'p99': percentile(ms, 99)}
+
+        for socket in sockets:
+            socket.close()
+        return result
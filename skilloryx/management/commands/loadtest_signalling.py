@@ -0,0 +1,121 @@
+import asyncio
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from skilloryx.models import Offer, Skill, SwapProposal
+from skilloryx.routing import websocket_urlpatterns
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+@contextmanager
+def call_rooms(count, prefix):
+    """
+    Two throwaway users and `count` proposals between them, yielded as
+    (users, room names); only a proposal's participants may join its room.
+    """
+    users = [User.objects.create_user(username=f'{prefix}-{side}') for side in range(2)]
+    skill, created = Skill.objects.get_or_create(name=prefix)
+    offers = [Offer.objects.create(profile=user.profile, skill=skill) for user in users]
+    proposals = SwapProposal.objects.bulk_create([
+        SwapProposal(
+            proposer=users[0].profile, responder=users[1].profile,
+            offer_from_proposer=offers[0], offer_from_responder=offers[1],
+        )
+        for _ in range(count)
+    ])
+    try:
+        yield users, [str(proposal.pk) for proposal in proposals]
+    finally:
+        for user in users:
+            user.delete()
+        if created:
+            skill.delete()
+
+
+class Command(BaseCommand):
+    help = 'Open many concurrent video-call signalling sockets in-process and report latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=5, help='ICE candidates sent by each peer.')
+        parser.add_argument('--timeout', type=float, default=60)
+
+    def handle(self, *args, **options):
+        layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        with override_settings(CHANNEL_LAYERS=layers):
+            with call_rooms(max(options['connections'] // 2, 1), 'loadtest') as (users, rooms):
+                async_to_sync(self.run)(options, users, rooms)
+
+    async def run(self, options, users, rooms):
+        application = URLRouter(websocket_urlpatterns)
+        timeout = options['timeout']
+        threads_before = threading.active_count()
+
+        peers = []
+        for room in rooms:
+            for user in users:
+                peer = WebsocketCommunicator(application, '/ws/session/')
+                peer.scope['user'] = user
+                peer.room = room
+                peers.append(peer)
+
+        async def join(peer):
+            await peer.connect(timeout)
+            await peer.receive_json_from(timeout)
+            await peer.send_json_to({'stream': 'call', 'payload': {'action': 'join', 'room': peer.room}})
+            await peer.receive_json_from(timeout)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(join(peer) for peer in peers))
+        connect_time = time.perf_counter() - start
+        threads_open = threading.active_count()
+
+        latencies = []
+        relays = []
+
+        async def talk(sender, receiver):
+            for _ in range(options['messages']):
+                await sender.send_json_to({'stream': 'call', 'payload': {
+                    'action': 'signal', 'room': sender.room,
+                    'message': {'type': 'ice-candidate', 'candidate': {'sent': time.perf_counter()}},
+                }})
+            received = 0
+            while received < options['messages']:
+                message = (await receiver.receive_json_from(timeout))['payload']['message']
+                now = time.perf_counter()
+                candidates = message.get('candidates') or [message.get('candidate')]
+                latencies.extend(now - candidate['sent'] for candidate in candidates)
+                received += len(candidates)
+                relays.append(1)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            talk(peers[i], peers[i + 1]) for i in range(0, len(peers), 2)
+        ))
+        exchange_time = time.perf_counter() - start
+        await asyncio.gather(*(peer.disconnect() for peer in peers))
+
+        ms = [latency * 1000 for latency in latencies]
+        self.stdout.write(f'connections        {len(peers)} on 1 worker process')
+        self.stdout.write(f'threads            {threads_before} before, {threads_open} with all sockets open')
+        self.stdout.write(f'connect            {connect_time:.2f}s ({len(peers) / connect_time:.0f} conn/s)')
+        self.stdout.write(f'messages           {len(ms)} in {exchange_time:.2f}s ({len(ms) / exchange_time:.0f} msg/s)')
+        self.stdout.write(f'layer relays       {len(relays)} ({len(ms) / len(relays):.1f} candidates per relay)')
+        self.stdout.write(
+            f'latency ms         p50 {percentile(ms, 50):.2f}  p90 {percentile(ms, 90):.2f}  '
+            f'p99 {percentile(ms, 99):.2f}  max {max(ms):.2f}  mean {statistics.mean(ms):.2f}'
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from skilloryx.models import Profile
+from skilloryx.photos import schedule
+
+
+class Command(BaseCommand):
+    help = 'Queue thumbnail generation for profile photos that have none (or all, with --all).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Reprocess photos that already have thumbnails.')
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.exclude(photo='').exclude(photo__isnull=True)
+        if not options['all']:
+            profiles = profiles.filter(photo_variants={})
+        total = 0
+        for profile in profiles.iterator():
+            schedule(profile)
+            total += 1
+        self.stdout.write(self.style.SUCCESS(f'Queued {total} photos; run_tasks will process them.'))
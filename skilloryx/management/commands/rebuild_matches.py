@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from skilloryx.matching import rebuild_all
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed match table from all offers and requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = rebuild_all(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {total} matches.'))
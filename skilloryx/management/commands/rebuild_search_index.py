@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from skilloryx import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for offers and requests.'
+
+    def handle(self, *args, **options):
+        search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt search index ({type(search.get_backend()).__name__}).'))
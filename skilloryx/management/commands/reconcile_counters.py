@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from skilloryx.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recount offers, requests, completed swaps and ratings for every profile and fix any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fixed = reconcile(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Reconciled counters; {fixed} profiles had drifted.'))
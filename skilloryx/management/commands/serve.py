@@ -0,0 +1,60 @@
+import importlib.util
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from skilloryx.server import SERVERS, Supervisor, bind, shared_state_problems
+
+
+class Command(BaseCommand):
+    help = 'Serve the ASGI application (HTTP and websockets) from several worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+        parser.add_argument('--workers', type=int, default=settings.ASGI_WORKERS)
+        parser.add_argument('--server', choices=SERVERS, default=settings.ASGI_SERVER)
+        parser.add_argument(
+            '--limit-concurrency', type=int, default=settings.ASGI_LIMIT_CONCURRENCY,
+            help='Open connections per worker before new ones get a 503 (uvicorn only, 0 for no limit).',
+        )
+        parser.add_argument('--backlog', type=int, default=2048)
+        parser.add_argument('--graceful-timeout', type=int, default=settings.ASGI_GRACEFUL_SECONDS)
+        parser.add_argument(
+            '--allow-local-state', action='store_true',
+            help='Run several workers even though websocket groups, cache or presence are per process.',
+        )
+        parser.add_argument('--check', action='store_true', help='Only check that state is shared, then exit.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+        if importlib.util.find_spec(options['server']) is None:
+            raise CommandError(f'{options["server"]} is not installed.')
+        if options['limit_concurrency'] and options['server'] != 'uvicorn':
+            raise CommandError('--limit-concurrency is only supported with --server uvicorn.')
+        if ':' in options['host'] and options['server'] == 'daphne':
+            raise CommandError('daphne workers can only share an IPv4 socket; use --server uvicorn for IPv6.')
+
+        if options['check'] or options['workers'] > 1:
+            problems = shared_state_problems()
+            for problem in problems:
+                self.stderr.write(f'- {problem}')
+            if options['check']:
+                if problems:
+                    raise CommandError('State is per process; set REDIS_URL to share it between workers.')
+                self.stdout.write('Channel layer, cache and presence are shared between workers.')
+                return
+            if problems and not options['allow_local_state']:
+                raise CommandError(
+                    f'Refusing to start {options["workers"]} workers with per-process state; set REDIS_URL, '
+                    'run one worker, or pass --allow-local-state.'
+                )
+
+        try:
+            sock = bind(options['host'], options['port'], options['backlog'])
+        except OSError as e:
+            raise CommandError(f'Cannot listen on {options["host"]}:{options["port"]}: {e}')
+        with sock:
+            Supervisor(sock, options, log=self.stdout.write).run()
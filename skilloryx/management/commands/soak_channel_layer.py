@@ -0,0 +1,132 @@
+import asyncio
+import random
+import time
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from skilloryx import metrics
+from skilloryx.layers import RedisChannelLayer
+from skilloryx.management.commands.loadtest_signalling import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive video_call_* and user_* groups through the channel layer and report delivery, drops, '
+        'group_send latency, queue depth and how groups spread over the Redis shards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=500, help='Call rooms, two peers each.')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--tabs', type=int, default=2, help='Sockets per user.')
+        parser.add_argument('--rate', type=int, default=2000, help='group_send calls per second.')
+        parser.add_argument('--duration', type=float, default=30)
+        parser.add_argument('--slow', type=float, default=0.0, help='Fraction of sockets that stop reading.')
+        parser.add_argument('--senders', type=int, default=32, help='Concurrent group_send loops.')
+        parser.add_argument(
+            '--hosts', default='',
+            help='Comma-separated Redis URLs to soak instead of the configured layer (use scratch instances).',
+        )
+
+    def handle(self, *args, **options):
+        if options['hosts']:
+            layer = RedisChannelLayer(**{**settings.CHANNEL_LAYER_REDIS_CONFIG, 'hosts': options['hosts'].split(',')})
+        else:
+            layer = get_channel_layer()
+        async_to_sync(self.run)(layer, options)
+
+    async def run(self, layer, options):
+        members = {}
+        for room in range(options['rooms']):
+            members[f'video_call_soak-{room}'] = [await layer.new_channel() for _ in range(2)]
+        for user in range(options['users']):
+            members[f'user_soak-{user}'] = [await layer.new_channel() for _ in range(options['tabs'])]
+        for group, channels in members.items():
+            for channel in channels:
+                await layer.group_add(group, channel)
+        groups = list(members)
+        channels = [channel for group_channels in members.values() for channel in group_channels]
+        slow = set(random.sample(channels, int(len(channels) * options['slow'])))
+
+        if isinstance(layer, RedisChannelLayer):
+            shards = Counter(layer.consistent_hash(group) for group in groups)
+            self.stdout.write(f'layer              {len(layer.hosts)} Redis host(s)')
+            for index, host in enumerate(layer.hosts):
+                self.stdout.write(f'  shard {index}          {shards[index]} groups  {host.get("address", host)}')
+        else:
+            self.stdout.write(f'layer              {type(layer).__name__}')
+        self.stdout.write(
+            f'groups             {options["rooms"]} video_call, {options["users"]} user '
+            f'({len(channels)} sockets, {len(slow)} not reading)'
+        )
+
+        dropped_before = dict(metrics.layer_dropped.series)
+        sent = Counter()
+        expected = Counter()
+        send_latency = {'video_call': [], 'user': []}
+        delivery_latency = []
+        depths = [0]
+        deadline = time.perf_counter() + options['duration']
+
+        async def read(channel):
+            while True:
+                message = await layer.receive(channel)
+                delivery_latency.append(time.perf_counter() - message['sent'])
+
+        async def send():
+            interval = options['senders'] / options['rate']
+            next_at = time.perf_counter()
+            while time.perf_counter() < deadline:
+                group = random.choice(groups)
+                kind = 'video_call' if group.startswith('video_call_') else 'user'
+                start = time.perf_counter()
+                await layer.group_send(group, {'type': 'soak', 'sent': start})
+                send_latency[kind].append(time.perf_counter() - start)
+                sent[kind] += 1
+                expected[kind] += len(members[group]) - len(slow.intersection(members[group]))
+                next_at += interval
+                await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+
+        async def sample_depth():
+            while time.perf_counter() < deadline:
+                depths.append(await layer.queue_depth())
+                await asyncio.sleep(0.5)
+
+        readers = [asyncio.ensure_future(read(channel)) for channel in channels if channel not in slow]
+        start = time.perf_counter()
+        await asyncio.gather(sample_depth(), *(send() for _ in range(options['senders'])))
+        elapsed = time.perf_counter() - start
+        # Let in-flight messages arrive
+        await asyncio.sleep(1)
+        for reader in readers:
+            reader.cancel()
+        for group, group_channels in members.items():
+            for channel in group_channels:
+                await layer.group_discard(group, channel)
+
+        dropped = {
+            kind: count - dropped_before.get(kind, 0) for kind, count in metrics.layer_dropped.series.items()
+        }
+        total = sum(sent.values())
+        self.stdout.write(f'group sends        {total} in {elapsed:.1f}s ({total / elapsed:.0f}/s)')
+        self.stdout.write(
+            f'deliveries         {len(delivery_latency)} of {sum(expected.values())} to reading sockets, '
+            f'dropped {", ".join(f"{kind} {count}" for kind, count in sorted(dropped.items()) if count) or "none"}'
+        )
+        for kind, latencies in send_latency.items():
+            if latencies:
+                ms = [latency * 1000 for latency in latencies]
+                self.stdout.write(
+                    f'{kind + " send ms":<19}p50 {percentile(ms, 50):.2f}  p99 {percentile(ms, 99):.2f}  '
+                    f'max {max(ms):.2f}'
+                )
+        if delivery_latency:
+            ms = [latency * 1000 for latency in delivery_latency]
+            self.stdout.write(
+                f'delivery ms        p50 {percentile(ms, 50):.2f}  p99 {percentile(ms, 99):.2f}  max {max(ms):.2f}'
+            )
+        self.stdout.write(f'queue depth        max {max(depths)} waiting for this process')
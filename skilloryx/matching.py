@@ -0,0 +1,224 @@
+import heapq
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from . import geo
+from .models import Match, Offer, Profile, Request
+
+
+def skill_positions(skill_ids):
+    """
+    Dense bit positions for the skills a scoring pass can match on, so masks
+    stay as wide as the number of those skills rather than the largest id.
+    """
+    return {skill_id: position for position, skill_id in enumerate(sorted(set(skill_ids)))}
+
+
+def skill_mask(skill_ids, positions):
+    """
+    Encode skill ids as an integer bitset, with bit positions[id] set for
+    each id; skills without a position can't match and are left out.
+    """
+    mask = 0
+    for skill_id in skill_ids:
+        if skill_id in positions:
+            mask |= 1 << positions[skill_id]
+    return mask
+
+
+def _masks(rows, positions):
+    masks = defaultdict(int)
+    for profile_id, skill_id in rows:
+        if skill_id in positions:
+            masks[profile_id] |= 1 << positions[skill_id]
+    return masks
+
+
+def reputation(rating_sum, rating_count):
+    """
+    The teacher's average rating, pulled towards MATCH_RATING_PRIOR so one
+    review can't dominate, as an offset in [-0.5, 0.5]. Unreviewed
+    teachers score 0.
+    """
+    prior_mean, prior_weight = settings.MATCH_RATING_PRIOR
+    average = (rating_sum + prior_mean * prior_weight) / (rating_count + prior_weight)
+    return (average - prior_mean) / 4
+
+
+def score(offered_mask, requested_mask, available_online, geohash, location, other_geohash, other_location,
+          rating_sum=0, rating_count=0):
+    """
+    Reciprocity is a single AND of the learner's offered skills against the
+    teacher's requested skills, however many skills either side has.
+    Location counts when both geohashes lie within MATCH_NEARBY_KM, or,
+    failing a geohash, when the location strings match (geo.same_place).
+    Reputation comes from the teacher's denormalized rating counters.
+    """
+    weights = settings.MATCH_WEIGHTS
+    return (
+        weights['reciprocity'] * bool(offered_mask & requested_mask)
+        + weights['online'] * bool(available_online)
+        + weights['location'] * geo.same_place(geohash, location, other_geohash, other_location)
+        + weights['reputation'] * reputation(rating_sum, rating_count)
+    )
+
+
+def rank(offered_mask, geohash, location, candidates, limit=None):
+    """
+    Score candidate offers for one learner in a single pass.
+
+    `candidates` yields (offer_id, partner_id, available_online,
+    partner_geohash, partner_location, partner_requested_mask,
+    partner_rating_sum, partner_rating_count) tuples. Returns (score, offer_id, partner_id)
+    tuples, best first; ties go to the newest offer (highest id).
+    """
+    scored = (
+        (score(offered_mask, requested_mask, online, geohash, location, other_geohash, other_location, rating_sum, rating_count),
+         offer_id, partner_id)
+        for offer_id, partner_id, online, other_geohash, other_location, requested_mask, rating_sum, rating_count in candidates
+    )
+    key = lambda row: (-row[0], -row[1])
+    if limit is None:
+        return sorted(scored, key=key)
+    return heapq.nsmallest(limit, scored, key=key)
+
+
+def score_profile(profile):
+    """
+    Match rows for every offer `profile` has asked to learn from.
+    """
+    offered_ids = list(profile.offers.values_list('skill_id', flat=True))
+    positions = skill_positions(offered_ids)
+    offered = skill_mask(offered_ids, positions)
+    offers = list(
+        Offer.objects.filter(skill_id__in=profile.requests.values('skill_id'))
+        .exclude(profile=profile)
+        .values_list('id', 'profile_id', 'available_online', 'profile__geohash', 'profile__location',
+                     'profile__rating_sum', 'profile__rating_count')
+    )
+    requested = _masks(Request.objects.filter(
+        profile_id__in={offer[1] for offer in offers},
+        skill_id__in=offered_ids,
+    ).values_list('profile_id', 'skill_id'), positions)
+    candidates = (
+        (offer_id, partner_id, online, other_geohash, other_location, requested[partner_id], rating_sum, rating_count)
+        for offer_id, partner_id, online, other_geohash, other_location, rating_sum, rating_count in offers
+    )
+    return [
+        Match(profile=profile, partner_id=partner_id, offer_id=offer_id, score=value)
+        for value, offer_id, partner_id in rank(offered, profile.geohash, profile.location, candidates)
+    ]
+
+
+def score_partner(partner):
+    """
+    Match rows for every other profile that asked to learn what `partner` offers.
+    """
+    offers = {offer.skill_id: offer for offer in partner.offers.all()}
+    requested_ids = list(partner.requests.values_list('skill_id', flat=True))
+    positions = skill_positions(requested_ids)
+    requested = skill_mask(requested_ids, positions)
+    requests = list(
+        Request.objects.filter(skill_id__in=list(offers))
+        .exclude(profile=partner)
+        .values_list('profile_id', 'skill_id', 'profile__geohash', 'profile__location')
+    )
+    offered = _masks(Offer.objects.filter(
+        profile_id__in={profile_id for profile_id, _, _, _ in requests},
+        skill_id__in=requested_ids,
+    ).values_list('profile_id', 'skill_id'), positions)
+    return [
+        Match(
+            profile_id=profile_id,
+            partner=partner,
+            offer=offers[skill_id],
+            score=score(
+                offered[profile_id], requested, offers[skill_id].available_online,
+                geohash, location, partner.geohash, partner.location,
+                partner.rating_sum, partner.rating_count,
+            ),
+        )
+        for profile_id, skill_id, geohash, location in requests
+    ]
+
+
+def refresh_profile(profile):
+    """
+    Recompute every match row that involves `profile`, on either side.
+    """
+    with transaction.atomic():
+        Match.objects.filter(profile=profile).delete()
+        Match.objects.bulk_create(score_profile(profile))
+        Match.objects.filter(partner=profile).delete()
+        Match.objects.bulk_create(score_partner(profile))
+
+
+def schedule_refresh(profile_id):
+    """
+    Refresh a profile's matches once the surrounding transaction commits.
+    The profile may be gone by then (cascading deletes), so it is re-fetched.
+    """
+    def run():
+        profile = Profile.objects.filter(pk=profile_id).first()
+        if profile is not None:
+            refresh_profile(profile)
+
+    transaction.on_commit(run)
+
+
+def rebuild_all(batch_size=1000):
+    """
+    Rebuild the whole match table from offers and requests in bulk.
+    """
+    places = {}
+    ratings = {}
+    for profile_id, geohash, location, rating_sum, rating_count in Profile.objects.values_list(
+            'id', 'geohash', 'location', 'rating_sum', 'rating_count'):
+        places[profile_id] = (geohash, location)
+        ratings[profile_id] = (rating_sum, rating_count)
+    request_rows = list(Request.objects.values_list('profile_id', 'skill_id'))
+    offer_rows = list(Offer.objects.values_list('id', 'profile_id', 'skill_id', 'available_online'))
+    # Only requested skills can make a match reciprocal
+    positions = skill_positions(skill_id for _, skill_id in request_rows)
+    offered = _masks(((profile_id, skill_id) for _, profile_id, skill_id, _ in offer_rows), positions)
+    requested = _masks(request_rows, positions)
+    requested_ids = defaultdict(list)
+    for profile_id, skill_id in request_rows:
+        requested_ids[profile_id].append(skill_id)
+    offers_by_skill = defaultdict(list)
+    for offer_id, profile_id, skill_id, online in offer_rows:
+        offers_by_skill[skill_id].append((offer_id, profile_id, online))
+
+    total = 0
+    with transaction.atomic():
+        Match.objects.all().delete()
+        batch = []
+        for profile_id, skill_ids in requested_ids.items():
+            candidates = (
+                (offer_id, partner_id, online, *places[partner_id], requested[partner_id], *ratings[partner_id])
+                for skill_id in skill_ids
+                for offer_id, partner_id, online in offers_by_skill.get(skill_id, ())
+                if partner_id != profile_id
+            )
+            for value, offer_id, partner_id in rank(offered.get(profile_id, 0), *places[profile_id], candidates):
+                batch.append(Match(profile_id=profile_id, partner_id=partner_id, offer_id=offer_id, score=value))
+            if len(batch) >= batch_size:
+                Match.objects.bulk_create(batch, batch_size=batch_size)
+                total += len(batch)
+                batch = []
+        Match.objects.bulk_create(batch, batch_size=batch_size)
+        total += len(batch)
+    return total
+
+
+def top_matches(profile, limit=6):
+    """
+    Best-scoring suggestions for `profile`, read straight from the match table.
+    """
+    return (
+        Match.objects.filter(profile=profile)
+        .select_related('partner__user', 'offer__skill')
+        .order_by('-score', '-offer')[:limit]
+    )
@@ -0,0 +1,222 @@
+"""
+Always-on request metrics and sampled profiling.
+
+`MetricsMiddleware` records wall time, DB time, query count, template render
+time and response size per view into in-process histograms, served in
+Prometheus text format by the `metrics` view. Each worker process keeps its
+own numbers, which is what Prometheus expects when it scrapes every process.
+The channel layer's send latency, drops and queue depth (see layers.py) are
+exported alongside.
+
+With `PROFILE_SAMPLE_RATE` above zero, that fraction of requests also runs
+under cProfile. The `PROFILE_KEEP` slowest of them are written to
+`PROFILE_DIR` as .prof files (open with `python -m pstats` or snakeviz).
+"""
+import bisect
+import contextvars
+import cProfile
+import heapq
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates as BaseDjangoTemplates
+
+from . import caching
+from .queries import QueryRecorder
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, label='view'):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self.lock:
+            counts, total = self.series.get(label, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[label] = (counts, total + value)
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((label, list(counts), total) for label, (counts, total) in self.series.items())
+        for label, counts, total in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label}"}} {total}')
+            lines.append(f'{self.name}_count{{{self.label}="{label}"}} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label, amount=1):
+        with self.lock:
+            self.series[label] = self.series.get(label, 0) + amount
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            series = sorted(self.series.items())
+        lines.extend(f'{self.name}{{{self.label}="{label}"}} {value}' for label, value in series)
+        return lines
+
+
+request_seconds = Histogram('skilloryx_request_seconds', 'Wall time per request.', SECONDS_BUCKETS)
+db_seconds = Histogram('skilloryx_db_seconds', 'Time spent in SQL per request.', SECONDS_BUCKETS)
+db_queries = Histogram('skilloryx_db_queries', 'SQL statements per request.', QUERY_BUCKETS)
+template_seconds = Histogram('skilloryx_template_seconds', 'Template render time per request.', SECONDS_BUCKETS)
+response_bytes = Histogram('skilloryx_response_bytes', 'Response body size.', BYTES_BUCKETS)
+
+# Filled in by the channel layers in layers.py, labelled by group kind
+# ("video_call", "user", ...) or "direct" for sends to a single channel
+layer_send_seconds = Histogram(
+    'skilloryx_channel_layer_send_seconds', 'Channel layer send and group_send time.', SECONDS_BUCKETS, label='group'
+)
+layer_dropped = Counter(
+    'skilloryx_channel_layer_dropped_total', 'Messages dropped because the channel was full.', label='group'
+)
+
+HISTOGRAMS = (request_seconds, db_seconds, db_queries, template_seconds, response_bytes, layer_send_seconds)
+
+# Template time of the request being handled, summed by TimedTemplate
+template_time = contextvars.ContextVar('template_time', default=None)
+
+
+def exposition():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.exposition())
+    lines.extend(layer_dropped.exposition())
+    layer = get_channel_layer()
+    if hasattr(layer, 'queue_depth'):
+        lines.append('# HELP skilloryx_channel_layer_queue_depth Messages waiting for this process\'s sockets.')
+        lines.append('# TYPE skilloryx_channel_layer_queue_depth gauge')
+        lines.append(f'skilloryx_channel_layer_queue_depth {async_to_sync(layer.queue_depth)()}')
+    for kind in ('hits', 'misses'):
+        lines.append(f'# TYPE skilloryx_cache_{kind}_total counter')
+        for name, counts in caching.counters().items():
+            lines.append(f'skilloryx_cache_{kind}_total{{cache="{name}"}} {counts[kind]}')
+    return '\n'.join(lines) + '\n'
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            elapsed = template_time.get()
+            if elapsed is not None:
+                elapsed[0] += time.perf_counter() - start
+
+
+class DjangoTemplates(BaseDjangoTemplates):
+    """
+    The stock Django template backend, timing each top-level render.
+    """
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class SlowestProfiles:
+    """
+    Keeps the slowest sampled profiles on disk, evicting faster ones.
+    """
+    def __init__(self):
+        self.kept = []
+        self.lock = threading.Lock()
+
+    def offer(self, duration, view, profiler):
+        with self.lock:
+            if len(self.kept) >= settings.PROFILE_KEEP and duration <= self.kept[0][0]:
+                return None
+            directory = Path(settings.PROFILE_DIR)
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f'{view}-{duration * 1000:.0f}ms-{os.getpid()}-{time.time_ns()}.prof'
+            profiler.dump_stats(path)
+            heapq.heappush(self.kept, (duration, str(path)))
+            if len(self.kept) > settings.PROFILE_KEEP:
+                _, evicted = heapq.heappop(self.kept)
+                Path(evicted).unlink(missing_ok=True)
+            return path
+
+
+slowest = SlowestProfiles()
+
+
+def start_profiler():
+    if settings.PROFILE_SAMPLE_RATE <= 0 or random.random() >= settings.PROFILE_SAMPLE_RATE:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already running on this thread
+        return None
+    return profiler
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        profiler = start_profiler()
+        token = template_time.set([0.0])
+        start = time.perf_counter()
+        try:
+            with QueryRecorder() as queries:
+                response = self.get_response(request)
+        finally:
+            wall = time.perf_counter() - start
+            rendering = template_time.get()[0]
+            template_time.reset(token)
+            if profiler:
+                profiler.disable()
+
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        request_seconds.observe(view, wall)
+        db_seconds.observe(view, queries.duration)
+        db_queries.observe(view, queries.count)
+        template_seconds.observe(view, rendering)
+        if not response.streaming:
+            response_bytes.observe(view, len(response.content))
+        if profiler:
+            slowest.offer(wall, view, profiler)
+        return response
@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0005_match"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="offer",
+            index=models.Index(fields=["-created_at", "-id"], name="offer_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="offer",
+            index=models.Index(
+                fields=["skill", "-created_at", "-id"], name="offer_skill_created_idx"
+            ),
+        ),
+    ]
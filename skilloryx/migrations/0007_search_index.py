@@ -0,0 +1,72 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+from django.db import migrations
+
+SQL = {
+    "sqlite": [
+        "CREATE VIRTUAL TABLE skilloryx_search USING fts5("
+        "kind UNINDEXED, object_id UNINDEXED, skill, body, "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE VIRTUAL TABLE skilloryx_search_vocab USING fts5vocab(skilloryx_search, 'row')",
+        "INSERT INTO skilloryx_search (rowid, kind, object_id, skill, body) "
+        "SELECT o.id * 2, 'offer', o.id, s.name, o.description "
+        "FROM skilloryx_offer o JOIN skilloryx_skill s ON s.id = o.skill_id",
+        "INSERT INTO skilloryx_search (rowid, kind, object_id, skill, body) "
+        "SELECT r.id * 2 + 1, 'request', r.id, s.name, r.details "
+        "FROM skilloryx_request r JOIN skilloryx_skill s ON s.id = r.skill_id",
+    ],
+    "postgresql": [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE TABLE skilloryx_search ("
+        "kind varchar(16) NOT NULL, object_id bigint NOT NULL, "
+        "skill text NOT NULL, body text NOT NULL, "
+        "document tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('simple', skill), 'A') || "
+        "setweight(to_tsvector('simple', body), 'B')"
+        ") STORED, PRIMARY KEY (kind, object_id))",
+        "CREATE INDEX skilloryx_search_document_idx ON skilloryx_search USING gin (document)",
+        "CREATE INDEX skilloryx_search_skill_trgm_idx ON skilloryx_search "
+        "USING gin (skill gin_trgm_ops)",
+        "INSERT INTO skilloryx_search (kind, object_id, skill, body) "
+        "SELECT 'offer', o.id, s.name, o.description "
+        "FROM skilloryx_offer o JOIN skilloryx_skill s ON s.id = o.skill_id",
+        "INSERT INTO skilloryx_search (kind, object_id, skill, body) "
+        "SELECT 'request', r.id, s.name, r.details "
+        "FROM skilloryx_request r JOIN skilloryx_skill s ON s.id = r.skill_id",
+    ],
+}
+
+DROP_SQL = {
+    "sqlite": [
+        "DROP TABLE IF EXISTS skilloryx_search_vocab",
+        "DROP TABLE IF EXISTS skilloryx_search",
+    ],
+    "postgresql": ["DROP TABLE IF EXISTS skilloryx_search"],
+}
+
+
+def create_search_table(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("PRAGMA compile_options")
+            if ("ENABLE_FTS5",) not in cursor.fetchall():
+                # No FTS5 in this SQLite build: search falls back to icontains.
+                return
+    for sql in SQL.get(vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_search_table(apps, schema_editor):
+    for sql in DROP_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0006_offer_keyset_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-18 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0007_search_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["proposal", "created_at", "id"],
+                name="message_proposal_created_idx",
+            ),
+        ),
+    ]
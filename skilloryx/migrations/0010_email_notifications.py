@@ -0,0 +1,70 @@
+# Generated by Django 6.0 on 2026-10-18 11:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0009_task"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="email_delivery",
+            field=models.CharField(
+                choices=[("instant", "Instant"), ("digest", "Digest")],
+                default="instant",
+                max_length=10,
+            ),
+        ),
+        migrations.CreateModel(
+            name="EmailNotification",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("subject", models.CharField(max_length=200)),
+                ("body", models.TextField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("pending", "Pending"), ("sent", "Sent")],
+                        default="pending",
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "deliver_after",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                ("sent_at", models.DateTimeField(blank=True, null=True)),
+                ("last_error", models.TextField(blank=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "profile",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="email_notifications",
+                        to="skilloryx.profile",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["status", "deliver_after"],
+                        name="email_status_deliver_idx",
+                    )
+                ],
+            },
+        ),
+    ]
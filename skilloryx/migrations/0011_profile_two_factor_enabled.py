@@ -0,0 +1,26 @@
+# Generated by Django 6.0 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    Profile = apps.get_model("skilloryx", "Profile")
+    TOTPDevice = apps.get_model("otp_totp", "TOTPDevice")
+    users = TOTPDevice.objects.filter(confirmed=True).values("user_id")
+    Profile.objects.filter(user_id__in=users).update(two_factor_enabled=True)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("otp_totp", "0003_add_timestamps"),
+        ("skilloryx", "0010_email_notifications"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="two_factor_enabled",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 6.0 on 2026-10-18 13:40
+
+import django.db.models.expressions
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def count(queryset, aggregate=None):
+    aggregate = aggregate or Count("pk")
+    return Coalesce(
+        Subquery(
+            queryset.annotate(_group=Value(1))
+            .values("_group")
+            .annotate(n=aggregate)
+            .values("n")[:1]
+        ),
+        0,
+        output_field=IntegerField(),
+    )
+
+
+def backfill(apps, schema_editor):
+    Profile = apps.get_model("skilloryx", "Profile")
+    Offer = apps.get_model("skilloryx", "Offer")
+    Request = apps.get_model("skilloryx", "Request")
+    SwapProposal = apps.get_model("skilloryx", "SwapProposal")
+    Review = apps.get_model("skilloryx", "Review")
+    profile = OuterRef("pk")
+    received = Review.objects.filter(
+        (Q(swap__proposer=profile) | Q(swap__responder=profile)) & ~Q(reviewer=profile)
+    )
+    Profile.objects.update(
+        offer_count=count(Offer.objects.filter(profile=profile)),
+        request_count=count(Request.objects.filter(profile=profile)),
+        completed_swap_count=count(
+            SwapProposal.objects.filter(
+                Q(proposer=profile) | Q(responder=profile), status="completed"
+            )
+        ),
+        rating_sum=count(received, Sum("rating")),
+        rating_count=count(received),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0012_profile_photo_variants"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="rating_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="rating_sum",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="completed_swap_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="offer_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="request_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="average_rating",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=models.Case(
+                    models.When(rating_count=0, then=None),
+                    default=models.ExpressionWrapper(
+                        django.db.models.expressions.CombinedExpression(
+                            django.db.models.expressions.CombinedExpression(
+                                models.F("rating_sum"), "*", models.Value(1.0)
+                            ),
+                            "/",
+                            models.F("rating_count"),
+                        ),
+                        output_field=models.FloatField(),
+                    ),
+                ),
+                output_field=models.FloatField(null=True),
+            ),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0013_profile_counters"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="match",
+            name="match_profile_score_idx",
+        ),
+        migrations.AlterField(
+            model_name="match",
+            name="score",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="match",
+            index=models.Index(
+                fields=["profile", "-score", "-offer"], name="match_profile_score_idx"
+            ),
+        ),
+    ]
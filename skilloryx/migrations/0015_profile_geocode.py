@@ -0,0 +1,45 @@
+# Generated by Django 6.0 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+from skilloryx import geo
+
+
+def backfill(apps, schema_editor):
+    Profile = apps.get_model("skilloryx", "Profile")
+    profiles = list(Profile.objects.exclude(location="").only("location"))
+    for profile in profiles:
+        place = geo.geocode(profile.location)
+        if place is not None:
+            profile.latitude, profile.longitude = place.latitude, place.longitude
+            profile.geohash = geo.encode(place.latitude, place.longitude)
+    Profile.objects.bulk_update(
+        profiles, ["latitude", "longitude", "geohash"], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0014_match_reputation"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="geohash",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=12
+            ),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="latitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="longitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 6.0 on 2026-10-18 15:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0015_profile_geocode"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReadReceipt",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_read_message_id", models.PositiveBigIntegerField(default=0)),
+                ("read_at", models.DateTimeField(auto_now=True)),
+                (
+                    "profile",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="read_receipts",
+                        to="skilloryx.profile",
+                    ),
+                ),
+                (
+                    "proposal",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="read_receipts",
+                        to="skilloryx.swapproposal",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("proposal", "profile")},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("skilloryx", "0017_email_claims"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="photo_pending",
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
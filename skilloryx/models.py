@@ -4,19 +4,99 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 from django_otp.plugins.otp_totp.models import TOTPDevice
 
+from . import geo
+
 class Profile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     bio = models.TextField(blank=True)
     location = models.CharField(max_length=100, blank=True)
+    # Geocoded from location on save (see geo.py); the geohash is indexed
+    # so nearby profiles can be found with range scans
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False)
     photo = models.ImageField(upload_to='profile_photos/', blank=True, null=True)
+    # Thumbnail paths by format and width, written by photos.process_profile_photo
+    photo_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Raw upload in PHOTO_UPLOAD_ROOT waiting for photos.publish_profile_photo
+    photo_pending = models.CharField(max_length=255, blank=True, editable=False)
+    email_delivery = models.CharField(max_length=10, choices=[
+        ('instant','Instant'),
+        ('digest','Digest')
+    ], default='instant')
+    # Kept in sync with the user's confirmed TOTP devices by signals.py
+    two_factor_enabled = models.BooleanField(default=False, editable=False)
+    # Denormalized counters, maintained by signals.py and reconcile_counters
+    offer_count = models.PositiveIntegerField(default=0, editable=False)
+    request_count = models.PositiveIntegerField(default=0, editable=False)
+    completed_swap_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    average_rating = models.GeneratedField(
+        expression=models.Case(
+            models.When(rating_count=0, then=None),
+            default=models.ExpressionWrapper(models.F('rating_sum') * 1.0 / models.F('rating_count'), output_field=models.FloatField()),
+        ),
+        output_field=models.FloatField(null=True),
+        db_persist=True,
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.user.username
 
+    # Only ever written with update() (see sync_2fa, photos.py and
+    # counters.py), so a full save from an instance loaded earlier must not
+    # write them back
+    MAINTAINED_FIELDS = {
+        'two_factor_enabled', 'photo', 'photo_variants', 'photo_pending',
+        'offer_count', 'request_count', 'completed_swap_count', 'rating_sum', 'rating_count',
+    }
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and not field.generated and field.name not in self.MAINTAINED_FIELDS
+            ]
+        if update_fields is None or 'location' in update_fields:
+            self.locate()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'latitude', 'longitude', 'geohash'}
+        super().save(*args, **kwargs)
+
+    def locate(self):
+        place = geo.geocode(self.location)
+        if place is None:
+            self.latitude = self.longitude = None
+            self.geohash = ''
+        else:
+            self.latitude, self.longitude = place.latitude, place.longitude
+            self.geohash = geo.encode(place.latitude, place.longitude)
+
+    @property
+    def photo_srcset(self):
+        return {
+            fmt: ', '.join(f'{self.photo.storage.url(name)} {size}w' for size, name in sorted(sizes.items(), key=lambda item: int(item[0])))
+            for fmt, sizes in self.photo_variants.items()
+        }
+
+    @property
+    def photo_thumbnail_url(self):
+        sizes = self.photo_variants.get('jpeg')
+        if sizes:
+            return self.photo.storage.url(sizes[min(sizes, key=int)])
+        return self.photo.url
+
     @property
     def is_2fa_enabled(self):
-        return TOTPDevice.objects.filter(user=self.user, confirmed=True).exists()
+        return self.two_factor_enabled
+
+    @classmethod
+    def sync_2fa(cls, user_id):
+        enabled = TOTPDevice.objects.filter(user_id=user_id, confirmed=True).exists()
+        cls.objects.filter(user_id=user_id).update(two_factor_enabled=enabled)
 
 class Skill(models.Model):
     name = models.CharField(max_length=80, unique=True)
@@ -40,6 +120,10 @@ class Offer(models.Model):
 
     class Meta:
         unique_together = ('profile','skill')
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='offer_created_idx'),
+            models.Index(fields=['skill', '-created_at', '-id'], name='offer_skill_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.profile.user.username} offers {self.skill.name}"
@@ -82,10 +166,91 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['proposal', 'created_at', 'id'], name='message_proposal_created_idx'),
+        ]
 
     def __str__(self):
         return f"Msg {self.id} by {self.sender}"
 
+class ReadReceipt(models.Model):
+    # How far into a proposal's chat a participant has read; messages with
+    # a higher id from the other side are unread
+    proposal = models.ForeignKey(SwapProposal, on_delete=models.CASCADE, related_name='read_receipts')
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='read_receipts')
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    read_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('proposal', 'profile')
+
+    def __str__(self):
+        return f"{self.profile} read {self.proposal} up to {self.last_read_message_id}"
+
+class Match(models.Model):
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='matches')
+    partner = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='+')
+    offer = models.ForeignKey(Offer, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('profile','offer')
+        indexes = [
+            models.Index(fields=['profile', '-score', '-offer'], name='match_profile_score_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.profile} -> {self.offer} ({self.score})"
+
+class Task(models.Model):
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=[
+        ('pending','Pending'),
+        ('running','Running'),
+        ('done','Done'),
+        ('failed','Failed')
+    ], default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='task_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"Task {self.id}: {self.name} ({self.status})"
+
+class EmailNotification(models.Model):
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='email_notifications')
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    status = models.CharField(max_length=20, choices=[
+        ('pending','Pending'),
+        ('sending','Sending'),
+        ('sent','Sent')
+    ], default='pending')
+    deliver_after = models.DateTimeField(default=timezone.now)
+    # When a delivery run claimed the row; claims older than the task lease
+    # belong to a dead runner and are taken over
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'deliver_after'], name='email_status_deliver_idx'),
+        ]
+
+    def __str__(self):
+        return f"Email to {self.profile} ({self.status}): {self.subject}"
+
 class Review(models.Model):
     swap = models.OneToOneField(SwapProposal, on_delete=models.CASCADE)
     reviewer = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='reviews_made')
@@ -0,0 +1,99 @@
+"""
+Email notifications with per-user instant or digest delivery.
+
+notify_by_email() records an EmailNotification and schedules delivery.
+Instant notifications are due straight away; digest notifications share a
+window per recipient (EMAIL_DIGEST_WINDOW_SECONDS) and go out as one
+email when it closes. Delivery sends everything due over one SMTP
+connection. Rows are claimed (status "sending") in a short transaction
+before anything is sent, so overlapping task runners never email the same
+notification twice and no transaction is open while SMTP is slow.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import EmailNotification, Task
+from .tasks import enqueue, task
+
+
+def notify_by_email(profile, subject, body):
+    now = timezone.now()
+    deliver_after = now
+    if profile.email_delivery == 'digest':
+        # Join the recipient's open digest window, or start a new one
+        open_window = (
+            EmailNotification.objects.filter(profile=profile, status='pending', deliver_after__gt=now)
+            .order_by('deliver_after').values_list('deliver_after', flat=True).first()
+        )
+        deliver_after = open_window or now + timedelta(seconds=settings.EMAIL_DIGEST_WINDOW_SECONDS)
+    notification = EmailNotification.objects.create(
+        profile=profile, subject=subject, body=body, deliver_after=deliver_after)
+    if not Task.objects.filter(name='deliver_email_notifications', status='pending', run_at=deliver_after).exists():
+        enqueue('deliver_email_notifications', run_at=deliver_after)
+    return notification
+
+
+def build_message(profile, notifications, connection):
+    if len(notifications) == 1:
+        subject, body = notifications[0].subject, notifications[0].body
+    else:
+        subject = f'Your SkillOryx activity ({len(notifications)} updates)'
+        body = '\n\n----------\n\n'.join(f'{n.subject}\n{n.body}' for n in notifications)
+    return EmailMessage(subject, body, None, [profile.user.email], connection=connection)
+
+
+def claim_due():
+    """
+    Mark due notifications as sending and return them. The claim commits
+    straight away, so no transaction or row lock is held while mail goes
+    out; claims older than TASKS_LEASE_SECONDS are taken over.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.TASKS_LEASE_SECONDS)
+    claimable = Q(status='pending', deliver_after__lte=now) | Q(status='sending', claimed_at__lt=stale)
+    with transaction.atomic():
+        ids = list(
+            EmailNotification.objects.select_for_update(skip_locked=True)
+            .filter(claimable).values_list('pk', flat=True)
+        )
+        # Re-checked in the UPDATE, so a runner that read the same rows first wins them
+        EmailNotification.objects.filter(claimable, pk__in=ids).update(status='sending', claimed_at=now)
+    return (
+        EmailNotification.objects.filter(status='sending', claimed_at=now)
+        .select_related('profile__user').order_by('created_at')
+    )
+
+
+@task
+def deliver_email_notifications():
+    """
+    Send every due notification, one email per recipient, over a single
+    connection. Failures go back to pending and the task is retried.
+    """
+    by_profile = defaultdict(list)
+    for notification in claim_due():
+        by_profile[notification.profile].append(notification)
+    if not by_profile:
+        return
+
+    failed = 0
+    with get_connection() as connection:
+        for profile, notifications in by_profile.items():
+            ids = [n.pk for n in notifications]
+            try:
+                connection.send_messages([build_message(profile, notifications, connection)])
+            except Exception as exc:
+                failed += 1
+                EmailNotification.objects.filter(pk__in=ids).update(
+                    status='pending', claimed_at=None, last_error=repr(exc))
+            else:
+                EmailNotification.objects.filter(pk__in=ids).update(
+                    status='sent', sent_at=timezone.now(), last_error='')
+    if failed:
+        raise RuntimeError(f'{failed} notification email(s) failed to send')
@@ -0,0 +1,67 @@
+import base64
+from dataclasses import dataclass
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    next_cursor: str = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(obj):
+    raw = f'{obj.created_at.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return (created_at, pk) for a cursor, or None if it is missing or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def page_size_from(value, default=None):
+    """
+    Parse a requested page size, falling back to the default and capping it.
+    """
+    default = default or settings.PAGE_SIZE
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, settings.MAX_PAGE_SIZE))
+
+
+def keyset_page(queryset, cursor=None, page_size=None):
+    """
+    One page of `queryset`, newest first, keyed on (created_at, id).
+
+    Fetches one row past the page to learn whether a next page exists, so a
+    page is always a single query however deep the cursor is.
+    """
+    page_size = page_size or settings.PAGE_SIZE
+    queryset = queryset.order_by('-created_at', '-id')
+    position = decode_cursor(cursor)
+    if position:
+        created_at, pk = position
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    items = list(queryset[:page_size + 1])
+    if len(items) > page_size:
+        items = items[:page_size]
+        return KeysetPage(items, encode_cursor(items[-1]))
+    return KeysetPage(items)
@@ -0,0 +1,155 @@
+"""
+Profile photo processing.
+
+The profile form only validates uploads. accept_upload() parks the raw file
+in PHOTO_UPLOAD_ROOT, which is outside MEDIA_ROOT and never served, and
+queues publish_profile_photo(). That job re-encodes the upload with strip()
+so the public copy never carries EXIF, GPS or other metadata and is capped
+at PHOTO_MAX_DIMENSION, writes square JPEG and WebP thumbnails for every
+size in PHOTO_SIZES (recorded in Profile.photo_variants so templates can
+build srcset attributes), and only then swaps it in as Profile.photo. Until
+the job has run the previous photo stays up.
+"""
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from PIL import Image, ImageOps, ImageSequence
+
+from . import caching
+from .models import Profile
+from .tasks import enqueue, task
+
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 6}),
+}
+
+
+def upload_storage():
+    return FileSystemStorage(location=settings.PHOTO_UPLOAD_ROOT)
+
+
+def encode(image, fmt):
+    pillow_format, _, options = FORMATS[fmt]
+    buffer = io.BytesIO()
+    image.save(buffer, pillow_format, **options)
+    return ContentFile(buffer.getvalue())
+
+
+def load(f):
+    image = Image.open(f)
+    image.load()
+    # Apply the EXIF orientation before the EXIF data is thrown away
+    return ImageOps.exif_transpose(image).convert('RGB')
+
+
+def strip(f):
+    """
+    The image re-encoded with no metadata, and its file extension.
+
+    Animated GIFs are re-encoded frame by frame and stay animated; anything
+    else becomes a JPEG.
+    """
+    box = (settings.PHOTO_MAX_DIMENSION, settings.PHOTO_MAX_DIMENSION)
+    image = Image.open(f)
+    if image.format == 'GIF' and getattr(image, 'is_animated', False):
+        frames, durations = [], []
+        for frame in ImageSequence.Iterator(image):
+            durations.append(frame.info.get('duration', 100))
+            frame = frame.convert('RGBA')
+            frame.thumbnail(box)
+            # Comments and other extensions would be written back out
+            frame.info = {}
+            frames.append(frame)
+        options = {'loop': image.info['loop']} if 'loop' in image.info else {}
+        buffer = io.BytesIO()
+        frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=durations, disposal=2, **options)
+        return ContentFile(buffer.getvalue()), 'gif'
+
+    f.seek(0)
+    image = load(f)
+    image.thumbnail(box)
+    return encode(image, 'jpeg'), 'jpg'
+
+
+def thumbnails(path):
+    with default_storage.open(path) as f:
+        image = load(f)
+    stem = os.path.splitext(os.path.basename(path))[0]
+
+    variants = {fmt: {} for fmt in FORMATS}
+    for size in settings.PHOTO_SIZES:
+        thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        for fmt, (_, extension, _) in FORMATS.items():
+            variants[fmt][str(size)] = default_storage.save(
+                f'profile_photos/thumbs/{stem}-{size}.{extension}', encode(thumbnail, fmt)
+            )
+    return variants
+
+
+def variant_names(variants):
+    return [name for sizes in variants.values() for name in sizes.values()]
+
+
+def accept_upload(profile, upload):
+    """
+    Queue a validated upload to replace the profile's photo.
+    """
+    name = upload_storage().save(f'profile_photos/{os.path.basename(upload.name)}', upload)
+    Profile.objects.filter(pk=profile.pk).update(photo_pending=name)
+    profile.photo_pending = name
+    enqueue('publish_profile_photo', profile_id=profile.pk, upload=name)
+
+
+def schedule(profile):
+    if profile.photo:
+        enqueue('process_profile_photo', profile_id=profile.pk, path=profile.photo.name)
+
+
+@task
+def publish_profile_photo(profile_id, upload):
+    uploads = upload_storage()
+    profile = Profile.objects.filter(pk=profile_id, photo_pending=upload).first()
+    if profile is None:
+        # Deleted, or replaced by a newer upload with its own job
+        uploads.delete(upload)
+        return
+
+    with uploads.open(upload) as f:
+        clean, extension = strip(f)
+    stem = os.path.splitext(os.path.basename(upload))[0]
+    path = default_storage.save(f'profile_photos/{stem}.{extension}', clean)
+    variants = thumbnails(path)
+
+    updated = Profile.objects.filter(pk=profile_id, photo_pending=upload).update(
+        photo=path, photo_variants=variants, photo_pending=''
+    )
+    if updated:
+        stale = [profile.photo.name] + variant_names(profile.photo_variants)
+    else:
+        stale = [path] + variant_names(variants)
+    for name in stale:
+        if name:
+            default_storage.delete(name)
+    uploads.delete(upload)
+    caching.bump('profiles')
+
+
+@task
+def process_profile_photo(profile_id, path):
+    profile = Profile.objects.filter(pk=profile_id).first()
+    if profile is None or profile.photo.name != path:
+        # Deleted, or replaced by a newer upload with its own job
+        return
+
+    variants = thumbnails(path)
+    updated = Profile.objects.filter(pk=profile_id, photo=path).update(photo_variants=variants)
+    stale = variant_names(profile.photo_variants)
+    if not updated:
+        stale = variant_names(variants)
+    for name in stale:
+        default_storage.delete(name)
+    caching.bump('profiles')
@@ -0,0 +1,222 @@
+"""
+Who is online.
+
+Every open session socket is a connection. A user is online while at least
+one of their connections has sent a heartbeat within PRESENCE_TTL_SECONDS;
+sockets that die without closing simply expire. Connections are kept in
+process memory, or in Redis when PRESENCE_REDIS_URL is set so that every
+worker sees the same state.
+
+Changes are not pushed per connection. `batcher` collects the users whose
+state may have flipped and, every PRESENCE_BATCH_SECONDS, re-reads them in
+one call and sends a `presence_changes` event to each changed user's
+group (group_name()). Session sockets join the group of every user a page
+watches, so a change only reaches the sockets watching that user. Sockets
+may only watch their match partners, up to PRESENCE_WATCH_LIMIT each.
+"""
+import asyncio
+import threading
+import time
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+def group_name(user_id):
+    return f'presence_{user_id}'
+
+
+class MemoryPresence:
+    # Cheap enough to call straight from the event loop
+    blocking = False
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def _live(self, user_id, now):
+        connections = self.connections.get(user_id, {})
+        for connection, expires in list(connections.items()):
+            if expires <= now:
+                del connections[connection]
+        if not connections:
+            self.connections.pop(user_id, None)
+        return connections
+
+    def connect(self, user_id, connection):
+        """
+        Add or refresh a connection; True if the user just came online.
+        """
+        now = time.time()
+        with self.lock:
+            came_online = not self._live(user_id, now)
+            self.connections.setdefault(user_id, {})[connection] = now + settings.PRESENCE_TTL_SECONDS
+        return came_online
+
+    heartbeat = connect
+
+    def disconnect(self, user_id, connection):
+        """
+        Drop a connection; True if it was the user's last one.
+        """
+        with self.lock:
+            connections = self.connections.get(user_id, {})
+            if connections.pop(connection, None) is None:
+                return False
+            return not self._live(user_id, time.time())
+
+    def online(self, user_ids):
+        # Read-only, so sweep() still sees and reports expired users
+        now = time.time()
+        with self.lock:
+            return {
+                user_id for user_id in user_ids
+                if any(expires > now for expires in self.connections.get(user_id, {}).values())
+            }
+
+    def sweep(self):
+        """
+        Forget expired connections; returns the users that went offline.
+        """
+        now = time.time()
+        with self.lock:
+            users = list(self.connections)
+            return {user_id for user_id in users if not self._live(user_id, now)}
+
+
+class RedisPresence:
+    """
+    A sorted set per user of connection -> expiry, plus one sorted set of
+    user -> latest expiry so `online()` is a single ZMSCORE (Redis 6.2+).
+    """
+    USERS = 'presence:users'
+    blocking = True
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def _key(self, user_id):
+        return f'presence:user:{user_id}'
+
+    def connect(self, user_id, connection):
+        now = time.time()
+        expires = now + settings.PRESENCE_TTL_SECONDS
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        pipe.zadd(key, {connection: expires})
+        pipe.expire(key, settings.PRESENCE_TTL_SECONDS * 2)
+        pipe.zadd(self.USERS, {user_id: expires}, gt=True)
+        _, before, *_ = pipe.execute()
+        return before == 0
+
+    heartbeat = connect
+
+    def _drop_if_empty(self, user_id, now):
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        _, remaining = pipe.execute()
+        if remaining:
+            return False
+        self.redis.zrem(self.USERS, user_id)
+        return True
+
+    def disconnect(self, user_id, connection):
+        if not self.redis.zrem(self._key(user_id), connection):
+            return False
+        return self._drop_if_empty(user_id, time.time())
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        now = time.time()
+        scores = self.redis.zmscore(self.USERS, user_ids)
+        return {user_id for user_id, score in zip(user_ids, scores) if score and score > now}
+
+    def sweep(self):
+        now = time.time()
+        expired = self.redis.zrangebyscore(self.USERS, '-inf', now)
+        return {int(user_id) for user_id in expired if self._drop_if_empty(int(user_id), now)}
+
+
+@lru_cache(maxsize=1)
+def backend():
+    if settings.PRESENCE_REDIS_URL:
+        return RedisPresence(settings.PRESENCE_REDIS_URL)
+    return MemoryPresence()
+
+
+def online(user_ids):
+    """
+    The subset of `user_ids` that is online, in one backend call.
+    """
+    return backend().online(user_ids)
+
+
+async def call(name, *args):
+    """
+    Run a backend method from async code, off the event loop if it blocks.
+    """
+    method = getattr(backend(), name)
+    if backend().blocking:
+        return await sync_to_async(method, thread_sensitive=False)(*args)
+    return method(*args)
+
+
+class Batcher:
+    """
+    Coalesces possible state changes into one event per changed user and
+    interval.
+    """
+    def __init__(self):
+        self.pending = set()
+        self.task = None
+        self.last_sweep = 0.0
+
+    def add(self, *user_ids):
+        self.pending.update(user_ids)
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.PRESENCE_BATCH_SECONDS)
+        await self.flush()
+
+    async def flush(self):
+        user_ids, self.pending = self.pending, set()
+        if not user_ids:
+            return
+        # Re-read rather than trusting event order, which can interleave
+        # across connections and workers
+        now_online = await call('online', user_ids)
+        layer = get_channel_layer()
+        await asyncio.gather(*(
+            layer.group_send(group_name(user_id), {
+                'type': 'presence_changes',
+                'changes': {str(user_id): user_id in now_online},
+            })
+            for user_id in user_ids
+        ))
+
+    async def sweep(self):
+        """
+        Every half TTL, push the users whose connections all expired.
+        """
+        now = time.monotonic()
+        if now - self.last_sweep < settings.PRESENCE_TTL_SECONDS / 2:
+            return
+        self.last_sweep = now
+        gone = await call('sweep')
+        if gone:
+            self.add(*gone)
+
+
+batcher = Batcher()
@@ -0,0 +1,37 @@
+"""
+QR codes for TOTP enrolment.
+
+The image only depends on the device's provisioning URL, so it is rendered
+once as SVG and cached until the device is confirmed, deleted or re-keyed,
+or OTP_QR_CACHE_SECONDS pass: it contains the TOTP secret, so it must not
+outlive enrolment in the cache.
+qrcode is imported when the app loads rather than on the first signup.
+"""
+import hashlib
+
+import qrcode
+from qrcode.image.svg import SvgPathFillImage
+from django.conf import settings
+from django.core.cache import cache
+
+
+def cache_key(device):
+    return f'otp-qr:{device.pk}:{hashlib.sha256(device.key.encode()).hexdigest()[:16]}'
+
+
+def render_svg(data):
+    image = qrcode.make(data, image_factory=SvgPathFillImage, border=4)
+    return image.to_string(encoding='unicode')
+
+
+def device_svg(device):
+    key = cache_key(device)
+    svg = cache.get(key)
+    if svg is None:
+        svg = render_svg(device.config_url)
+        cache.set(key, svg, settings.OTP_QR_CACHE_SECONDS)
+    return svg
+
+
+def forget(device):
+    cache.delete(cache_key(device))
@@ -0,0 +1,81 @@
+"""
+Per-request query recording and N+1 detection.
+
+`QueryRecorder` hooks the database connection and keeps every SQL statement
+run inside it. Statements are grouped by shape (parameters and literal
+numbers stripped), so the same lookup repeated once per row of a list stands
+out as a likely N+1. `QueryCountMiddleware` applies it to every request when
+`QUERY_COUNT` is enabled, and the test suite uses it for per-URL budgets.
+"""
+import logging
+import re
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+NUMBER_RE = re.compile(r'\b\d+\b')
+
+
+def shape(sql):
+    sql = IN_LIST_RE.sub('IN (...)', sql)
+    return NUMBER_RE.sub('?', ' '.join(sql.split()))
+
+
+class QueryRecorder:
+    def __init__(self, using=connection):
+        self.connection = using
+        self.queries = []
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def shapes(self):
+        return Counter(shape(sql) for sql in self.queries)
+
+    def repeated(self, threshold=None):
+        """
+        Query shapes run at least `threshold` times, most frequent first.
+        """
+        threshold = threshold or settings.QUERY_REPEAT_THRESHOLD
+        return [(sql, n) for sql, n in self.shapes().most_common() if n >= threshold]
+
+
+class QueryCountMiddleware:
+    """
+    Adds an `X-Query-Count` header and logs a warning for likely N+1 queries.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.QUERY_COUNT:
+            return self.get_response(request)
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        response['X-Query-Count'] = recorder.count
+        for sql, n in recorder.repeated():
+            logger.warning('Possible N+1 on %s: %d x %s', request.path, n, sql)
+        return response
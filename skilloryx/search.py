@@ -0,0 +1,197 @@
+"""
+Full-text search over skills, offers and requests.
+
+Every Offer and Request is mirrored into a `skilloryx_search` document table
+(skill name + description/details). On SQLite that table is an FTS5 index
+ranked with bm25; on Postgres it carries a weighted tsvector and a trigram
+index on the skill name. Other databases fall back to a plain `icontains`
+filter. Documents are kept current by the signal handlers in signals.py.
+"""
+import difflib
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Offer, Request
+
+TABLE = 'skilloryx_search'
+VOCAB_TABLE = 'skilloryx_search_vocab'
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+KINDS = ('offer', 'request')
+
+
+def _terms(q):
+    return [term.lower() for term in TERM_RE.findall(q)][:8]
+
+
+class FallbackBackend:
+    """
+    Used when no search table exists (unsupported database or no FTS5).
+    """
+    def clear(self):
+        pass
+
+    def index(self, kind, object_id, skill, body):
+        pass
+
+    def remove(self, kind, object_ids):
+        pass
+
+    def search(self, kind, q, limit):
+        model = Offer if kind == 'offer' else Request
+        text_field = 'description' if kind == 'offer' else 'details'
+        queryset = model.objects.all()
+        for term in _terms(q):
+            queryset = queryset.filter(Q(skill__name__icontains=term) | Q(**{f'{text_field}__icontains': term}))
+        return list(queryset.order_by('-created_at').values_list('id', flat=True)[:limit])
+
+
+class SQLiteBackend:
+    # Documents are keyed on rowid so updates and deletes are index lookups;
+    # UNINDEXED columns can only be scanned.
+    @staticmethod
+    def rowid(kind, object_id):
+        return object_id * len(KINDS) + KINDS.index(kind)
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLE}')
+
+    def index(self, kind, object_id, skill, body):
+        rowid = self.rowid(kind, object_id)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [rowid])
+            cursor.execute(
+                f'INSERT INTO {TABLE} (rowid, kind, object_id, skill, body) VALUES (%s, %s, %s, %s, %s)',
+                [rowid, kind, object_id, skill, body],
+            )
+
+    def remove(self, kind, object_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'DELETE FROM {TABLE} WHERE rowid = %s',
+                [(self.rowid(kind, object_id),) for object_id in object_ids],
+            )
+
+    def _similar(self, cursor, term):
+        # Typo tolerance: pull indexed terms sharing the first letter and keep
+        # the close ones. The vocabulary grows with distinct words, not rows.
+        cursor.execute(
+            f'SELECT term FROM {VOCAB_TABLE} WHERE term >= %s AND term < %s',
+            [term[0], chr(ord(term[0]) + 1)],
+        )
+        vocabulary = [row[0] for row in cursor.fetchall()]
+        return difflib.get_close_matches(term, vocabulary, n=3, cutoff=0.75)
+
+    def search(self, kind, q, limit):
+        terms = _terms(q)
+        if not terms:
+            return []
+        with connection.cursor() as cursor:
+            clauses = []
+            for term in terms:
+                options = [f'"{term}"*'] + [f'"{similar}"' for similar in self._similar(cursor, term)]
+                clauses.append('(' + ' OR '.join(options) + ')')
+            cursor.execute(
+                f'SELECT object_id FROM {TABLE} WHERE {TABLE} MATCH %s AND kind = %s '
+                f'ORDER BY bm25({TABLE}, 0, 0, 10.0, 1.0) LIMIT %s',
+                [' AND '.join(clauses), kind, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresBackend:
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {TABLE}')
+
+    def index(self, kind, object_id, skill, body):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {TABLE} (kind, object_id, skill, body) VALUES (%s, %s, %s, %s) '
+                'ON CONFLICT (kind, object_id) DO UPDATE SET skill = EXCLUDED.skill, body = EXCLUDED.body',
+                [kind, object_id, skill, body],
+            )
+
+    def remove(self, kind, object_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {TABLE} WHERE kind = %s AND object_id = ANY(%s)',
+                [kind, list(object_ids)],
+            )
+
+    def search(self, kind, q, limit):
+        terms = _terms(q)
+        if not terms:
+            return []
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT object_id FROM {TABLE}, to_tsquery('simple', %s) query "
+                f"WHERE kind = %s AND (document @@ query OR skill %% %s) "
+                f"ORDER BY ts_rank(document, query) + similarity(skill, %s) DESC LIMIT %s",
+                [tsquery, kind, q, q, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgresBackend,
+}
+
+_backends = {}
+
+
+def get_backend():
+    """
+    The backend for the default database, chosen once per process.
+    """
+    alias = connection.alias
+    if alias not in _backends:
+        backend = BACKENDS.get(connection.vendor)
+        if backend is None or TABLE not in connection.introspection.table_names():
+            backend = FallbackBackend
+        _backends[alias] = backend()
+    return _backends[alias]
+
+
+def index_offer(offer):
+    get_backend().index('offer', offer.pk, offer.skill.name, offer.description)
+
+
+def index_request(request_obj):
+    get_backend().index('request', request_obj.pk, request_obj.skill.name, request_obj.details)
+
+
+def index_skill(skill):
+    """
+    Re-index every document that embeds this skill's name.
+    """
+    for offer in Offer.objects.filter(skill=skill).select_related('skill'):
+        index_offer(offer)
+    for request_obj in Request.objects.filter(skill=skill).select_related('skill'):
+        index_request(request_obj)
+
+
+def remove(kind, object_id):
+    get_backend().remove(kind, [object_id])
+
+
+def rebuild():
+    backend = get_backend()
+    backend.clear()
+    for offer in Offer.objects.select_related('skill').iterator():
+        backend.index('offer', offer.pk, offer.skill.name, offer.description)
+    for request_obj in Request.objects.select_related('skill').iterator():
+        backend.index('request', request_obj.pk, request_obj.skill.name, request_obj.details)
+
+
+def search_ids(kind, q, limit=100):
+    """
+    Ids of matching offers or requests, most relevant first.
+    """
+    return get_backend().search(kind, q, limit)
@@ -0,0 +1,274 @@
+"""
+The production ASGI launcher behind `python manage.py serve`.
+
+The supervisor binds the listening socket once and starts ASGI_WORKERS
+processes that all accept on it, each running settings.ASGI_APPLICATION
+under daphne or uvicorn. Workers that die are restarted, with backoff when
+they keep dying on startup. SIGHUP reloads: a new generation is started and
+the old one is only stopped once every new worker is listening, so the
+socket never goes unserved. SIGTERM and SIGINT stop every worker, giving
+each ASGI_GRACEFUL_SECONDS before it is killed.
+
+Websocket groups, the cache and presence live in process memory unless
+REDIS_URL is set, so with several workers a chat message or call signal
+would only reach sockets on the same process. `shared_state_problems()`
+lists what would break, and serve refuses to start more than one worker
+while it finds anything.
+"""
+import argparse
+import asyncio
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+
+SERVERS = ('daphne', 'uvicorn')
+# A worker that exits sooner than this after starting counts as a crash loop
+MIN_UPTIME_SECONDS = 10
+MAX_BACKOFF_SECONDS = 30
+BOOT_TIMEOUT_SECONDS = 60
+
+
+def shared_state_problems(ping=True):
+    """
+    Why running more than one worker would split state, as readable
+    strings; empty when everything shared lives outside the process.
+    """
+    problems = []
+    layer = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND', '')
+    if layer.endswith('InMemoryChannelLayer'):
+        problems.append('CHANNEL_LAYERS uses the in-memory layer, so group messages never leave their worker')
+    elif ping:
+        try:
+            asyncio.run(asyncio.wait_for(_ping_layer(), 5))
+        except Exception as e:
+            problems.append(f'the channel layer did not answer a ping ({e!r})')
+    for alias, cache in settings.CACHES.items():
+        if cache['BACKEND'].endswith('LocMemCache'):
+            problems.append(f'cache "{alias}" is per process, so invalidations do not reach other workers')
+    if not settings.PRESENCE_REDIS_URL:
+        problems.append('PRESENCE_REDIS_URL is empty, so each worker only sees its own sockets online')
+    return problems
+
+
+async def _ping_layer():
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    # Every shard, not just the one a new channel happens to hash to
+    for index in range(len(getattr(layer, 'hosts', ()))):
+        await layer.connection(index).ping()
+    channel = await layer.new_channel()
+    await layer.send(channel, {'type': 'ping'})
+    await layer.receive(channel)
+
+
+def bind(host, port, backlog):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def worker_command(sock, ready_fd, options):
+    """
+    The command line of one worker process, which inherits `sock` and
+    writes a byte to `ready_fd` once it is accepting connections.
+    """
+    command = [
+        sys.executable, '-m', 'skilloryx.server',
+        '--fd', str(sock.fileno()),
+        '--ready-fd', str(ready_fd),
+        '--server', options['server'],
+        '--graceful-timeout', str(options['graceful_timeout']),
+    ]
+    if options['limit_concurrency']:
+        command += ['--limit-concurrency', str(options['limit_concurrency'])]
+    return command
+
+
+class Worker:
+    def __init__(self, process, ready_fd):
+        self.process = process
+        self.ready_fd = ready_fd
+        self.started = time.monotonic()
+        self.listening = False
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def check_ready(self):
+        if not self.listening and self.ready_fd is not None:
+            self.listening = bool(os.read(self.ready_fd, 1))
+            os.close(self.ready_fd)
+            self.ready_fd = None
+        return self.listening
+
+
+class Supervisor:
+    def __init__(self, sock, options, log=print):
+        self.sock = sock
+        self.options = options
+        self.log = log
+        self.workers = []
+        self.respawn_at = []
+        self.backoff = 1
+        self.signals = []
+
+    def spawn(self):
+        ready_read, ready_write = os.pipe()
+        process = subprocess.Popen(
+            worker_command(self.sock, ready_write, self.options),
+            pass_fds=(self.sock.fileno(), ready_write),
+        )
+        os.close(ready_write)
+        return Worker(process, ready_read)
+
+    def wait_ready(self, workers, timeout):
+        deadline = time.monotonic() + timeout
+        while not all(worker.listening for worker in workers):
+            pending = {worker.ready_fd: worker for worker in workers if worker.ready_fd is not None}
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                break
+            readable, _, _ = select.select(list(pending), [], [], min(remaining, 0.5))
+            for fd in readable:
+                pending[fd].check_ready()
+        return all(worker.listening for worker in workers)
+
+    def stop(self, workers):
+        for worker in workers:
+            if worker.process.poll() is None:
+                worker.process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.options['graceful_timeout']
+        for worker in workers:
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.log(f'Worker {worker.pid} did not stop in time, killing it.')
+                worker.process.kill()
+                worker.process.wait()
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+                worker.ready_fd = None
+
+    def reload(self):
+        self.log('Reloading: starting a new generation of workers.')
+        new = [self.spawn() for _ in range(self.options['workers'])]
+        if not self.wait_ready(new, BOOT_TIMEOUT_SECONDS):
+            self.log('Reload failed, the new workers did not start; keeping the current ones.')
+            self.stop(new)
+            return
+        old, self.workers = self.workers, new
+        self.respawn_at = []
+        self.stop(old)
+        self.log(f'Reloaded, serving with workers {", ".join(str(worker.pid) for worker in new)}.')
+
+    def reap(self):
+        now = time.monotonic()
+        for worker in list(self.workers):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            self.workers.remove(worker)
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+            if now - worker.started < MIN_UPTIME_SECONDS:
+                delay, self.backoff = self.backoff, min(self.backoff * 2, MAX_BACKOFF_SECONDS)
+            else:
+                delay, self.backoff = 0, 1
+            self.log(f'Worker {worker.pid} exited with code {code}, restarting in {delay}s.')
+            self.respawn_at.append(now + delay)
+        for at in sorted(self.respawn_at):
+            if at <= now:
+                self.respawn_at.remove(at)
+                self.workers.append(self.spawn())
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        self.workers = [self.spawn() for _ in range(self.options['workers'])]
+        self.wait_ready(self.workers, BOOT_TIMEOUT_SECONDS)
+        host, port = self.sock.getsockname()[:2]
+        self.log(
+            f'Serving {settings.ASGI_APPLICATION} on {host}:{port} with {len(self.workers)} '
+            f'{self.options["server"]} worker(s): {", ".join(str(worker.pid) for worker in self.workers)}.'
+        )
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.log('Shutting down.')
+                    self.stop(self.workers)
+                    return
+            self.reap()
+            self.wait_ready(self.workers, 0.5)
+            time.sleep(0.5)
+
+
+def run_worker(argv=None):
+    """
+    Entry point of one worker: load the application, then serve it on the
+    inherited socket until told to stop.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fd', type=int, required=True)
+    parser.add_argument('--ready-fd', type=int, required=True)
+    parser.add_argument('--server', choices=SERVERS, default='daphne')
+    parser.add_argument('--graceful-timeout', type=int, default=30)
+    parser.add_argument('--limit-concurrency', type=int)
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
+    from django.utils.module_loading import import_string
+
+    application = import_string(settings.ASGI_APPLICATION)
+
+    def ready():
+        os.write(args.ready_fd, b'1')
+        os.close(args.ready_fd)
+
+    if args.server == 'uvicorn':
+        import uvicorn
+
+        class Server(uvicorn.Server):
+            async def startup(self, sockets=None):
+                await super().startup(sockets)
+                ready()
+
+        Server(uvicorn.Config(
+            application,
+            fd=args.fd,
+            lifespan='off',
+            limit_concurrency=args.limit_concurrency,
+            timeout_graceful_shutdown=args.graceful_timeout,
+            proxy_headers=True,
+        )).run()
+    else:
+        from daphne.server import Server
+
+        Server(
+            application,
+            # Twisted's fd endpoint string can only describe IPv4 sockets
+            endpoints=[f'fd:fileno={args.fd}'],
+            application_close_timeout=args.graceful_timeout,
+            proxy_forwarded_address_header='X-Forwarded-For',
+            proxy_forwarded_port_header='X-Forwarded-Port',
+            proxy_forwarded_proto_header='X-Forwarded-Proto',
+            ready_callable=ready,
+        ).run()
+
+
+if __name__ == '__main__':
+    run_worker()
@@ -1,14 +1,131 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import Profile
+from django_otp.plugins.otp_totp.models import TOTPDevice
+from .models import Profile, Offer, Request, Skill, SwapProposal, Review
+from .matching import schedule_refresh
+from . import counters, qr, search
+from .caching import bump
 
 @receiver(post_save, sender = User)
 def create_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user = instance)
 
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    if hasattr(instance, 'profile'):
-        instance.profile.save()
+@receiver(post_save, sender=TOTPDevice)
+@receiver(post_delete, sender=TOTPDevice)
+def sync_2fa(sender, instance, **kwargs):
+    Profile.sync_2fa(instance.user_id)
+
+@receiver(post_save, sender=TOTPDevice)
+@receiver(post_delete, sender=TOTPDevice)
+def forget_qr_code(sender, instance, signal, **kwargs):
+    if signal is post_delete or instance.confirmed:
+        qr.forget(instance)
+
+@receiver(post_save, sender=Offer)
+@receiver(post_delete, sender=Offer)
+@receiver(post_save, sender=Request)
+@receiver(post_delete, sender=Request)
+def refresh_matches(sender, instance, **kwargs):
+    schedule_refresh(instance.profile_id)
+
+@receiver(post_save, sender=Offer)
+@receiver(post_delete, sender=Offer)
+def invalidate_offers(sender, instance, **kwargs):
+    bump('offers')
+
+@receiver(post_save, sender=Request)
+@receiver(post_delete, sender=Request)
+def invalidate_requests(sender, instance, **kwargs):
+    bump('requests')
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_profiles(sender, instance, **kwargs):
+    bump('profiles')
+
+@receiver(post_save, sender=Skill)
+def invalidate_skill(sender, instance, created, **kwargs):
+    if not created:
+        bump('offers')
+        bump('requests')
+
+@receiver(post_save, sender=Offer)
+def index_offer(sender, instance, **kwargs):
+    search.index_offer(instance)
+
+@receiver(post_save, sender=Request)
+def index_request(sender, instance, **kwargs):
+    search.index_request(instance)
+
+@receiver(post_save, sender=Skill)
+def index_skill(sender, instance, created, **kwargs):
+    if not created:
+        search.index_skill(instance)
+
+@receiver(post_delete, sender=Offer)
+def unindex_offer(sender, instance, **kwargs):
+    search.remove('offer', instance.pk)
+
+@receiver(post_delete, sender=Request)
+def unindex_request(sender, instance, **kwargs):
+    search.remove('request', instance.pk)
+
+@receiver(post_save, sender=Offer)
+def count_offer(sender, instance, created, **kwargs):
+    if created:
+        counters.adjust([instance.profile_id], offer_count=1)
+
+@receiver(post_delete, sender=Offer)
+def uncount_offer(sender, instance, **kwargs):
+    counters.adjust([instance.profile_id], offer_count=-1)
+
+@receiver(post_save, sender=Request)
+def count_request(sender, instance, created, **kwargs):
+    if created:
+        counters.adjust([instance.profile_id], request_count=1)
+
+@receiver(post_delete, sender=Request)
+def uncount_request(sender, instance, **kwargs):
+    counters.adjust([instance.profile_id], request_count=-1)
+
+# Remember the values as loaded so saves can count transitions
+@receiver(post_init, sender=SwapProposal)
+def remember_status(sender, instance, **kwargs):
+    instance._counted_status = instance.status
+
+@receiver(post_init, sender=Review)
+def remember_rating(sender, instance, **kwargs):
+    instance._counted_rating = instance.rating if instance.pk else None
+
+@receiver(post_save, sender=SwapProposal)
+def count_completed_swap(sender, instance, created, **kwargs):
+    was = not created and instance._counted_status == 'completed'
+    now = instance.status == 'completed'
+    if was != now:
+        counters.adjust([instance.proposer_id, instance.responder_id], completed_swap_count=1 if now else -1)
+    instance._counted_status = instance.status
+
+@receiver(post_delete, sender=SwapProposal)
+def uncount_completed_swap(sender, instance, **kwargs):
+    if instance._counted_status == 'completed':
+        counters.adjust([instance.proposer_id, instance.responder_id], completed_swap_count=-1)
+
+@receiver(post_save, sender=Review)
+def count_rating(sender, instance, created, **kwargs):
+    if created or instance.rating != instance._counted_rating:
+        reviewee_id = counters.reviewee_id(instance)
+        if created:
+            counters.adjust([reviewee_id], rating_sum=instance.rating, rating_count=1)
+        else:
+            counters.adjust([reviewee_id], rating_sum=instance.rating - instance._counted_rating)
+        # Reputation feeds into everyone's matches against this profile
+        schedule_refresh(reviewee_id)
+    instance._counted_rating = instance.rating
+
+@receiver(post_delete, sender=Review)
+def uncount_rating(sender, instance, **kwargs):
+    reviewee_id = counters.reviewee_id(instance)
+    counters.adjust([reviewee_id], rating_sum=-instance._counted_rating, rating_count=-1)
+    schedule_refresh(reviewee_id)
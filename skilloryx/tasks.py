@@ -0,0 +1,132 @@
+"""
+A small database-backed job queue.
+
+Jobs are registered with @task and queued with enqueue(); the row is written
+in the caller's transaction, so a job is only visible once the work that
+queued it has committed. `manage.py run_tasks` claims due rows, runs them
+and retries failures with exponential backoff.
+
+Delivery is at least once: a job still running after TASKS_LEASE_SECONDS is
+taken to belong to a dead worker and is claimed again, so jobs must be safe
+to run twice and anything slower than the lease should be split up. Every
+claim counts as an attempt, so a job that keeps killing its worker still
+fails after max_attempts.
+"""
+import logging
+import traceback
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def task(func):
+    registry[func.__name__] = func
+    return func
+
+
+def enqueue(name, max_attempts=None, run_at=None, **payload):
+    if name not in registry:
+        raise KeyError(f'Unknown task {name!r}')
+    job = Task.objects.create(
+        name=name,
+        payload=payload,
+        max_attempts=max_attempts or settings.TASKS_MAX_ATTEMPTS,
+        run_at=run_at or timezone.now(),
+    )
+    if settings.TASKS_EAGER and job.run_at <= timezone.now():
+        transaction.on_commit(lambda: run_now(job))
+    return job
+
+
+def run_now(job):
+    if Task.objects.filter(pk=job.pk, status='pending').update(status='running', attempts=F('attempts') + 1):
+        job.attempts += 1
+        run(job)
+
+
+def backoff(attempts):
+    return timedelta(seconds=min(settings.TASKS_BACKOFF_SECONDS * 2 ** (attempts - 1), settings.TASKS_BACKOFF_MAX_SECONDS))
+
+
+def claim(limit):
+    """
+    Mark up to `limit` due jobs as running, counting the attempt, and return
+    them. Jobs left running past the lease (a worker died mid-job) become
+    claimable again, or fail once they are out of attempts.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.TASKS_LEASE_SECONDS)
+    with transaction.atomic():
+        Task.objects.filter(status='running', updated_at__lt=stale, attempts__gte=F('max_attempts')).update(
+            status='failed', last_error='Lease expired on the last attempt', updated_at=now)
+        jobs = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='pending', run_at__lte=now) | Q(status='running', updated_at__lt=stale))
+            .order_by('run_at')[:limit]
+        )
+        Task.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status='running', attempts=F('attempts') + 1, updated_at=now)
+    for job in jobs:
+        job.attempts += 1
+    return jobs
+
+
+def run(job):
+    try:
+        registry[job.name](**job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            logger.error('Task %s (%s) failed permanently', job.pk, job.name)
+        else:
+            job.status = 'pending'
+            job.run_at = timezone.now() + backoff(job.attempts)
+            logger.warning('Task %s (%s) failed, retrying at %s', job.pk, job.name, job.run_at)
+    else:
+        job.status = 'done'
+        job.last_error = ''
+    job.save(update_fields=['status', 'run_at', 'last_error', 'updated_at'])
+    return job.status == 'done'
+
+
+def run_pending(batch_size=50):
+    """
+    Run every job that is due now; returns how many ran.
+    """
+    total = 0
+    while True:
+        jobs = claim(batch_size)
+        if not jobs:
+            return total
+        for job in jobs:
+            run(job)
+        total += len(jobs)
+
+
+@task
+def send_email(subject, message, recipient_list):
+    send_mail(subject, message, None, recipient_list)
+
+
+@task
+def push_notification(group, message):
+    async_to_sync(get_channel_layer().group_send)(
+        group,
+        {
+            'type': 'user_notification',
+            'message': message,
+        }
+    )
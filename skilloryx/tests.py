@@ -1,6 +1,52 @@
-from django.test import TestCase
-from django.contrib.auth.models import User
-from .models import Profile, Skill, Offer
+import http.client
+import logging.handlers
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from PIL import Image
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.contrib.auth.models import AnonymousUser, User
+from django.urls import reverse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import override_settings
+from django.core.cache import cache
+from django_otp.plugins.otp_totp.models import TOTPDevice
+from .models import Profile, Skill, Offer, Request, Match, SwapProposal, Message, Task
+from .models import EmailNotification, Review
+from .tasks import claim, enqueue, push_notification, run_pending
+from .forms import ProfileForm
+from .notifications import build_message, claim_due, deliver_email_notifications, notify_by_email
+from . import caching
+from .queries import QueryRecorder
+from . import counters, geo, inbox, layers, metrics, presence, qr, server
+from .counters import reconcile
+from .routing import websocket_urlpatterns
+from .matching import top_matches, rank, rebuild_all, refresh_profile, skill_mask, skill_positions
+from .pagination import keyset_page
+from .search import search_ids
+
+def geohash_of(location):
+    place = geo.geocode(location)
+    return geo.encode(place.latitude, place.longitude)
 
 class ProfileTestCase(TestCase):
     def setUp(self):
@@ -10,6 +56,34 @@ class ProfileTestCase(TestCase):
         self.assertTrue(hasattr(self.user, 'profile'))
         self.assertEqual(self.user.profile.user, self.user)
 
+    def test_2fa_flag_follows_devices(self):
+        device = TOTPDevice.objects.create(user=self.user, name='default', confirmed=False)
+        self.assertFalse(Profile.objects.get(user=self.user).is_2fa_enabled)
+        device.confirmed = True
+        device.save()
+        profile = Profile.objects.get(user=self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(profile.is_2fa_enabled)
+        device.delete()
+        self.assertFalse(Profile.objects.get(user=self.user).is_2fa_enabled)
+
+    def test_login_reads_flag_not_devices(self):
+        TOTPDevice.objects.create(user=self.user, name='default', confirmed=True)
+        # User and profile lookups, then the session write
+        with self.assertNumQueries(6), QueryRecorder() as recorder:
+            response = self.client.post(reverse('login'), {'username': 'testuser', 'password': '12345'})
+        self.assertRedirects(response, reverse('otp_verify'), fetch_redirect_response=False)
+        self.assertFalse([sql for sql in recorder.queries if TOTPDevice._meta.db_table in sql])
+
+    def test_stale_profile_save_keeps_2fa_flag(self):
+        profile = Profile.objects.get(user=self.user)
+        TOTPDevice.objects.create(user=self.user, name='default', confirmed=True)
+        self.user.save()
+        profile.bio = 'Edited'
+        profile.save()
+        profile.refresh_from_db()
+        self.assertEqual((profile.bio, profile.two_factor_enabled), ('Edited', True))
+
 class SkillTestCase(TestCase):
     def test_skill_creation(self):
         skill = Skill.objects.create(name='Python')
@@ -27,3 +101,1127 @@ class OfferTestCase(TestCase):
             level='beginner'
         )
         self.assertEqual(offer.profile.user, self.user)
+
+class MatchIndexTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='12345').profile
+        self.bob = User.objects.create_user(username='bob', password='12345').profile
+        self.python = Skill.objects.create(name='Python')
+        self.guitar = Skill.objects.create(name='Guitar')
+
+    def test_reciprocal_match_is_indexed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Offer.objects.create(profile=self.alice, skill=self.python)
+            Request.objects.create(profile=self.alice, skill=self.guitar)
+            bob_offer = Offer.objects.create(profile=self.bob, skill=self.guitar, available_online=False)
+            Request.objects.create(profile=self.bob, skill=self.python)
+        match = Match.objects.get(profile=self.alice)
+        self.assertEqual(match.offer, bob_offer)
+        self.assertEqual(match.score, 2)
+        self.assertEqual(list(top_matches(self.alice)), [match])
+
+    def test_deleting_offer_updates_index(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            offer = Offer.objects.create(profile=self.bob, skill=self.guitar)
+            Request.objects.create(profile=self.alice, skill=self.guitar)
+        self.assertTrue(Match.objects.filter(profile=self.alice).exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            offer.delete()
+        self.assertFalse(Match.objects.filter(profile=self.alice).exists())
+
+    def test_rebuild_matches_command(self):
+        Offer.objects.create(profile=self.bob, skill=self.guitar)
+        Request.objects.create(profile=self.alice, skill=self.guitar)
+        Match.objects.all().delete()
+        call_command('rebuild_matches', stdout=StringIO())
+        self.assertEqual(Match.objects.get(profile=self.alice).score, 1)
+
+class MatchEngineTestCase(TestCase):
+    def test_rank_scores_reciprocity_online_and_location(self):
+        # Sparse ids still get the low bits
+        positions = skill_positions([1, 2, 3, 5_000_000])
+        self.assertEqual(skill_mask([2, 5_000_000], positions), 0b1010)
+        offered = skill_mask([1, 2], positions)
+        dhaka, gazipur, sylhet = (geohash_of(name) for name in ('Dhaka', 'Gazipur', 'Sylhet'))
+        candidates = [
+            (10, 100, False, sylhet, 'Sylhet', skill_mask([3], positions), 0, 0),
+            (11, 101, True, gazipur, 'Gazipur', skill_mask([2, 5_000_000], positions), 0, 0),
+            (12, 102, True, '', '', 0, 0, 0),
+        ]
+        ranked = rank(offered, dhaka, 'Dhaka', candidates)
+        self.assertEqual(ranked, [(4, 11, 101), (1, 12, 102), (0, 10, 100)])
+        self.assertEqual(rank(offered, dhaka, 'Dhaka', candidates, limit=1), [(4, 11, 101)])
+
+    def test_unknown_places_match_on_their_name(self):
+        self.assertIsNone(geo.geocode('Kuakata'))
+        candidates = [
+            (10, 100, True, '', 'kuakata ', 0, 0, 0),
+            (11, 101, True, '', 'Kalapara', 0, 0, 0),
+            (12, 102, True, geohash_of('Dhaka'), 'Dhaka', 0, 0, 0),
+        ]
+        self.assertEqual(rank(0, '', 'Kuakata', candidates), [(2, 10, 100), (1, 12, 102), (1, 11, 101)])
+        # Nobody is co-located with a profile that has no location at all
+        self.assertEqual(rank(0, '', '', candidates[:2]), [(1, 11, 101), (1, 10, 100)])
+
+    def test_reputation_and_recency(self):
+        candidates = [
+            (10, 100, True, '', '', 0, 0, 0),
+            (11, 101, True, '', '', 0, 0, 0),
+            (12, 102, True, '', '', 0, 10, 5),
+            (13, 103, True, '', '', 0, 25, 5),
+        ]
+        # Well-reviewed first, badly reviewed last, unreviewed ties newest first
+        self.assertEqual([row[1] for row in rank(0, '', '', candidates)], [13, 11, 10, 12])
+        with self.settings(MATCH_WEIGHTS={'reciprocity': 2, 'online': 1, 'location': 1, 'reputation': 0}):
+            self.assertEqual([row[1] for row in rank(0, '', '', candidates)], [13, 12, 11, 10])
+
+    def test_refresh_query_budget_independent_of_candidates(self):
+        learner = User.objects.create_user(username='learner', password='12345').profile
+        skill = Skill.objects.create(name='Python')
+        Request.objects.create(profile=learner, skill=skill)
+        counts = []
+        for teachers in (2, 20):
+            for i in range(teachers - Offer.objects.count()):
+                teacher = User.objects.create_user(username=f'teacher{teachers}-{i}', password='12345').profile
+                Offer.objects.create(profile=teacher, skill=skill)
+            with QueryRecorder() as recorder:
+                refresh_profile(learner)
+            counts.append(recorder.count)
+        self.assertEqual(Match.objects.filter(profile=learner).count(), 20)
+        self.assertEqual(counts[0], counts[1])
+
+class OfferPaginationTestCase(TestCase):
+    def setUp(self):
+        profile = User.objects.create_user(username='teacher', password='12345').profile
+        self.offers = [
+            Offer.objects.create(profile=profile, skill=Skill.objects.create(name=f'Skill {i}'))
+            for i in range(5)
+        ]
+
+    def test_pages_walk_newest_first_without_overlap(self):
+        seen = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page = keyset_page(Offer.objects.select_related('skill', 'profile__user'), cursor, page_size=2)
+                [offer.profile.user.username for offer in page.items]
+            seen.extend(page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, sorted(self.offers, key=lambda o: (o.created_at, o.id), reverse=True))
+
+    def test_malformed_cursor_starts_from_newest(self):
+        page = keyset_page(Offer.objects.all(), 'not-a-cursor', page_size=2)
+        self.assertEqual(len(page.items), 2)
+
+    def test_offer_list_page_size_is_capped(self):
+        with self.settings(MAX_PAGE_SIZE=3):
+            response = self.client.get('/offers/', {'size': 50})
+        self.assertEqual(len(response.context['offers']), 3)
+        self.assertTrue(response.context['page'].has_next)
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.profile = User.objects.create_user(username='teacher', password='12345').profile
+        self.python = Offer.objects.create(
+            profile=self.profile, skill=Skill.objects.create(name='Python Programming'),
+            description='Django and data analysis')
+        self.guitar = Offer.objects.create(
+            profile=self.profile, skill=Skill.objects.create(name='Guitar'),
+            description='Acoustic basics, some python scripting for tabs')
+
+    def test_prefix_match_ranks_skill_name_first(self):
+        self.assertEqual(search_ids('offer', 'pyth'), [self.python.id, self.guitar.id])
+
+    def test_typo_tolerance(self):
+        self.assertEqual(search_ids('offer', 'gitar'), [self.guitar.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.guitar.skill.name = 'Ukulele'
+        self.guitar.skill.save()
+        self.assertEqual(search_ids('offer', 'ukulele'), [self.guitar.id])
+        self.guitar.delete()
+        self.assertEqual(search_ids('offer', 'ukulele'), [])
+
+    def test_offer_list_uses_search(self):
+        response = self.client.get('/offers/', {'q': 'django'})
+        self.assertEqual(response.context['offers'], [self.python])
+
+def session_socket(user):
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/session/')
+    communicator.scope['user'] = user
+    return communicator
+
+async def connected(user):
+    communicator = session_socket(user)
+    assert (await communicator.connect())[0]
+    # The hello frame with the heartbeat interval
+    assert (await communicator.receive_json_from())['stream'] == 'session'
+    return communicator
+
+class SessionSocketTestCase(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='12345')
+        self.bob = User.objects.create_user(username='bob', password='12345')
+        self.eve = User.objects.create_user(username='eve', password='12345')
+        offer_a = Offer.objects.create(profile=self.alice.profile, skill=Skill.objects.create(name='Python'))
+        offer_b = Offer.objects.create(profile=self.bob.profile, skill=Skill.objects.create(name='Guitar'))
+        self.proposal = SwapProposal.objects.create(
+            proposer=self.alice.profile, responder=self.bob.profile,
+            offer_from_proposer=offer_a, offer_from_responder=offer_b)
+
+    async def subscribed(self, user):
+        communicator = await connected(user)
+        await communicator.send_json_to({'stream': 'chat', 'payload': {'action': 'subscribe', 'proposal': self.proposal.id}})
+        return communicator
+
+    def test_anonymous_visitors_are_refused(self):
+        async def run():
+            connected, _ = await session_socket(AnonymousUser()).connect()
+            self.assertFalse(connected)
+        async_to_sync(run)()
+
+    def test_foreign_origins_are_refused(self):
+        from main.asgi import application
+
+        self.client.force_login(self.alice)
+        cookie = f'sessionid={self.client.cookies["sessionid"].value}'.encode()
+
+        async def run():
+            for origin, allowed in ((b'https://evil.example', False), (b'http://testserver', True)):
+                communicator = WebsocketCommunicator(
+                    application, '/ws/session/', headers=[(b'origin', origin), (b'cookie', cookie)]
+                )
+                connected, _ = await communicator.connect()
+                self.assertEqual(connected, allowed)
+                await communicator.disconnect()
+        async_to_sync(run)()
+
+    def test_chat_messages_are_pushed_to_both_participants(self):
+        async def run():
+            alice = await self.subscribed(self.alice)
+            bob = await self.subscribed(self.bob)
+            await alice.send_json_to({'stream': 'chat', 'payload': {'action': 'send', 'proposal': self.proposal.id, 'content': 'Hi Bob'}})
+            for communicator in (alice, bob):
+                frame = await communicator.receive_json_from()
+                self.assertEqual((frame['stream'], frame['payload']['proposal']), ('chat', self.proposal.id))
+                self.assertEqual(frame['payload']['message']['content'], 'Hi Bob')
+                self.assertEqual(frame['payload']['message']['sender__user__username'], 'alice')
+            await alice.disconnect()
+            await bob.disconnect()
+        async_to_sync(run)()
+        self.assertEqual(Message.objects.get().content, 'Hi Bob')
+        # Delivered to Bob's open chat, so it counts as read
+        self.assertEqual(inbox.proposals(self.bob.profile).get().unread, 0)
+
+    def test_outsiders_cannot_subscribe(self):
+        async def run():
+            eve = await self.subscribed(self.eve)
+            frame = await eve.receive_json_from()
+            self.assertEqual(frame['payload']['errors'], 'not a participant')
+            await eve.send_json_to({'stream': 'chat', 'payload': {'action': 'send', 'proposal': self.proposal.id, 'content': 'x'}})
+            self.assertEqual((await eve.receive_json_from())['payload']['errors'], 'not subscribed')
+            await eve.disconnect()
+        async_to_sync(run)()
+        self.assertFalse(Message.objects.exists())
+
+    def test_http_post_and_notifications_share_the_socket(self):
+        async def run():
+            bob = await self.subscribed(self.bob)
+            await sync_to_async(self.client.force_login)(self.alice)
+            await sync_to_async(self.client.post)(f'/proposals/{self.proposal.id}/message/', {'content': 'via http'})
+            self.assertEqual((await bob.receive_json_from())['payload']['message']['content'], 'via http')
+            await sync_to_async(push_notification)(group='user_bob', message={'type': 'video_call_invitation'})
+            self.assertEqual(await bob.receive_json_from(), {'stream': 'notifications', 'payload': {'type': 'video_call_invitation'}})
+            await bob.disconnect()
+        async_to_sync(run)()
+
+class MessageDeltaTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='12345')
+        bob = User.objects.create_user(username='bob', password='12345')
+        offer_a = Offer.objects.create(profile=self.alice.profile, skill=Skill.objects.create(name='Python'))
+        offer_b = Offer.objects.create(profile=bob.profile, skill=Skill.objects.create(name='Guitar'))
+        self.proposal = SwapProposal.objects.create(
+            proposer=self.alice.profile, responder=bob.profile,
+            offer_from_proposer=offer_a, offer_from_responder=offer_b)
+        for i in range(3):
+            Message.objects.create(proposal=self.proposal, sender=bob.profile, content=f'm{i}')
+        self.url = f'/proposals/{self.proposal.id}/message/'
+        self.client.force_login(self.alice)
+
+    def test_returns_only_messages_after_cursor(self):
+        first = self.client.get(self.url, {'limit': 2}).json()
+        self.assertEqual([m['content'] for m in first['messages']], ['m0', 'm1'])
+        self.assertTrue(first['has_more'])
+        rest = self.client.get(self.url, {'after': first['cursor']}).json()
+        self.assertEqual([m['content'] for m in rest['messages']], ['m2'])
+        self.assertFalse(rest['has_more'])
+
+    def test_up_to_date_client_gets_304(self):
+        response = self.client.get(self.url)
+        cursor = response.json()['cursor']
+        latest = self.client.get(self.url, {'after': cursor})
+        self.assertEqual(latest.json()['messages'], [])
+        again = self.client.get(self.url, {'after': cursor}, HTTP_IF_NONE_MATCH=latest['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+class InboxTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='12345').profile
+        self.bob = User.objects.create_user(username='bob', password='12345').profile
+        self.proposals = []
+        for i, status in enumerate(['pending', 'accepted', 'pending', 'declined']):
+            skill = Skill.objects.create(name=f'Skill {i}')
+            proposer, responder = (self.alice, self.bob) if i % 2 else (self.bob, self.alice)
+            self.proposals.append(SwapProposal.objects.create(
+                proposer=proposer, responder=responder, status=status,
+                offer_from_proposer=Offer.objects.create(profile=proposer, skill=skill),
+                offer_from_responder=Offer.objects.create(profile=responder, skill=skill)))
+
+    def test_page_is_one_query_and_filters_by_status(self):
+        with self.assertNumQueries(1):
+            page = inbox.page(self.alice, page_size=3)
+            for proposal in page.items:
+                [proposal.proposer.user.username, proposal.responder.user.username,
+                 proposal.offer_from_proposer.skill.name, proposal.offer_from_responder.skill.name, proposal.unread]
+        self.assertEqual(page.items, self.proposals[:0:-1])
+        self.assertEqual(inbox.page(self.alice, cursor=page.next_cursor).items, self.proposals[:1])
+        self.assertEqual(list(inbox.proposals(self.alice, 'pending')), [self.proposals[2], self.proposals[0]])
+        self.client.force_login(self.alice.user)
+        response = self.client.get(reverse('proposals'), {'status': 'declined'})
+        self.assertEqual(list(response.context['proposals']), [self.proposals[3]])
+
+    def test_unread_counts_follow_read_receipts(self):
+        proposal = self.proposals[0]
+        for i in range(3):
+            Message.objects.create(proposal=proposal, sender=self.bob, content=f'm{i}')
+        Message.objects.create(proposal=proposal, sender=self.alice, content='mine')
+        unread = lambda profile: inbox.proposals(profile).get(pk=proposal.pk).unread
+        self.assertEqual((unread(self.alice), unread(self.bob)), (3, 1))
+        self.client.force_login(self.alice.user)
+        self.client.get(reverse('proposal_detail', args=[proposal.pk]))
+        self.assertEqual((unread(self.alice), unread(self.bob)), (0, 1))
+        Message.objects.create(proposal=proposal, sender=self.bob, content='again')
+        self.assertEqual(unread(self.alice), 1)
+        # A stale receipt never moves back
+        inbox.mark_read(proposal.pk, self.alice, 1)
+        self.assertEqual(unread(self.alice), 1)
+
+class VideoCallSignallingTestCase(TestCase):
+    def setUp(self):
+        self.caller = User.objects.create_user(username='caller', password='12345')
+        self.callee = User.objects.create_user(username='callee', password='12345')
+        offer_a = Offer.objects.create(profile=self.caller.profile, skill=Skill.objects.create(name='Python'))
+        offer_b = Offer.objects.create(profile=self.callee.profile, skill=Skill.objects.create(name='Guitar'))
+        self.room = str(SwapProposal.objects.create(
+            proposer=self.caller.profile, responder=self.callee.profile,
+            offer_from_proposer=offer_a, offer_from_responder=offer_b).pk)
+
+    async def join(self, user, room):
+        communicator = await connected(user)
+        await communicator.send_json_to({'stream': 'call', 'payload': {'action': 'join', 'room': room}})
+        self.assertEqual((await communicator.receive_json_from())['payload'], {'room': room, 'joined': True})
+        return communicator
+
+    def signal(self, room, message):
+        return {'stream': 'call', 'payload': {'action': 'signal', 'room': room, 'message': message}}
+
+    def test_signalling_reaches_peer_but_not_sender(self):
+        async def run():
+            caller = await self.join(self.caller, self.room)
+            callee = await self.join(self.callee, self.room)
+            await caller.send_json_to(self.signal(self.room, {'type': 'offer', 'sdp': 'v=0'}))
+            self.assertEqual(
+                await callee.receive_json_from(),
+                {'stream': 'call', 'payload': {'room': self.room, 'message': {'type': 'offer', 'sdp': 'v=0'}}},
+            )
+            self.assertTrue(await caller.receive_nothing())
+            await caller.disconnect()
+            await callee.disconnect()
+        async_to_sync(run)()
+
+    def test_ice_candidates_are_coalesced(self):
+        async def run():
+            caller = await self.join(self.caller, self.room)
+            callee = await self.join(self.callee, self.room)
+            for i in range(3):
+                await caller.send_json_to(self.signal(self.room, {'type': 'ice-candidate', 'candidate': {'candidate': str(i)}}))
+            batch = (await callee.receive_json_from())['payload']['message']
+            self.assertEqual(batch['type'], 'ice-candidates')
+            self.assertEqual([c['candidate'] for c in batch['candidates']], ['0', '1', '2'])
+            self.assertTrue(await callee.receive_nothing())
+            await caller.disconnect()
+            await callee.disconnect()
+        with self.settings(VIDEO_CALL_ICE_BATCH_SECONDS=0.2):
+            async_to_sync(run)()
+
+    def test_only_participants_join(self):
+        eve = User.objects.create_user(username='eve', password='12345')
+
+        async def run():
+            communicator = await connected(eve)
+            for room in (self.room, 'lobby'):
+                await communicator.send_json_to({'stream': 'call', 'payload': {'action': 'join', 'room': room}})
+                self.assertEqual(
+                    (await communicator.receive_json_from())['payload'], {'room': room, 'error': 'not a participant'})
+            await communicator.send_json_to(self.signal(self.room, {'type': 'offer', 'sdp': 'v=0'}))
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+        async_to_sync(run)()
+
+@override_settings(PRESENCE_BATCH_SECONDS=0.05)
+class PresenceTestCase(TestCase):
+    def setUp(self):
+        presence.backend.cache_clear()
+        self.alice = User.objects.create_user(username='alice', password='12345')
+        self.bob = User.objects.create_user(username='bob', password='12345')
+        self.carol = User.objects.create_user(username='carol', password='12345')
+        skill = Skill.objects.create(name='Python')
+        for partner in (self.bob, self.carol):
+            offer = Offer.objects.create(profile=partner.profile, skill=skill)
+            Match.objects.create(profile=self.alice.profile, partner=partner.profile, offer=offer)
+
+    def watch(self, user_ids):
+        return {'stream': 'presence', 'payload': {'action': 'watch', 'users': user_ids}}
+
+    def test_connections_are_refcounted_and_expire(self):
+        tracker = presence.MemoryPresence()
+        self.assertTrue(tracker.connect(2, 'tab-1'))
+        self.assertFalse(tracker.connect(2, 'tab-2'))
+        self.assertFalse(tracker.disconnect(2, 'tab-1'))
+        self.assertEqual(tracker.online([1, 2, 3]), {2})
+        self.assertTrue(tracker.disconnect(2, 'tab-2'))
+        self.assertEqual(tracker.online([2]), set())
+        tracker.connect(2, 'tab-3')
+        with mock.patch('skilloryx.presence.time.time', return_value=time.time() + 61):
+            self.assertEqual(tracker.online([2]), set())
+            self.assertEqual(tracker.sweep(), {2})
+
+    def test_watchers_get_coalesced_changes(self):
+        async def run():
+            alice = await connected(self.alice)
+            await alice.send_json_to(self.watch([self.bob.pk]))
+            snapshot = await alice.receive_json_from()
+            self.assertEqual(snapshot['payload']['changes'], {str(self.bob.pk): False})
+            tabs = [await connected(self.bob) for _ in range(3)]
+            # Three connections, one event
+            self.assertEqual(
+                await alice.receive_json_from(), {'stream': 'presence', 'payload': {'changes': {str(self.bob.pk): True}}})
+            self.assertTrue(await alice.receive_nothing(0.2))
+            for tab in tabs:
+                await tab.disconnect()
+            self.assertEqual((await alice.receive_json_from())['payload']['changes'], {str(self.bob.pk): False})
+            await alice.disconnect()
+        async_to_sync(run)()
+        self.assertEqual(presence.online([self.alice.pk, self.bob.pk]), set())
+
+    @override_settings(PRESENCE_WATCH_LIMIT=2)
+    def test_watches_limited_to_partners(self):
+        stranger = User.objects.create_user(username='stranger', password='12345')
+        dave = User.objects.create_user(username='dave', password='12345')
+        offer = Offer.objects.create(profile=dave.profile, skill=Skill.objects.create(name='Chess'))
+        Match.objects.create(profile=self.alice.profile, partner=dave.profile, offer=offer)
+
+        async def run():
+            alice = await connected(self.alice)
+            await alice.send_json_to(self.watch([stranger.pk, self.bob.pk]))
+            self.assertEqual((await alice.receive_json_from())['payload']['changes'], {str(self.bob.pk): False})
+            await alice.send_json_to(self.watch([self.carol.pk]))
+            self.assertEqual((await alice.receive_json_from())['payload']['changes'], {str(self.carol.pk): False})
+            # Over the per-socket limit
+            await alice.send_json_to(self.watch([dave.pk]))
+            self.assertTrue(await alice.receive_nothing())
+            await alice.disconnect()
+        async_to_sync(run)()
+
+    def test_sockets_only_join_watched_users_groups(self):
+        layer = get_channel_layer()
+        members = lambda user: set(layer.groups.get(presence.group_name(user.pk), {}))
+
+        async def run():
+            alice = await connected(self.alice)
+            await alice.send_json_to(self.watch([self.bob.pk]))
+            await alice.receive_json_from()
+            self.assertEqual(len(members(self.bob)), 1)
+            self.assertEqual(members(self.carol), set())
+            # carol's batch goes to her group, which has no members
+            carol = await connected(self.carol)
+            self.assertTrue(await alice.receive_nothing(0.2))
+            await alice.send_json_to(self.watch([self.carol.pk]))
+            await alice.receive_json_from()
+            await alice.send_json_to({'stream': 'presence', 'payload': {'action': 'unwatch', 'users': [self.bob.pk]}})
+            await carol.disconnect()
+            self.assertEqual(await alice.receive_json_from(), {'stream': 'presence', 'payload': {'changes': {str(self.carol.pk): False}}})
+            self.assertEqual(members(self.bob), set())
+            await alice.disconnect()
+            self.assertEqual(members(self.carol), set())
+        async_to_sync(run)()
+
+    def test_overlapping_watches_are_refcounted(self):
+        async def run():
+            alice = await connected(self.alice)
+            # Two pages watching bob: he stays watched until both let go
+            for _ in range(2):
+                await alice.send_json_to(self.watch([self.bob.pk]))
+                await alice.receive_json_from()
+            await alice.send_json_to({'stream': 'presence', 'payload': {'action': 'unwatch', 'users': [self.bob.pk]}})
+            bob = await connected(self.bob)
+            self.assertEqual((await alice.receive_json_from())['payload']['changes'], {str(self.bob.pk): True})
+            await alice.send_json_to({'stream': 'presence', 'payload': {'action': 'unwatch', 'users': [self.bob.pk]}})
+            await bob.disconnect()
+            self.assertTrue(await alice.receive_nothing(0.2))
+            await alice.disconnect()
+        async_to_sync(run)()
+
+SESSION_WORKER_HARNESS = """
+const sockets = [];
+class WebSocket {
+  constructor() { this.readyState = 0; this.sent = []; sockets.push(this); }
+  send(data) { this.sent.push(JSON.parse(data)); }
+  close() {}
+}
+WebSocket.OPEN = 1;
+const self = { location: { href: 'http://testserver/' }, postMessage() {} };
+require('vm').runInNewContext(require('fs').readFileSync(process.argv[1], 'utf8'), {
+  self, WebSocket, URL, setTimeout, clearTimeout, setInterval, clearInterval,
+});
+JSON.parse(process.argv[2]).forEach(data => {
+  if (data === 'open') {
+    sockets[0].readyState = WebSocket.OPEN;
+    sockets[0].onopen();
+  } else {
+    self.onmessage({ data });
+  }
+});
+process.stdout.write(JSON.stringify(sockets.map(socket => socket.sent)));
+"""
+
+@skipUnless(shutil.which('node'), 'needs node')
+class SessionWorkerTestCase(SimpleTestCase):
+    watch = {'stream': 'presence', 'payload': {'action': 'watch', 'users': [2]}}
+    unwatch = {'stream': 'presence', 'payload': {'action': 'unwatch', 'users': [2]}}
+
+    def run_worker(self, *messages):
+        worker = os.path.join(settings.BASE_DIR, 'static', 'js', 'session-worker.js')
+        result = subprocess.run(
+            ['node', '-e', SESSION_WORKER_HARNESS, worker, json.dumps(messages)],
+            capture_output=True, text=True, check=True,
+        )
+        return json.loads(result.stdout)
+
+    def test_subscriptions_sent_once_when_made_while_connecting(self):
+        subscribe = {'type': 'subscribe', 'key': 'presence', 'frame': self.watch, 'leave': self.unwatch}
+        chat = {'stream': 'chat', 'payload': {'action': 'subscribe', 'proposal': 5}}
+        message = {'stream': 'chat', 'payload': {'message': 'hi'}}
+        sent = self.run_worker(
+            subscribe,
+            subscribe,
+            {'type': 'subscribe', 'key': 'chat:5', 'frame': chat},
+            {'type': 'unsubscribe', 'key': 'chat:5'},
+            {'type': 'send', 'frame': message},
+            'open',
+            {'type': 'unsubscribe', 'key': 'presence'},
+        )
+        # One watch, so the single unwatch ends it
+        self.assertEqual(sent, [[self.watch, message, self.unwatch]])
+
+class ServeTestCase(TestCase):
+    def test_several_workers_need_shared_state(self):
+        stderr = StringIO()
+        with self.assertRaisesMessage(CommandError, 'Refusing to start 2 workers'):
+            call_command('serve', workers=2, stderr=stderr)
+        self.assertIn('in-memory layer', stderr.getvalue())
+        redis = 'redis://localhost:6379/0'
+        with override_settings(
+            CHANNEL_LAYERS={'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}},
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': redis}},
+            PRESENCE_REDIS_URL=redis,
+        ):
+            self.assertEqual(server.shared_state_problems(ping=False), [])
+
+    def test_reload_replaces_workers_on_the_same_socket(self):
+        sock = server.bind('127.0.0.1', 0, 16)
+        options = {'workers': 1, 'server': 'daphne', 'graceful_timeout': 5, 'limit_concurrency': 0}
+        supervisor = server.Supervisor(sock, options, log=lambda message: None)
+        supervisor.workers = [supervisor.spawn()]
+        try:
+            self.assertTrue(supervisor.wait_ready(supervisor.workers, 60))
+            old = supervisor.workers[0]
+            supervisor.reload()
+            self.assertIsNotNone(old.process.poll())
+            self.assertIsNone(supervisor.workers[0].process.poll())
+            connection = http.client.HTTPConnection(*sock.getsockname(), timeout=10)
+            connection.request('GET', reverse('about'))
+            self.assertEqual(connection.getresponse().status, 200)
+        finally:
+            supervisor.stop(supervisor.workers)
+            sock.close()
+
+
+class ChannelLayerTestCase(TestCase):
+    def test_group_prefix_capacity_and_drop_metrics(self):
+        layer = layers.InMemoryChannelLayer(capacity=5, group_capacity={'user_': 2, 'video_call_': 10})
+        dropped = dict(metrics.layer_dropped.series)
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.group_add('user_alice', channel)
+            await layer.group_add('video_call_room', channel)
+            for _ in range(3):
+                await layer.group_send('user_alice', {'type': 'user.notification'})
+            self.assertEqual(await layer.queue_depth(), 2)
+            # Past the default capacity of 5, within the call rooms' 10
+            for _ in range(5):
+                await layer.group_send('video_call_room', {'type': 'video_call_message'})
+            self.assertEqual(await layer.queue_depth(), 7)
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'video_call_present'})
+        async_to_sync(run)()
+        self.assertEqual(metrics.layer_dropped.series['user'], dropped.get('user', 0) + 1)
+        self.assertEqual(metrics.layer_dropped.series['direct'], dropped.get('direct', 0) + 1)
+        self.assertIn('skilloryx_channel_layer_send_seconds_count{group="video_call"}', metrics.exposition())
+
+    def test_redis_shards_send_process_channels_where_they_are_read(self):
+        layer = layers.RedisChannelLayer(hosts=['redis://shard-a:6379', 'redis://shard-b:6379', 'redis://shard-c:6379'])
+        for _ in range(20):
+            channel = async_to_sync(layer.new_channel)()
+            self.assertEqual(layer.consistent_hash(channel), layer.consistent_hash(layer.non_local_name(channel)))
+        self.assertEqual({layer.consistent_hash(f'video_call_{room}') for room in range(100)}, {0, 1, 2})
+
+    def test_redis_drops_counted_without_extra_logging(self):
+        layers.RedisChannelLayer(hosts=['redis://shard-a:6379'])
+        logger = logging.getLogger('channels_redis.core')
+        handler = logging.handlers.BufferingHandler(10)
+        logger.addHandler(handler)
+        dropped = metrics.layer_dropped.series.get('other', 0)
+        # As configured before the layer lowered the logger to INFO
+        with mock.patch.object(layers.group_send_drops, 'level', logging.WARNING):
+            try:
+                logger.info('%s of %s channels over capacity in group %s', 2, 3, 'lobby')
+            finally:
+                logger.removeHandler(handler)
+        self.assertEqual(metrics.layer_dropped.series['other'], dropped + 2)
+        self.assertEqual(handler.buffer, [])
+
+
+class TaskQueueTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='12345', email='alice@example.com')
+        self.bob = User.objects.create_user(username='bob', password='12345')
+        offer_a = Offer.objects.create(profile=self.alice.profile, skill=Skill.objects.create(name='Python'))
+        offer_b = Offer.objects.create(profile=self.bob.profile, skill=Skill.objects.create(name='Guitar'))
+        self.proposal = SwapProposal.objects.create(
+            proposer=self.alice.profile, responder=self.bob.profile,
+            offer_from_proposer=offer_a, offer_from_responder=offer_b)
+
+    def test_accept_queues_email_instead_of_sending(self):
+        self.client.force_login(self.bob)
+        self.client.post(f'/proposals/{self.proposal.id}/accept/')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(set(Task.objects.values_list('name', flat=True)), {'deliver_email_notifications', 'push_notification'})
+        self.assertEqual(run_pending(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['alice@example.com'])
+        self.assertFalse(Task.objects.exclude(status='done').exists())
+
+    def test_failures_are_retried_with_backoff(self):
+        job = enqueue('send_email', max_attempts=2, subject='s', message='m', recipient_list=['x@example.com'])
+        with mock.patch('skilloryx.tasks.send_mail', side_effect=OSError('smtp down')):
+            with self.assertLogs('skilloryx.tasks', 'WARNING') as logs:
+                run_pending()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), ('pending', 1))
+            self.assertGreater(job.run_at, timezone.now())
+            self.assertEqual(run_pending(), 0)
+            Task.objects.filter(pk=job.pk).update(run_at=timezone.now())
+            with self.assertLogs('skilloryx.tasks', 'ERROR'):
+                run_pending()
+        self.assertIn('retrying', logs.output[0])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertIn('smtp down', job.last_error)
+
+    def test_expired_leases_count_as_attempts(self):
+        job = enqueue('send_email', max_attempts=2, subject='s', message='m', recipient_list=['x@example.com'])
+        expired = timezone.now() - timedelta(seconds=settings.TASKS_LEASE_SECONDS + 1)
+        for attempts in (1, 2):
+            self.assertEqual([claimed.attempts for claimed in claim(10)], [attempts])
+            Task.objects.filter(pk=job.pk).update(updated_at=expired)
+        self.assertEqual(claim(10), [])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+class EmailDigestTestCase(TestCase):
+    def setUp(self):
+        self.instant = User.objects.create_user(username='instant', password='12345', email='i@example.com').profile
+        self.digest = User.objects.create_user(username='digest', password='12345', email='d@example.com').profile
+        self.digest.email_delivery = 'digest'
+        self.digest.save()
+
+    def test_instant_and_digest_delivery(self):
+        notify_by_email(self.instant, 'One', 'first')
+        notify_by_email(self.digest, 'Two', 'second')
+        notify_by_email(self.digest, 'Three', 'third')
+        with mock.patch('skilloryx.notifications.get_connection', wraps=get_connection) as connections:
+            run_pending()
+            self.assertEqual([m.to for m in mail.outbox], [['i@example.com']])
+
+            # Close the digest window
+            EmailNotification.objects.update(deliver_after=timezone.now())
+            Task.objects.filter(status='pending').update(run_at=timezone.now())
+            run_pending()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[1].to, ['d@example.com'])
+        self.assertIn('2 updates', mail.outbox[1].subject)
+        self.assertIn('third', mail.outbox[1].body)
+        self.assertEqual(connections.call_count, 2)
+        self.assertFalse(EmailNotification.objects.filter(status='pending').exists())
+
+    def test_digest_shares_one_window_and_task(self):
+        first = notify_by_email(self.digest, 'Two', 'second')
+        second = notify_by_email(self.digest, 'Three', 'third')
+        self.assertEqual(first.deliver_after, second.deliver_after)
+        self.assertEqual(Task.objects.filter(name='deliver_email_notifications').count(), 1)
+
+    def test_partial_failure_keeps_sent_rows_sent(self):
+        second = User.objects.create_user(username='second', password='12345', email='s@example.com').profile
+        notify_by_email(self.instant, 'One', 'first')
+        notify_by_email(second, 'Two', 'second')
+
+        def build(profile, notifications, connection):
+            if profile == self.instant:
+                raise OSError('mailbox full')
+            return build_message(profile, notifications, connection)
+
+        with mock.patch('skilloryx.notifications.build_message', side_effect=build):
+            with self.assertRaises(RuntimeError):
+                deliver_email_notifications()
+        self.assertEqual([m.to for m in mail.outbox], [['s@example.com']])
+        deliver_email_notifications()
+        self.assertEqual([m.to for m in mail.outbox], [['s@example.com'], ['i@example.com']])
+
+    def test_claimed_rows_are_not_sent_twice(self):
+        notify_by_email(self.instant, 'One', 'first')
+        # Another runner claimed it and is still sending
+        self.assertEqual(len(claim_due()), 1)
+        deliver_email_notifications()
+        self.assertEqual(mail.outbox, [])
+        # Its claim outlived the lease, so the runner died
+        EmailNotification.objects.update(
+            claimed_at=timezone.now() - timedelta(seconds=settings.TASKS_LEASE_SECONDS + 1))
+        deliver_email_notifications()
+        self.assertEqual([m.to for m in mail.outbox], [['i@example.com']])
+        self.assertEqual(EmailNotification.objects.get().status, 'sent')
+
+class CacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        caching.stats.clear()
+        self.user = User.objects.create_user(username='alice', password='12345')
+        self.skill = Skill.objects.create(name='Python')
+
+    def test_anonymous_page_cached_until_offer_saved(self):
+        self.client.get(reverse('index'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('index'))
+        Offer.objects.create(profile=self.user.profile, skill=self.skill, level='expert')
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, 'Python')
+        self.assertEqual(caching.counters()['index'], {'hits': 1, 'misses': 2})
+
+    def test_signed_in_pages_not_cached(self):
+        self.client.login(username='alice', password='12345')
+        self.client.get(reverse('about'))
+        self.client.get(reverse('about'))
+        self.assertEqual(caching.counters(), {})
+
+    def test_offer_card_fragment_invalidated_by_version(self):
+        offer = Offer.objects.create(profile=self.user.profile, skill=self.skill, level='expert', description='old text')
+        self.client.login(username='alice', password='12345')
+        self.assertContains(self.client.get(reverse('offers')), 'old text')
+        Offer.objects.filter(pk=offer.pk).update(description='new text')
+        self.assertContains(self.client.get(reverse('offers')), 'old text')
+        offer.description = 'new text'
+        offer.save()
+        self.assertContains(self.client.get(reverse('offers')), 'new text')
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Every route in urls.py gets a query budget for a GET by a signed-in user,
+    with enough rows on each list page that an N+1 would show up.
+    """
+    ROWS = 6
+
+    # Routes that change state on GET run last
+    BUDGETS = {
+        'index': 5,
+        'offers': 3,
+        'offer_create': 3,
+        'request_create': 3,
+        'offer_detail': 6,
+        'propose_swap': 5,
+        'proposals': 4,
+        'proposal_detail': 8,
+        'proposal_message': 10,
+        'signup': 2,
+        'otp_setup': 1,
+        'otp_verify': 1,
+        'login': 2,
+        'profile_edit': 4,
+        'profile': 7,
+        'video_call': 2,
+        'about': 2,
+        'privacy': 2,
+        'terms': 2,
+        'contact': 2,
+        'cache_stats': 2,
+        'metrics': 2,
+        'proposal_accept': 11,
+        'proposal_decline': 6,
+        # Includes the UPDATE that decrements the owner's offer_count
+        'offer_delete': 13,
+        'logout': 4,
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='alice', password='12345', is_staff=True).profile
+        self.bob = User.objects.create_user(username='bob', password='12345').profile
+        for i in range(self.ROWS):
+            skill = Skill.objects.create(name=f'Skill {i}')
+            mine = Offer.objects.create(profile=self.alice, skill=skill, level='expert')
+            theirs = Offer.objects.create(profile=self.bob, skill=skill, level='beginner')
+            Request.objects.create(profile=self.alice, skill=skill)
+            self.proposal = SwapProposal.objects.create(
+                proposer=self.bob, responder=self.alice, offer_from_proposer=theirs, offer_from_responder=mine
+            )
+            Message.objects.create(proposal=self.proposal, sender=self.bob, content=f'hello {i}')
+        self.offer = mine
+        self.client.login(username='alice', password='12345')
+
+    def url(self, name):
+        kwargs = {
+            'offer_delete': {'pk': self.offer.pk},
+            'offer_detail': {'pk': self.offer.pk},
+            'propose_swap': {'offer_id': self.proposal.offer_from_proposer_id},
+            'proposal_detail': {'pk': self.proposal.pk},
+            'proposal_message': {'pk': self.proposal.pk},
+            'proposal_accept': {'pk': self.proposal.pk},
+            'proposal_decline': {'pk': self.proposal.pk},
+            'profile': {'username': 'alice'},
+            'video_call': {'room_name': self.proposal.pk},
+        }
+        return reverse(name, kwargs=kwargs.get(name))
+
+    def test_every_route_has_a_budget(self):
+        from .urls import urlpatterns
+        self.assertEqual({pattern.name for pattern in urlpatterns}, set(self.BUDGETS))
+
+    def test_query_budgets(self):
+        for name, budget in self.BUDGETS.items():
+            with self.subTest(name):
+                with QueryRecorder() as recorder:
+                    self.client.get(self.url(name))
+                self.assertLessEqual(recorder.count, budget)
+                self.assertEqual(recorder.repeated(self.ROWS), [])
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        for histogram in metrics.HISTOGRAMS:
+            histogram.series.clear()
+        User.objects.create_user(username='admin', password='12345', is_staff=True)
+
+    def test_request_metrics_exposed(self):
+        self.client.get(reverse('about'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.client.login(username='admin', password='12345')
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('skilloryx_request_seconds_count{view="about"} 1', body)
+        self.assertIn('skilloryx_db_queries_bucket{view="metrics",le="+Inf"} 1', body)
+        self.assertIn('# TYPE skilloryx_template_seconds histogram', body)
+        self.assertIn('skilloryx_response_bytes_count{view="about"} 1', body)
+        _, total = metrics.template_seconds.series['about']
+        self.assertGreater(total, 0)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_auth(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer nope').status_code, 403)
+        self.client.login(username='admin', password='12345')
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_slowest_requests_profiled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2, PROFILE_DIR=directory):
+                for _ in range(4):
+                    self.client.get(reverse('terms'))
+            self.assertEqual(len(os.listdir(directory)), 2)
+        metrics.slowest.kept.clear()
+
+class OTPQRCodeTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice', password='12345')
+        self.device = TOTPDevice.objects.create(user=self.user, name='default', confirmed=False)
+        session = self.client.session
+        session['setup_user_id'] = self.user.id
+        session.save()
+
+    def test_svg_rendered_once_until_confirmed(self):
+        with mock.patch('skilloryx.qr.render_svg', wraps=qr.render_svg) as render_svg:
+            response = self.client.get(reverse('otp_setup'))
+            self.client.get(reverse('otp_setup'))
+        self.assertContains(response, '<svg')
+        self.assertEqual(render_svg.call_count, 1)
+
+        self.device.confirmed = True
+        self.device.save()
+        self.assertIsNone(cache.get(qr.cache_key(self.device)))
+
+    def test_svg_expires_after_enrolment_window(self):
+        with mock.patch('skilloryx.qr.cache') as qr_cache:
+            qr_cache.get.return_value = None
+            qr.device_svg(self.device)
+        self.assertEqual(qr_cache.set.call_args.args[2], settings.OTP_QR_CACHE_SECONDS)
+
+class ProfilePhotoTestCase(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.uploads = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media.name, PHOTO_UPLOAD_ROOT=self.uploads.name)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='alice', password='12345')
+        self.client.login(username='alice', password='12345')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media.cleanup()
+        self.uploads.cleanup()
+
+    def upload(self, size=(1600, 1200), fmt='JPEG'):
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera Maker'
+        buffer = BytesIO()
+        Image.effect_noise(size, 64).convert('RGB').save(buffer, fmt, quality=95, exif=exif)
+        return SimpleUploadedFile('me.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def post(self, photo):
+        return self.client.post(reverse('profile_edit'), {'bio': '', 'location': '', 'email_delivery': 'instant', 'photo': photo})
+
+    def media_files(self):
+        return [name for _, _, names in os.walk(self.media.name) for name in names]
+
+    def test_upload_thumbnailed_and_stripped(self):
+        photo = self.upload()
+        self.post(photo)
+        # Nothing is public until the queued job has stripped the upload
+        self.assertFalse(Profile.objects.get(user=self.user).photo)
+        self.assertEqual(self.media_files(), [])
+        run_pending()
+
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile.photo_pending, '')
+        self.assertEqual(set(profile.photo_variants), {'jpeg', 'webp'})
+        self.assertEqual(set(profile.photo_variants['webp']), {'80', '160', '320'})
+        with Image.open(profile.photo.path) as original:
+            self.assertEqual(max(original.size), 1024)
+            self.assertEqual(len(original.getexif()), 0)
+        self.assertEqual(os.listdir(os.path.join(self.uploads.name, 'profile_photos')), [])
+
+        # The profile page serves the 80px variants instead of the upload
+        served = os.path.getsize(os.path.join(self.media.name, profile.photo_variants['webp']['80']))
+        self.assertLess(served * 20, photo.size)
+        response = self.client.get(reverse('profile', args=['alice']))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, profile.photo_variants['jpeg']['160'])
+
+        # A new upload keeps the old photo up until it replaces it
+        old = [profile.photo.name, profile.photo_variants['jpeg']['80']]
+        self.post(self.upload())
+        self.assertEqual(Profile.objects.get(user=self.user).photo_variants, profile.photo_variants)
+        run_pending()
+        profile = Profile.objects.get(user=self.user)
+        self.assertNotIn(profile.photo.name, old)
+        for name in old:
+            self.assertFalse(default_storage.exists(name))
+
+    def test_superseded_upload_discarded(self):
+        self.post(self.upload())
+        self.post(self.upload(size=(800, 600)))
+        run_pending()
+        profile = Profile.objects.get(user=self.user)
+        with Image.open(profile.photo.path) as original:
+            self.assertEqual(original.size, (800, 600))
+        self.assertEqual(len(self.media_files()), 1 + 2 * len(settings.PHOTO_SIZES))
+        self.assertEqual(os.listdir(os.path.join(self.uploads.name, 'profile_photos')), [])
+
+    def test_animated_gif_stays_animated(self):
+        frames = [Image.new('RGB', (1600, 1200), color) for color in ('red', 'green', 'blue')]
+        buffer = BytesIO()
+        frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=120, loop=0, comment=b'taken at home')
+        self.post(SimpleUploadedFile('me.gif', buffer.getvalue(), content_type='image/gif'))
+        run_pending()
+
+        profile = Profile.objects.get(user=self.user)
+        self.assertTrue(profile.photo.name.endswith('.gif'))
+        with Image.open(profile.photo.path) as stored:
+            self.assertEqual(stored.n_frames, 3)
+            self.assertEqual(max(stored.size), 1024)
+            self.assertNotIn('comment', stored.info)
+        self.assertEqual(set(profile.photo_variants['jpeg']), {'80', '160', '320'})
+
+    def test_rejects_non_image(self):
+        upload = SimpleUploadedFile('me.jpg', b'not an image', content_type='image/jpeg')
+        response = self.post(upload)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Task.objects.filter(name='publish_profile_photo').exists())
+
+class MediaServingTestCase(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings_override.enable()
+        self.name = default_storage.save('profile_photos/me.jpg', ContentFile(b'0123456789' * 100))
+        self.url = reverse('media', args=[self.name])
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media.cleanup()
+
+    def test_content_hashed_and_immutable(self):
+        self.assertRegex(self.name, r'^profile_photos/me\.[0-9a-f]{12}\.jpg$')
+        again = default_storage.save(self.name, ContentFile(b'different'))
+        self.assertRegex(again, r'^profile_photos/me\.[0-9a-f]{12}\.jpg$')
+        self.assertNotEqual(again, self.name)
+
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789' * 100)
+        self.assertIn('immutable', response['Cache-Control'])
+        revalidated = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-14')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 5-14/1000')
+        self.assertEqual(b''.join(response.streaming_content), b'5678901234')
+        self.assertEqual(b''.join(self.client.get(self.url, HTTP_RANGE='bytes=-3').streaming_content), b'789')
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=2000-').status_code, 416)
+
+    def test_outside_media_root(self):
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, 404)
+        self.assertEqual(self.client.get(reverse('media', args=['missing.jpg'])).status_code, 404)
+
+class ProfileCounterTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='12345').profile
+        self.bob = User.objects.create_user(username='bob', password='12345').profile
+        self.skill = Skill.objects.create(name='Python')
+        self.mine = Offer.objects.create(profile=self.alice, skill=self.skill, level='expert')
+        self.theirs = Offer.objects.create(profile=self.bob, skill=self.skill, level='beginner')
+        Request.objects.create(profile=self.alice, skill=self.skill)
+
+    def counts(self, profile):
+        return Profile.objects.values_list(*counters.FIELDS, 'average_rating').get(pk=profile.pk)
+
+    def test_signals_keep_counters(self):
+        proposal = SwapProposal.objects.create(
+            proposer=self.alice, responder=self.bob, offer_from_proposer=self.mine, offer_from_responder=self.theirs)
+        proposal.status = 'completed'
+        proposal.save()
+        proposal.save()
+        review = Review.objects.create(swap=proposal, reviewer=self.alice, rating=4)
+        Review.objects.create(swap=SwapProposal.objects.create(
+            proposer=self.bob, responder=self.alice, offer_from_proposer=self.theirs, offer_from_responder=self.mine,
+        ), reviewer=self.alice, rating=5)
+        self.assertEqual(self.counts(self.alice), (1, 1, 1, 0, 0, None))
+        self.assertEqual(self.counts(self.bob), (1, 0, 1, 9, 2, 4.5))
+
+        review.rating = 2
+        review.save()
+        self.assertEqual(self.counts(self.bob)[3:], (7, 2, 3.5))
+        self.mine.delete()
+        self.assertEqual(self.counts(self.alice), (0, 1, 0, 0, 0, None))
+        self.assertEqual(self.counts(self.bob), (1, 0, 0, 0, 0, None))
+
+    def test_reconcile_fixes_drift(self):
+        Profile.objects.update(offer_count=7, rating_count=3)
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn('2 profiles', out.getvalue())
+        self.assertEqual(self.counts(self.alice), (1, 1, 0, 0, 0, None))
+        self.assertEqual(reconcile(), 0)
+
+    def test_profile_edit_keeps_concurrent_increment(self):
+        editing = ProfileForm({'bio': 'Edited', 'location': '', 'email_delivery': 'instant'},
+                              instance=Profile.objects.get(pk=self.alice.pk))
+        self.assertTrue(editing.is_valid())
+        Offer.objects.create(profile=self.alice, skill=Skill.objects.create(name='Chess'))
+        editing.save()
+        self.client.login(username='alice', password='12345')
+        self.assertEqual(self.counts(self.alice)[0], 2)
+        self.assertEqual(Profile.objects.get(pk=self.alice.pk).bio, 'Edited')
+
+class GeoTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='learner', password='12345')
+        self.user.profile.location = 'Dhaka, Bangladesh'
+        self.user.profile.save()
+        skill = Skill.objects.create(name='Guitar')
+        self.teachers = {}
+        for location in ('Dacca', 'Gazipur', 'Chittagong', 'Atlantis'):
+            profile = User.objects.create_user(username=location.lower(), password='12345').profile
+            profile.location = location
+            profile.save()
+            self.teachers[location] = Offer.objects.create(profile=profile, skill=skill)
+
+    def test_spellings_geocode_to_one_place(self):
+        self.assertEqual(geo.geocode('Dhaka, Bangladesh'), geo.geocode('dacca'))
+        self.assertEqual(geo.geocode('Mirpur, Dhaka'), geo.geocode('Dhaka'))
+        self.assertIsNone(geo.geocode('Atlantis'))
+        profile = Profile.objects.get(user__username='dacca')
+        self.assertEqual(profile.geohash, self.user.profile.geohash)
+        profile.location = 'Atlantis'
+        profile.save(update_fields=['location'])
+        self.assertEqual(Profile.objects.get(pk=profile.pk).geohash, '')
+
+    def test_near_is_a_range_scan_on_the_geohash_index(self):
+        profile = self.user.profile
+        offers = geo.near(Offer.objects.all(), profile.latitude, profile.longitude, 25, field='profile__geohash')
+        self.assertEqual(set(offers), {self.teachers['Dacca'], self.teachers['Gazipur']})
+        self.assertIn('geohash" >=', str(offers.query))
+        self.client.login(username='learner', password='12345')
+        response = self.client.get(reverse('offers'), {'near': '100'})
+        self.assertEqual(set(response.context['offers']), {self.teachers['Dacca'], self.teachers['Gazipur']})
+        response = self.client.get(reverse('offers'), {'near': '500'})
+        self.assertEqual(len(response.context['offers']), 4)
+
+    def test_nearby_spellings_get_the_location_bonus(self):
+        Request.objects.create(profile=self.user.profile, skill=self.teachers['Dacca'].skill)
+        with self.captureOnCommitCallbacks(execute=True):
+            refresh_profile(self.user.profile)
+        scores = dict(Match.objects.filter(profile=self.user.profile).values_list('offer', 'score'))
+        far = scores[self.teachers['Chittagong'].pk]
+        self.assertEqual(scores[self.teachers['Dacca'].pk], far + 1)
+        self.assertEqual(scores[self.teachers['Gazipur'].pk], far + 1)
+        self.assertEqual(scores[self.teachers['Atlantis'].pk], far)
+
+    def test_unknown_city_matches_the_same_name(self):
+        profile = self.user.profile
+        profile.location = ' atlantis'
+        profile.save()
+        self.assertEqual(profile.geohash, '')
+        Request.objects.create(profile=profile, skill=self.teachers['Dacca'].skill)
+        # Scored from the learner's side, from the teacher's, and in bulk
+        refresh_profile(profile)
+        learner_side = dict(Match.objects.filter(profile=profile).values_list('offer', 'score'))
+        refresh_profile(self.teachers['Atlantis'].profile)
+        teacher_side = Match.objects.get(offer=self.teachers['Atlantis']).score
+        rebuild_all()
+        rebuilt = dict(Match.objects.filter(profile=profile).values_list('offer', 'score'))
+        self.assertEqual(learner_side, rebuilt)
+        self.assertEqual(teacher_side, rebuilt[self.teachers['Atlantis'].pk])
+        self.assertEqual(rebuilt[self.teachers['Atlantis'].pk], rebuilt[self.teachers['Dacca'].pk] + 1)
@@ -1,35 +1,85 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
 from .models import Offer, Skill, Profile, SwapProposal, Message, Request
+from .matching import top_matches, schedule_refresh
+from .pagination import KeysetPage, keyset_page, page_size_from, encode_cursor, decode_cursor
+from .search import search_ids
+from .chat import broadcast_message, message_payload
+from .tasks import enqueue
+from .notifications import notify_by_email
+from .caching import cache_anonymous, counters
+from . import geo, inbox, metrics, photos, presence
+from .qr import device_svg
+from .storage import is_hashed
 from .forms import OfferForm, ProposeForm, MessageForm, SignUpForm, RequestForm, OTPTokenForm, ProfileForm
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.models import User
 from django.db.models import Q
+from django.conf import settings
 from django_otp.plugins.otp_totp.models import TOTPDevice
-from django.core.mail import send_mail
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from django.db import transaction
+import mimetypes
+import os
+import re
 
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Radii, in km, offered by the offer list's "near me" filter
+NEARBY_KM = ('5', '25', '100')
+
+def _offers():
+    return Offer.objects.select_related('skill', 'profile__user')
+
+def _proposals():
+    return SwapProposal.objects.select_related(
+        'proposer__user', 'responder__user', 'offer_from_proposer__skill', 'offer_from_responder__skill'
+    )
+
+@cache_anonymous('offers', 'profiles')
 def index(request):
 
-    offers = Offer.objects.order_by('-created_at')[:12]
+    offers = keyset_page(_offers(), page_size=12).items
     suggestions = []
+    online = set()
     if request.user.is_authenticated:
         profile, created = Profile.objects.get_or_create(user=request.user)
-        suggestions = find_matches(profile)[:6]
-    return render(request, 'skilloryx/index.html', {'offers':offers, 'suggestions':suggestions})
+        suggestions = list(top_matches(profile, 6))
+        online = presence.online({suggestion.partner.user_id for suggestion in suggestions})
+    return render(request, 'skilloryx/index.html', {'offers':offers, 'suggestions':suggestions, 'online':online})
 
+@cache_anonymous('offers', 'profiles')
 def offer_list(request):
     q = request.GET.get('q','')
+    offers = _offers()
+    near = request.GET.get('near', '')
+    if near not in NEARBY_KM or not request.user.is_authenticated:
+        near = ''
+    elif request.user.profile.geohash:
+        # Only teachers in the geohash cells around the user's own location
+        profile = request.user.profile
+        offers = geo.near(offers, profile.latitude, profile.longitude, int(near), field='profile__geohash')
     if q:
-        offers = Offer.objects.filter(skill__name__icontains=q)
+        # Relevance-ranked, so a single capped page rather than a cursor.
+        ids = search_ids('offer', q, limit=settings.MAX_PAGE_SIZE)
+        found = offers.in_bulk(ids)
+        page = KeysetPage([found[pk] for pk in ids if pk in found])
     else:
-        offers = Offer.objects.order_by('-created_at')
-    return render(request, 'skilloryx/offer_list.html', {'offers':offers, 'q':q})
+        page = keyset_page(offers, request.GET.get('cursor'), page_size_from(request.GET.get('size')))
+    return render(request, 'skilloryx/offer_list.html', {
+        'offers':page.items, 'page':page, 'q':q, 'near':near, 'nearby_km':NEARBY_KM,
+    })
 
+@cache_anonymous('offers', 'profiles')
 def offer_detail(request, pk):
-    offer = get_object_or_404(Offer, pk=pk)
+    offer = get_object_or_404(_offers(), pk=pk)
     return render(request, 'skilloryx/offer_detail.html', {'offer':offer})
 
 @login_required
@@ -69,39 +119,54 @@ def request_create(request):
 @login_required
 def propose_swap(request, offer_id):
     profile, created = Profile.objects.get_or_create(user=request.user)
-    target = get_object_or_404(Offer, id=offer_id)
+    target = get_object_or_404(_offers(), id=offer_id)
     if target.profile == profile:
         return redirect('offer_detail', pk=offer_id)
     if request.method == 'POST':
         our_offer_id = request.POST.get('our_offer')
         our_offer = get_object_or_404(Offer, id=our_offer_id, profile=profile)
-        proposal = SwapProposal.objects.create(
-            proposer=profile,
-            responder=target.profile,
-            offer_from_proposer=our_offer,
-            offer_from_responder=target,
-            message=request.POST.get('message','')
-        )
+        with transaction.atomic():
+            proposal = SwapProposal.objects.create(
+                proposer=profile,
+                responder=target.profile,
+                offer_from_proposer=our_offer,
+                offer_from_responder=target,
+                message=request.POST.get('message','')
+            )
+            notify_by_email(
+                target.profile,
+                'You Have a New Swap Proposal',
+                f'{profile.user.username} wants to swap {our_offer.skill.name} for your {target.skill.name}.\n\n'
+                f'Review it here: {request.build_absolute_uri(f"/proposals/{proposal.pk}/")}'
+            )
         return redirect('proposals')
     else:
-        my_offers = profile.offers.all()
+        my_offers = profile.offers.select_related('skill')
         return render(request, 'skilloryx/propose.html', {'target':target, 'my_offers':my_offers})
 
 @login_required
 def proposal_list(request):
     profile, created = Profile.objects.get_or_create(user=request.user)
-    sent = profile.proposals_sent.all()
-    received = profile.proposals_received.all()
-    return render(request, 'skilloryx/proposal_list.html', {'sent':sent, 'received':received})
+    status = request.GET.get('status', '')
+    if status not in inbox.STATUSES:
+        status = ''
+    page = inbox.page(profile, status, request.GET.get('cursor'), page_size_from(request.GET.get('size')))
+    return render(request, 'skilloryx/proposal_list.html', {
+        'proposals':page.items, 'page':page, 'profile':profile, 'status':status, 'statuses':inbox.STATUSES,
+    })
 
 @login_required
 def proposal_detail(request, pk):
     profile, created = Profile.objects.get_or_create(user=request.user)
-    proposal = get_object_or_404(SwapProposal, pk=pk)
+    proposal = get_object_or_404(_proposals(), pk=pk)
     if profile not in [proposal.proposer, proposal.responder]:
         return redirect('index')
     message_form = MessageForm()
-    return render(request, 'skilloryx/proposal_detail.html', {'proposal':proposal, 'message_form':message_form})
+    chat_messages = list(proposal.messages.select_related('sender__user').order_by('created_at', 'id'))
+    cursor = encode_cursor(chat_messages[-1]) if chat_messages else ''
+    if chat_messages:
+        inbox.mark_read(proposal.pk, profile, chat_messages[-1].id)
+    return render(request, 'skilloryx/proposal_detail.html', {'proposal':proposal, 'message_form':message_form, 'chat_messages':chat_messages, 'cursor':cursor})
 
 @login_required
 def proposal_message(request, pk):
@@ -109,6 +174,7 @@ def proposal_message(request, pk):
     proposal = get_object_or_404(SwapProposal, pk=pk)
     if profile not in [proposal.proposer, proposal.responder]:
         return redirect('index')
+    from django.http import JsonResponse, HttpResponseNotModified
     if request.method == 'POST':
         form = MessageForm(request.POST)
         if form.is_valid():
@@ -116,41 +182,62 @@ def proposal_message(request, pk):
             msg.proposal = proposal
             msg.sender = profile
             msg.save()
-
-            from django.http import JsonResponse
-            return JsonResponse({'success':True, 'content':msg.content, 'created_at': str(msg.created_at), 'sender': msg.sender.user.username})
-    from django.http import JsonResponse
-
-    msgs = list(proposal.messages.values('id','sender__user__username','content','created_at'))
-    return JsonResponse({'messages':msgs})
+            broadcast_message(msg)
+
+            return JsonResponse({'success':True, 'content':msg.content, 'created_at': str(msg.created_at), 'sender': msg.sender.user.username, 'message': message_payload(msg)})
+
+    # Only messages after the client's cursor; an up-to-date client gets a 304
+    cursor = request.GET.get('after', '')
+    limit = page_size_from(request.GET.get('limit'), default=settings.MAX_PAGE_SIZE)
+    latest = proposal.messages.order_by('-created_at', '-id').values_list('id', flat=True).first()
+    etag = f'"{pk}-{latest or 0}-{cursor}-{limit}"'
+    if request.headers.get('If-None-Match') == etag:
+        return HttpResponseNotModified(headers={'ETag': etag})
+
+    msgs = proposal.messages.select_related('sender__user').order_by('created_at', 'id')
+    position = decode_cursor(cursor)
+    if position:
+        created_at, last_id = position
+        msgs = msgs.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=last_id))
+    msgs = list(msgs[:limit + 1])
+    has_more = len(msgs) > limit
+    msgs = msgs[:limit]
+    if msgs:
+        inbox.mark_read(proposal.pk, profile, msgs[-1].id)
+    response = JsonResponse({
+        'messages': [message_payload(msg) for msg in msgs],
+        'cursor': encode_cursor(msgs[-1]) if msgs else cursor,
+        'has_more': has_more,
+    })
+    response['ETag'] = etag
+    return response
 
 @login_required
 def proposal_accept(request, pk):
     profile, created = Profile.objects.get_or_create(user=request.user)
-    proposal = get_object_or_404(SwapProposal, pk=pk)
+    proposal = get_object_or_404(_proposals(), pk=pk)
     if profile != proposal.responder:
         return redirect('index')
-    proposal.status = 'accepted'
-    proposal.save()
-
-    # Send real-time notification to proposer
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        f'user_{proposal.proposer.user.username}',
-        {
-            'type': 'user_notification',
-            'message': {
+    with transaction.atomic():
+        proposal.status = 'accepted'
+        proposal.save()
+
+        # Notification and email are queued so a slow channel layer or SMTP
+        # server doesn't hold up the redirect; run_tasks delivers them
+        enqueue(
+            'push_notification',
+            group=f'user_{proposal.proposer.user.username}',
+            message={
                 'type': 'video_call_invitation',
                 'proposal_id': pk,
                 'message': f'{proposal.responder.user.username} has accepted your proposal. Join the video call now!',
                 'url': request.build_absolute_uri(f'/video_call/{pk}')
             }
-        }
-    )
+        )
 
-    # Send email notification to proposer
-    subject = 'Your Swap Proposal Has Been Accepted!'
-    message = f'''
+        # Send email notification to proposer
+        subject = 'Your Swap Proposal Has Been Accepted!'
+        message = f'''
 Hello {proposal.proposer.user.username},
 
 Your swap proposal for {proposal.offer_from_proposer.skill.name} has been accepted by {proposal.responder.user.username}.
@@ -162,7 +249,7 @@ Click here to join: {request.build_absolute_uri('/video_call/' + str(pk))}
 Best regards,
 SkillOryx Team
 '''
-    send_mail(subject, message, None, [proposal.proposer.user.email])
+        notify_by_email(proposal.proposer, subject, message)
 
     # Redirect to video call immediately
     return redirect('video_call', room_name=pk)
@@ -216,18 +303,7 @@ def otp_setup_view(request):
     else:
         form = OTPTokenForm()
 
-    import qrcode
-    import io
-    import base64
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(device.config_url)
-    qr.make(fit=True)
-    img = qr.make_image(fill='black', back_color='white')
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    qr_code = base64.b64encode(buffer.getvalue()).decode()
-
-    return render(request, 'skilloryx/otp_setup.html', {'form': form, 'qr_code': qr_code, 'device': device})
+    return render(request, 'skilloryx/otp_setup.html', {'form': form, 'qr_svg': device_svg(device), 'device': device})
 
 def login_view(request):
     if request.method == 'POST':
@@ -289,22 +365,32 @@ def profile_edit(request):
         form = ProfileForm(request.POST, request.FILES, instance=profile)
         if form.is_valid():
             form.save()
+            if 'location' in form.changed_data:
+                schedule_refresh(profile.id)
+            if form.cleaned_data['photo']:
+                photos.accept_upload(profile, form.cleaned_data['photo'])
             return redirect('profile', username=request.user.username)
     else:
         form = ProfileForm(instance=profile)
     return render(request, 'skilloryx/profile_edit.html', {'form': form})
 
+@cache_anonymous('profiles', 'offers', 'requests')
 def profile_view(request, username):
-    user = get_object_or_404(User, username=username)
-    profile = user.profile
+    profile = get_object_or_404(
+        Profile.objects.select_related('user').prefetch_related('offers__skill', 'requests__skill'),
+        user__username=username,
+    )
     return render(request, 'skilloryx/profile.html', {'profile':profile})
 
+@cache_anonymous()
 def about_view(request):
     return render(request, 'skilloryx/about.html')
 
+@cache_anonymous()
 def privacy_view(request):
     return render(request, 'skilloryx/privacy.html')
 
+@cache_anonymous()
 def terms_view(request):
     return render(request, 'skilloryx/terms.html')
 
@@ -312,25 +398,85 @@ def terms_view(request):
 def video_call(request, room_name):
     return render(request, 'skilloryx/video_call.html', {'room_name': room_name})
 
+@cache_anonymous()
 def contact_view(request):
     return render(request, 'skilloryx/contact.html')
 
-
-def find_matches(profile):
-    my_offers = set(o.skill for o in profile.offers.all())
-    my_requests = set(r.skill for r in profile.requests.all())
-    candidates = []
-    for offer in Offer.objects.filter(skill__in=my_requests).exclude(profile=profile):
-        other = offer.profile
-        other_offers = set(o.skill for o in other.offers.all())
-        other_requests = set(r.skill for r in other.requests.all())
-        score = 0
-        if any(skill in my_offers for skill in other_requests):
-            score += 2
-        if offer.available_online:
-            score += 1
-        if profile.location and profile.location == other.location:
-            score += 1
-        candidates.append((other, score, offer))
-    candidates.sort(key=lambda x: x[1], reverse=True)
-    return candidates
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse(counters())
+
+def metrics_view(request):
+    allowed = request.user.is_staff or bool(settings.METRICS_TOKEN) and constant_time_compare(
+        request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}')
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4')
+
+
+def _byte_range(header, size):
+    """
+    (start, end) of a single `bytes=` range, None to send the whole file,
+    or False if the range can't be satisfied.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(MEDIA_CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    stat = os.stat(full_path)
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        # Hashed names never change content, so browsers needn't revalidate
+        'Cache-Control': 'public, max-age=31536000, immutable' if is_hashed(path) else f'public, max-age={settings.MEDIA_MAX_AGE}',
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        byte_range = None
+        if request.headers.get('If-Range', etag) in (etag, headers['Last-Modified']):
+            byte_range = _byte_range(request.headers.get('Range', ''), stat.st_size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+        elif byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(_read_range(full_path, start, end - start + 1), status=206, content_type=content_type)
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        else:
+            # FileResponse hands the open file to the server's file_wrapper (sendfile)
+            response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    for header, value in headers.items():
+        response[header] = value
+    return response
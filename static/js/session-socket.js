@@ -0,0 +1,53 @@
+// Page side of the shared session socket (see session-worker.js).
+//
+//   SkilloryxSession.on('notifications', payload => ...)
+//   SkilloryxSession.subscribe('chat:5', 'chat', {action: 'subscribe', proposal: 5},
+//                              {action: 'unsubscribe', proposal: 5})
+//   SkilloryxSession.send('chat', {action: 'send', proposal: 5, content: 'Hi'})
+
+const SkilloryxSession = (() => {
+  const url = document.currentScript.dataset.worker;
+  const worker = typeof SharedWorker !== 'undefined'
+    ? new SharedWorker(url, { name: 'skilloryx-session' })
+    : new Worker(url);
+  const port = worker.port || worker;
+  const handlers = { open: [], closed: [] };
+  let open = false;
+
+  function emit(name, payload) {
+    (handlers[name] || []).forEach(handler => handler(payload));
+  }
+
+  port.onmessage = ({ data }) => {
+    if (data.type === 'frame') {
+      emit(`stream:${data.frame.stream}`, data.frame.payload);
+    } else if (data.type === 'open' || data.type === 'closed') {
+      open = data.type === 'open';
+      emit(data.type);
+    }
+  };
+
+  window.addEventListener('pagehide', () => port.postMessage({ type: 'close' }));
+  // Restored from the back/forward cache after this page's port was released
+  window.addEventListener('pageshow', (event) => { if (event.persisted) window.location.reload(); });
+
+  return {
+    isOpen: () => open,
+    on(stream, handler) {
+      (handlers[`stream:${stream}`] = handlers[`stream:${stream}`] || []).push(handler);
+    },
+    onOpen(handler) { handlers.open.push(handler); },
+    onClose(handler) { handlers.closed.push(handler); },
+    send(stream, payload) {
+      port.postMessage({ type: 'send', frame: { stream, payload } });
+    },
+    subscribe(key, stream, payload, leave) {
+      port.postMessage({
+        type: 'subscribe', key, frame: { stream, payload }, leave: leave && { stream, payload: leave },
+      });
+    },
+    unsubscribe(key) {
+      port.postMessage({ type: 'unsubscribe', key });
+    },
+  };
+})();
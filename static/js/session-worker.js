@@ -0,0 +1,130 @@
+// Holds the one /ws/session/ socket for the whole browser session. Loaded
+// as a SharedWorker, every open tab talks to it over its own port; where
+// SharedWorker is missing it runs as a dedicated worker for a single page.
+//
+// Pages post {type: 'send' | 'subscribe' | 'unsubscribe' | 'close'}.
+// Subscriptions are reference counted across pages and replayed after a
+// reconnect; server frames are broadcast to every page as {type: 'frame'}.
+
+const ports = new Set();
+const subscriptions = new Map();
+let socket = null;
+let queue = [];
+let retryDelay = 1000;
+let idleTimer = null;
+let heartbeat = null;
+
+function broadcast(message) {
+  ports.forEach(port => port.postMessage(message));
+}
+
+function connect() {
+  const url = new URL('/ws/session/', self.location.href);
+  url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:';
+  socket = new WebSocket(url);
+
+  socket.onopen = () => {
+    retryDelay = 1000;
+    subscriptions.forEach(sub => socket.send(JSON.stringify(sub.frame)));
+    queue.forEach(frame => socket.send(frame));
+    queue = [];
+    broadcast({ type: 'open' });
+  };
+
+  socket.onmessage = (event) => {
+    const frame = JSON.parse(event.data);
+    if (frame.stream === 'session' && frame.payload.heartbeat) {
+      // Keeps this session counted as online (see presence.py)
+      clearInterval(heartbeat);
+      heartbeat = setInterval(
+        () => sendFrame({ stream: 'presence', payload: { action: 'heartbeat' } }),
+        frame.payload.heartbeat * 1000
+      );
+      return;
+    }
+    broadcast({ type: 'frame', frame });
+  };
+
+  socket.onclose = () => {
+    socket = null;
+    clearInterval(heartbeat);
+    broadcast({ type: 'closed' });
+    if (ports.size) {
+      setTimeout(() => { if (!socket && ports.size) connect(); }, retryDelay);
+      retryDelay = Math.min(retryDelay * 2, 30000);
+    }
+  };
+}
+
+function sendFrame(frame) {
+  const data = JSON.stringify(frame);
+  if (socket && socket.readyState === WebSocket.OPEN) {
+    socket.send(data);
+  } else {
+    queue.push(data);
+    if (!socket) connect();
+  }
+}
+
+// Subscription frames are never queued: a new socket starts with no
+// subscriptions, and onopen replays the ones still held
+function sendSubscriptionFrame(frame) {
+  if (socket && socket.readyState === WebSocket.OPEN) {
+    socket.send(JSON.stringify(frame));
+  } else if (!socket) {
+    connect();
+  }
+}
+
+function release(port, key) {
+  const sub = subscriptions.get(key);
+  if (!sub) return;
+  sub.ports.delete(port);
+  if (!sub.ports.size) {
+    subscriptions.delete(key);
+    if (sub.leave) sendSubscriptionFrame(sub.leave);
+  }
+}
+
+function detach(port) {
+  ports.delete(port);
+  subscriptions.forEach((sub, key) => release(port, key));
+  if (!ports.size) {
+    // Give a page that is navigating a moment to reattach before closing
+    clearTimeout(idleTimer);
+    idleTimer = setTimeout(() => { if (!ports.size && socket) socket.close(); }, 5000);
+  }
+}
+
+function attach(port) {
+  ports.add(port);
+  clearTimeout(idleTimer);
+  port.onmessage = ({ data }) => {
+    if (data.type === 'send') {
+      sendFrame(data.frame);
+    } else if (data.type === 'subscribe') {
+      let sub = subscriptions.get(data.key);
+      if (!sub) {
+        sub = { frame: data.frame, leave: data.leave, ports: new Set() };
+        subscriptions.set(data.key, sub);
+        sendSubscriptionFrame(data.frame);
+      }
+      sub.ports.add(port);
+    } else if (data.type === 'unsubscribe') {
+      release(port, data.key);
+    } else if (data.type === 'close') {
+      detach(port);
+    }
+  };
+  if (!socket) {
+    connect();
+  } else if (socket.readyState === WebSocket.OPEN) {
+    port.postMessage({ type: 'open' });
+  }
+}
+
+if ('onconnect' in self) {
+  self.onconnect = (event) => attach(event.ports[0]);
+} else {
+  attach(self);
+}